@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of chunk splitting and metadata stamping on the film corpus.
+
+    python -m benchmarks.split_benchmark --limit 10000 --repeat 3
+
+baseline  : a new splitter per film, split_documents then generate_chunk_metadata,
+            the way the loader used to do it
+streaming : iter_chunks_with_metadata over all films with the shared splitter
+"""
+import argparse
+import time
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from utils import ew_embedding_util
+from utils import ew_mysql_util
+from film.io.film_document import build_payload, build_document
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the per call splitter with the streaming splitter")
+    parser.add_argument("--limit", type=int, default=10000, help="Number of films read from film_indonesia")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per splitter, the best one is reported")
+    args = parser.parse_args()
+
+    docs = load_corpus(args.limit)
+    print(f"Corpus: [{len(docs)}] films")
+
+    baseline_chunks = split_baseline(docs)
+    streaming_chunks = list(ew_embedding_util.iter_chunks_with_metadata(docs))
+    same = ([(c.page_content, c.metadata) for c in baseline_chunks]
+            == [(c.page_content, c.metadata) for c in streaming_chunks])
+    print(f"Chunks: [{len(streaming_chunks)}], identical output: [{same}]")
+
+    baseline = best_of(args.repeat, lambda: split_baseline(docs))
+    streaming = best_of(args.repeat, lambda: sum(1 for _ in ew_embedding_util.iter_chunks_with_metadata(docs)))
+    print(f"baseline  : [{baseline:.3f}]s [{len(docs) / baseline:.0f}] films/s")
+    print(f"streaming : [{streaming:.3f}]s [{len(docs) / streaming:.0f}] films/s")
+    print(f"speedup   : [{baseline / streaming:.2f}]x")
+
+
+def load_corpus(limit):
+    mysql_conn = ew_mysql_util.get_mysql_conn()
+    cursor = mysql_conn.cursor()
+    cursor.execute("SELECT film_id, title, description FROM film_indonesia ORDER BY film_id LIMIT %s", (limit,))
+    docs = [build_document(film_id, build_payload(film_id, title, description)) for film_id, title, description in cursor.fetchall()]
+    cursor.close()
+    mysql_conn.close()
+    return docs
+
+
+def split_baseline(docs):
+    chunks = list()
+    for doc in docs:
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=ew_embedding_util.CHUNK_SIZE,
+            chunk_overlap=ew_embedding_util.CHUNK_OVERLAP,
+            length_function=len,
+            is_separator_regex=False,
+        )
+        chunks.extend(ew_embedding_util.generate_chunk_metadata(text_splitter.split_documents([doc])))
+    return chunks
+
+
+def best_of(repeat, fn):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Benchmark of the cold start of the film modules, every run is a fresh interpreter.
+
+    python -m benchmarks.startup_benchmark --repeat 5
+
+Nothing is queried: chroma, the embedding model and MySQL are only opened on
+first use, an import that still opens one of them shows up here as a slow start.
+Run `python -X importtime -c "import <module>"` to see where the time goes.
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+# Label and command of every measured start
+TARGETS = [
+    ("interpreter", [sys.executable, "-c", "pass"]),
+    ("film_controller --help", [sys.executable, "-m", "film.film_controller", "--help"]),
+    ("import film.service.film_get_service", [sys.executable, "-c", "import film.service.film_get_service"]),
+    ("import film.service.film_search_service", [sys.executable, "-c", "import film.service.film_search_service"]),
+    ("import film.agents.app", [sys.executable, "-c", "import film.agents.app"]),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the cold start of the film modules")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per target, the best one is reported")
+    args = parser.parse_args()
+
+    width = max(len(label) for label, _ in TARGETS)
+    for label, command in TARGETS:
+        if not run(command):
+            print(f"{label.ljust(width)} : failed, run [{' '.join(command[1:])}] to see why")
+            continue
+        elapsed = best_of(args.repeat, lambda: run(command))
+        print(f"{label.ljust(width)} : [{elapsed:.3f}]s")
+
+
+def run(command):
+    return subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def best_of(repeat, fn):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    main()
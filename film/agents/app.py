@@ -1,6 +1,9 @@
+import asyncio
 import logging
+import time
 import uuid
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import Literal
 
@@ -9,12 +12,14 @@ from langgraph.graph import END, StateGraph, START
 from langgraph.prebuilt import tools_condition
 
 from film.agents.state import State
-from film.agents.keyword_agent import keyword_agent
-from film.agents.mysql_agent import mysql_agent
-from film.agents.chroma_agent import chroma_agent
-from film.agents.reranking_agent import reranking_agent
-from film.agents.evaluation_agent import evaluation_agent
+from film.agents.keyword_agent import keyword_agent, akeyword_agent
+from film.agents.mysql_agent import mysql_agent, amysql_agent, mysql_search_many
+from film.agents.chroma_agent import chroma_agent, achroma_agent, chroma_search_many
+from film.agents.reranking_agent import reranking_agent, areranking_agent
+from film.agents.evaluation_agent import evaluation_agent, aevaluation_agent, evaluate_items, get_descriptions
+from film.agents.result_cache import ResultCache
 from film.agents.utils import *
+from utils.ew_cache_util import DiskCache
 
 from langchain.globals import set_debug
 
@@ -22,6 +27,25 @@ logger = logging.getLogger(__name__)
 
 set_debug(False)
 
+RESULT_CACHE_TTL = 3600
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_THRESHOLD = 0.98
+# Prompts whose LLM stages run at the same time in agent_rag_batch
+BATCH_LLM_CONCURRENCY = 4
+PAGE_SIZE = 5
+# The first page fetches as deep as agent_rag, every refill multiplies the depth
+PAGE_MYSQL_LIMIT = 5
+PAGE_CHROMA_K = 10
+PAGE_DEPTH_FACTOR = 4
+PAGE_MAX_DEPTH = 1000
+PAGE_CURSOR_TTL = 1800
+PAGE_CURSOR_PATH = "cache/page_cursor.sqlite"
+result_cache = ResultCache("chroma_film_indonesia"
+                           , ttl=RESULT_CACHE_TTL
+                           , max_size=RESULT_CACHE_SIZE
+                           , threshold=RESULT_CACHE_THRESHOLD)
+page_cursors = DiskCache(PAGE_CURSOR_PATH, max_bytes=64 * 1024 * 1024)
+
 """
 Semantically search data with the provided keywords.
 Here is how the search algorithm works:
@@ -48,24 +72,44 @@ Here is how the search algorithm works:
 5. Evaluate top 5 recommended movies for relevancy
 """
 
-builder = StateGraph(State)
-builder.add_node("keyword_agent", keyword_agent)
-builder.add_node("mysql_agent", mysql_agent)
-builder.add_node("chroma_agent", chroma_agent)
-builder.add_node("reranking_agent", reranking_agent)
-builder.add_node("evaluation_agent", evaluation_agent)
+def build_graph(evaluate=True, asynchronous=False):
+    """
+    The search graph, without evaluate it stops at the fused candidate list.
+    The asynchronous graph runs the async agents and is driven with astream / ainvoke.
+    """
+
+    builder = StateGraph(State)
+    builder.add_node("keyword_agent", akeyword_agent if asynchronous else keyword_agent)
+    builder.add_node("mysql_agent", amysql_agent if asynchronous else mysql_agent)
+    builder.add_node("chroma_agent", achroma_agent if asynchronous else chroma_agent)
+    builder.add_node("reranking_agent", areranking_agent if asynchronous else reranking_agent)
+
+    builder.add_edge("__start__", "keyword_agent")
+    builder.add_edge("keyword_agent", "mysql_agent")
+    builder.add_edge("keyword_agent", "chroma_agent")
+    builder.add_edge(["chroma_agent", "mysql_agent"], "reranking_agent")
+    if evaluate:
+        builder.add_node("evaluation_agent", aevaluation_agent if asynchronous else evaluation_agent)
+        builder.add_edge("reranking_agent", "evaluation_agent")
+        builder.add_edge("evaluation_agent", "__end__")
+    else:
+        builder.add_edge("reranking_agent", "__end__")
+
+    return builder.compile()
 
 
-builder.add_edge("__start__", "keyword_agent")
-builder.add_edge("keyword_agent", "mysql_agent")
-builder.add_edge("keyword_agent", "chroma_agent")
-builder.add_edge(["chroma_agent", "mysql_agent"], "reranking_agent")
-builder.add_edge("reranking_agent", "evaluation_agent")
-builder.add_edge("evaluation_agent", "__end__")
+app = build_graph()
+candidate_app = build_graph(evaluate=False)
+async_app = build_graph(asynchronous=True)
 
-app = builder.compile()
+def agent_rag(user_prompt: str, filters: dict = None):
+    # Repeated and near identical prompts are answered without running the graph,
+    # the cache is keyed by prompt only so filtered searches bypass it
+    if not filters:
+        cached = result_cache.lookup(user_prompt)
+        if cached is not None:
+            return cached
 
-def agent_rag(user_prompt: str):
     thread_id = str(uuid.uuid4())
     config = {
         "configurable": {
@@ -75,8 +119,224 @@ def agent_rag(user_prompt: str):
     }
 
     inputs = {"ori_prompt": user_prompt}
+    if filters:
+        inputs["filters"] = filters
     response = {}
     for output in app.stream(inputs, config, stream_mode="values"):
         response = output
 
+    if not filters:
+        result_cache.store(user_prompt, response["result_list"])
     return response["result_list"]
+
+
+async def agent_rag_async(user_prompt: str, filters: dict = None):
+    """
+    agent_rag on the event loop, many searches can be awaited at the same time by one worker.
+    The LLM calls are awaited, MySQL, chroma and the result cache run on worker threads.
+    """
+
+    if not filters:
+        cached = await asyncio.to_thread(result_cache.lookup, user_prompt)
+        if cached is not None:
+            return cached
+
+    config = {
+        "configurable": {
+            "user_id": "anonymous",
+            "thread_id": str(uuid.uuid4()),
+        }
+    }
+
+    inputs = {"ori_prompt": user_prompt}
+    if filters:
+        inputs["filters"] = filters
+    response = {}
+    async for output in async_app.astream(inputs, config, stream_mode="values"):
+        response = output
+
+    if not filters:
+        await asyncio.to_thread(result_cache.store, user_prompt, response["result_list"])
+    return response["result_list"]
+
+
+
+def agent_rag_batch(prompts: list[str], llm_concurrency: int = BATCH_LLM_CONCURRENCY):
+    """
+    agent_rag over many prompts, one result list per prompt plus throughput stats.
+
+    1. Keywords of every prompt, LLM calls spread over `llm_concurrency` threads
+    2. Chroma, every query text embedded in one call and sent as one vector query
+    3. MySQL, the candidates of many prompts fetched with UNION ALL statements
+    4. Reranking per prompt, the descriptions of every top 5 read with one query
+    5. Evaluation of the top 5 of every prompt, again over `llm_concurrency` threads
+
+    A prompt that fails gets an empty result list and is counted in the stats. A batched
+    backend call that fails is retried prompt by prompt, so one bad prompt only fails itself.
+    """
+
+    stats = {"prompts": len(prompts), "failed": 0}
+    timings = dict()
+    start = time.perf_counter()
+
+    def timed(stage, fn):
+        stage_start = time.perf_counter()
+        value = fn()
+        timings[stage] = time.perf_counter() - stage_start
+        return value
+
+    def safe(fn, *args):
+        try:
+            return fn(*args)
+        except Exception as e:
+            logger.error(f"Batch search Error: {e}")
+            return None
+
+    def safe_many(fn, texts):
+        """fn over many texts in one call, one call per text when it fails, None for the texts still failing"""
+
+        result = safe(fn, texts)
+        if result is not None:
+            return result
+        return [None if value is None else value[0] for value in (safe(fn, [text]) for text in texts)]
+
+    def valid():
+        return [i for i, state in enumerate(states) if state is not None]
+
+    with ThreadPoolExecutor(max_workers=llm_concurrency) as executor:
+        states = timed("keywords", lambda: list(executor.map(lambda prompt: safe(keyword_agent, {"ori_prompt": prompt}), prompts)))
+        searched = valid()
+        query_texts = [states[i]["keywords"] + " " + states[i]["ind_prompt"] for i in searched]
+
+        chroma_lists = timed("chroma", lambda: safe_many(chroma_search_many, query_texts))
+        mysql_lists = timed("mysql", lambda: safe_many(mysql_search_many, query_texts))
+
+        def rerank(i, chroma_list, mysql_list):
+            states[i]["chroma_list"] = chroma_list
+            states[i]["mysql_list"] = mysql_list
+            states[i].update(reranking_agent(states[i]))
+            return True
+
+        def rerank_all():
+            for i, chroma_list, mysql_list in zip(searched, chroma_lists, mysql_lists):
+                if chroma_list is None or mysql_list is None or safe(rerank, i, chroma_list, mysql_list) is None:
+                    states[i] = None
+        timed("reranking", rerank_all)
+
+        # The evaluation threads must not share the MySQL connection, descriptions are read up front
+        item_ids = [item["item_id"] for i in valid() for item in states[i]["combined_list"][:5]]
+        descriptions = timed("descriptions", lambda: safe(get_descriptions, item_ids))
+        if descriptions is None:
+            # Without descriptions the evaluator judges nothing, every remaining prompt fails
+            states = [None] * len(prompts)
+
+        def evaluate(state):
+            return evaluate_items(state["ind_prompt"], state["keywords"], state["combined_list"][:5], descriptions)
+        evaluated_ids = valid()
+        evaluated = timed("evaluation", lambda: list(executor.map(lambda i: safe(evaluate, states[i]), evaluated_ids)))
+
+    results = [[] for _ in prompts]
+    for i, result_list in zip(evaluated_ids, evaluated):
+        if result_list is not None:
+            results[i] = result_list
+    stats["failed"] = len(prompts) - sum(1 for result_list in evaluated if result_list is not None)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    stats["seconds"] = round(elapsed, 3)
+    stats["prompts_per_second"] = round(len(prompts) / elapsed, 3)
+    stats["stage_seconds"] = {stage: round(seconds, 3) for stage, seconds in timings.items()}
+    logger.info(f"### Batch search {stats}")
+    return {
+            "results": results,
+            "stats": stats,
+            }
+
+
+def agent_rag_page(prompt: str = None, cursor: str = None, page_size: int = PAGE_SIZE, filters: dict = None):
+    """
+    Paginated agent_rag.
+
+    The first call, with a prompt, runs the graph up to the fused candidate list and
+    keeps it with the keywords under a cursor. A call with the returned cursor evaluates
+    the next `page_size` candidates, the candidate list is only deepened, without the
+    keyword LLM, once the page runs past its end.
+
+    Filters, see FilmFilter.from_dict, are given with the prompt and kept with the cursor.
+    Returns {"results": [...], "cursor": cursor of the next page or None on the last page}.
+    A page holds the candidates of its slice the evaluator kept, so it can be shorter than page_size.
+    """
+
+    if cursor is None:
+        if prompt is None:
+            raise ValueError("Either a prompt or a cursor is required")
+        token, offset = uuid.uuid4().hex, 0
+        state = _first_candidates(prompt, filters or {})
+    else:
+        token, offset = _parse_cursor(cursor)
+        state = page_cursors.get_json(token)
+        if state is None or time.time() - state["created"] > PAGE_CURSOR_TTL:
+            raise ValueError(f"Cursor [{cursor}] is unknown or expired, start a new search")
+
+    end = offset + page_size
+    if end > len(state["combined_list"]) and not state["exhausted"]:
+        _deepen(state, end)
+
+    items = state["combined_list"][offset:end]
+    logger.info(f"### Page [{offset}:{end}] of [{len(state['combined_list'])}] candidates")
+    results = evaluate_items(state["ind_prompt"], state["keywords"], [dict(item) for item in items])
+
+    page_cursors.put_json(token, state)
+    has_more = end < len(state["combined_list"]) or not state["exhausted"]
+    return {
+            "results": results,
+            "cursor": f"{token}.{end}" if has_more else None,
+            }
+
+
+def _first_candidates(prompt, filters):
+    inputs = {"ori_prompt": prompt, "mysql_limit": PAGE_MYSQL_LIMIT, "chroma_k": PAGE_CHROMA_K, "filters": filters}
+    config = {"configurable": {"user_id": "anonymous", "thread_id": str(uuid.uuid4())}}
+    response = {}
+    for output in candidate_app.stream(inputs, config, stream_mode="values"):
+        response = output
+
+    return {
+            "prompt": prompt,
+            "ind_prompt": response["ind_prompt"],
+            "keywords": response["keywords"],
+            "combined_list": response["combined_list"],
+            "mysql_limit": PAGE_MYSQL_LIMIT,
+            "chroma_k": PAGE_CHROMA_K,
+            "filters": filters,
+            "exhausted": False,
+            "created": time.time(),
+            }
+
+
+def _deepen(state, needed):
+    """Fetch deeper candidates with the stored keywords until `needed` are known or the legs run dry"""
+
+    while len(state["combined_list"]) < needed and not state["exhausted"]:
+        mysql_limit = min(state["mysql_limit"] * PAGE_DEPTH_FACTOR, PAGE_MAX_DEPTH)
+        chroma_k = min(state["chroma_k"] * PAGE_DEPTH_FACTOR, PAGE_MAX_DEPTH)
+        search_state = {"ind_prompt": state["ind_prompt"], "keywords": state["keywords"]
+                        , "mysql_limit": mysql_limit, "chroma_k": chroma_k, "filters": state["filters"]}
+        search_state.update(mysql_agent(search_state))
+        search_state.update(chroma_agent(search_state))
+        combined_list = reranking_agent(search_state)["combined_list"]
+
+        # Served candidates keep their place, the new ones follow in fused order
+        known = {item["item_id"] for item in state["combined_list"]}
+        new_items = [item for item in combined_list if item["item_id"] not in known]
+        state["combined_list"].extend(new_items)
+        state["exhausted"] = (len(new_items) == 0
+                              or (mysql_limit == state["mysql_limit"] and chroma_k == state["chroma_k"]))
+        state["mysql_limit"], state["chroma_k"] = mysql_limit, chroma_k
+        logger.info(f"### Deepened to MySQL [{mysql_limit}] Chroma [{chroma_k}], [{len(new_items)}] new candidates")
+
+
+def _parse_cursor(cursor):
+    token, _, offset = cursor.partition(".")
+    if not token or not offset.isdigit():
+        raise ValueError(f"Malformed cursor [{cursor}]")
+    return token, int(offset)
@@ -1,25 +1,70 @@
+import asyncio
 import logging
 from film.agents.state import State
-from utils import ew_embedding_util
+from utils import ew_registry_util
 from film.io.film_score import FilmScore
+from film.service import film_vector_service
+from film.io.film_filter import FilmFilter
 
 logger = logging.getLogger(__name__)
-db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
+CHROMA_K = 10
+
+
+def _db():
+    return ew_registry_util.get_chroma_db("chroma_film_indonesia", cache_embeddings=True)
+
 
 def chroma_agent(state: State):
     ind_prompt = state["ind_prompt"]
     keywords =  state["keywords"] + " " + ind_prompt
     
     # Search the DB.
-    k = 10
-    logger.info(f"### Querying vector stores with top [{k}] : {keywords}")
-    results = db.similarity_search_with_score(keywords, k)
+    k = state.get("chroma_k") or CHROMA_K
+    where = FilmFilter.from_dict(state.get("filters")).chroma_where()
+    if film_vector_service.CHUNK_POOLING != "none":
+        logger.info(f"### Querying vector stores for [{k}] films pooled by [{film_vector_service.CHUNK_POOLING}] : {keywords} {where}")
+        films = film_vector_service.search_films(_db(), keywords, k, where)
+        return {
+                "chroma_list": [{"item_id": mysql_id, "score": score} for mysql_id, score in films],
+                }
+
+    logger.info(f"### Querying vector stores with top [{k}] : {keywords} {where}")
+    results = film_vector_service.similarity_search(_db(), keywords, k, where)
+    
+    return {
+            "chroma_list": _chroma_list(results),
+            }
+
+
+async def achroma_agent(state: State):
+    """chroma_agent on a worker thread, chroma and the query embedding only have blocking clients"""
+
+    return await asyncio.to_thread(chroma_agent, state)
+
+
+def chroma_search_many(query_texts, k=CHROMA_K):
+    """chroma_list of many query texts, embedded in one call and sent as one vector query"""
+
+    if film_vector_service.CHUNK_POOLING != "none":
+        results = film_vector_service.similarity_search_many(_db(), query_texts, k * film_vector_service.POOL_OVERSAMPLE)
+        return [[{"item_id": mysql_id, "score": score} for mysql_id, score in film_vector_service.pool_films(query_results, k)]
+                for query_results in results]
+
+    results = film_vector_service.similarity_search_many(_db(), query_texts, k)
+    return [_chroma_list(query_results) for query_results in results]
+
+
+def _chroma_list(results):
+    """
+    Collapse the (mysql_id, cosine distance) chunk hits into one item per film.
+    The score is the cosine similarity, like the pooled search gives, higher is better.
+    """
 
     # Create a list of result
     doc_list = list()
     film_id_set = set()
-    for doc, _score in results:
-        film_score = FilmScore(doc.metadata.get("mysql_id", None), _score)
+    for mysql_id, distance in results:
+        film_score = FilmScore(mysql_id, 1 - distance)
         doc_list.append(film_score)
         film_id_set.add(film_score.film_id)
 
@@ -45,6 +90,4 @@ def chroma_agent(state: State):
         item_obj = {"item_id":item.film_id, "score":item.score}
         chroma_list.append(item_obj)    
     
-    return {
-            "chroma_list": chroma_list,
-            }
\ No newline at end of file
+    return chroma_list
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import json
 from datetime import date, datetime
@@ -7,81 +8,148 @@ from film.agents.state import State
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_ollama import ChatOllama
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
-from utils import ew_mysql_util
-mysql_conn = ew_mysql_util.get_mysql_conn()
+from utils import ew_registry_util
+from film.io.film_statements import FILM_DESCRIPTION
 
 logger = logging.getLogger(__name__)
 
     
 def evaluation_agent(state: State):
     
-    ind_prompt = state["ind_prompt"]
-    user_prompt = ind_prompt + " " + state["keywords"]
-    logger.debug(f"### User prompt: [{user_prompt}]")
     logger.debug(f"### State :\n{state}")
+    result_list = evaluate_items(state["ind_prompt"], state["keywords"], state["combined_list"][:5])
     
-    items = state["combined_list"]
+    return {
+            "result_list": result_list,
+            }
+
+
+def evaluate_items(ind_prompt, keywords, items, descriptions=None):
+    """
+    Keep the items whose description the LLM judges to have the theme of the prompt.
+    Descriptions are read one by one from MySQL unless a dict of item_id to description is given.
+    """
+
+    user_prompt = ind_prompt + " " + keywords
+    logger.debug(f"### User prompt: [{user_prompt}]")
+
     result_list = []
-    for item in items[:5]:
-        logger.debug(f"### Get item description: [{item["item_id"]}]")
-        # llama3.2:3b-instruct-q8_0
-        # llama3.1:8b-instruct-q8_0
-        evaluation_llm = ChatOllama(model="llama3.1:8b-instruct-q8_0", temperature = 0, format="json")
-        agent_prompt = ChatPromptTemplate.from_messages(
-            [
-                (
-                    "system",
-                    """
-                    I am running a movie database service in Indonesian language where user can search movie based on prompt they entered.
-                    You will be a evaluator assistant whose job is to asses if the description matches the theme mentioned in the prompt.
-                    
-                    Score:
-                    A score of yes means that the item has the theme specified in the prompt. 
-                    Explain your reasoning in a step-by-step manner to ensure your reasoning and conclusion are correct.
-                    Current time: {time}.
-                    """
-                ),
-                (            
-                    "human", 
-                    """
-                    Given the prompt: {user_prompt} and the item description: {description} assess if the description has the theme in the prompt.
-                    Return JSON with two two keys, 
-                    binary_score is 'yes' or 'no' score to indicate that the description has the theme mentioned in the prompt. 
-                    And a key, explanation, that contains an explanation of the score in Indonesian language.                
-                    """
-                )
-            ]
-        )    
-        item_description = get_description(item["item_id"])    
-        agent_prompt = agent_prompt.partial(time=datetime.now())
-        agent_prompt = agent_prompt.partial(user_prompt=user_prompt)
-        agent_prompt = agent_prompt.partial(description=item_description)
-        evaluation_llm = agent_prompt | evaluation_llm
-        result = evaluation_llm.invoke(state)
-        logger.info(f"##### Evaluation agent result: \n[{result.content}] \nDescription: {item_description}")
-        ai_response = json.loads(result.content)["binary_score"]
-        explanation = json.loads(result.content)["explanation"]
-        if "yes" == ai_response:
-            item["description"] = item_description
-            item["explanation"] = explanation
+    for item in items:
+        logger.debug(f"### Get item description: [{item['item_id']}]")
+        if descriptions is None:
+            item_description = get_description(item["item_id"])    
+        else:
+            item_description = descriptions.get(item["item_id"], "")
+        result = _evaluation_chain(user_prompt, item_description).invoke({})
+        if _is_relevant(item, item_description, result):
             result_list.append(item)
     
+    return result_list
+
+
+async def aevaluation_agent(state: State):
+    """evaluation_agent with the items judged concurrently"""
+
+    logger.debug(f"### State :\n{state}")
+    result_list = await aevaluate_items(state["ind_prompt"], state["keywords"], state["combined_list"][:5])
+
     return {
             "result_list": result_list,
             }
 
 
+async def aevaluate_items(ind_prompt, keywords, items, descriptions=None):
+    """
+    evaluate_items awaiting the LLM, every item is judged at the same time and the order of items is kept.
+    Missing descriptions are read with one query on a worker thread.
+    """
+
+    user_prompt = ind_prompt + " " + keywords
+    logger.debug(f"### User prompt: [{user_prompt}]")
+    if descriptions is None:
+        descriptions = await asyncio.to_thread(get_descriptions, [item["item_id"] for item in items])
+
+    item_descriptions = [descriptions.get(item["item_id"], "") for item in items]
+    results = await asyncio.gather(*[_evaluation_chain(user_prompt, item_description).ainvoke({})
+                                     for item_description in item_descriptions])
+
+    return [item for item, item_description, result in zip(items, item_descriptions, results)
+            if _is_relevant(item, item_description, result)]
+
+
+def _evaluation_chain(user_prompt, item_description):
+    # llama3.2:3b-instruct-q8_0
+    # llama3.1:8b-instruct-q8_0
+    evaluation_llm = ChatOllama(model="llama3.1:8b-instruct-q8_0", temperature = 0, format="json")
+    agent_prompt = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                """
+                I am running a movie database service in Indonesian language where user can search movie based on prompt they entered.
+                You will be a evaluator assistant whose job is to asses if the description matches the theme mentioned in the prompt.
+                
+                Score:
+                A score of yes means that the item has the theme specified in the prompt. 
+                Explain your reasoning in a step-by-step manner to ensure your reasoning and conclusion are correct.
+                Current time: {time}.
+                """
+            ),
+            (            
+                "human", 
+                """
+                Given the prompt: {user_prompt} and the item description: {description} assess if the description has the theme in the prompt.
+                Return JSON with two two keys, 
+                binary_score is 'yes' or 'no' score to indicate that the description has the theme mentioned in the prompt. 
+                And a key, explanation, that contains an explanation of the score in Indonesian language.                
+                """
+            )
+        ]
+    )    
+    agent_prompt = agent_prompt.partial(time=datetime.now())
+    agent_prompt = agent_prompt.partial(user_prompt=user_prompt)
+    agent_prompt = agent_prompt.partial(description=item_description)
+    return agent_prompt | evaluation_llm
+
+
+def _is_relevant(item, item_description, result):
+    """Whether the LLM judged the item relevant, a relevant item gets its description and the explanation"""
+
+    logger.info(f"##### Evaluation agent result: \n[{result.content}] \nDescription: {item_description}")
+    ai_response = json.loads(result.content)["binary_score"]
+    explanation = json.loads(result.content)["explanation"]
+    if "yes" == ai_response:
+        item["description"] = item_description
+        item["explanation"] = explanation
+        return True
+    return False
+
+
 def get_description(item_id):
     """Add additional context to a keywords to enhance result"""
 
     # Get additional data from MySQL
-    cursor = mysql_conn.cursor(dictionary=True)
-    qry = f"SELECT film_id, title, description FROM film_indonesia WHERE film_id IN ({item_id})"
-    cursor.execute(qry)    
-    resultset = cursor.fetchall()
+    resultset = ew_registry_util.get_mysql_pool().execute(FILM_DESCRIPTION, (item_id,))
     description = ""
     for rs in resultset:
         description = rs["title"] + ". " + rs["description"]
-    cursor.close()
 
     return description
+
+
+def get_descriptions(item_ids):
+    """Descriptions of many items with one query, as a dict of item_id to description"""
+
+    item_ids = list(dict.fromkeys(item_ids))
+    if not item_ids:
+        return dict()
+
+    placeholders = ", ".join(["%s"] * len(item_ids))
+    qry = f"SELECT film_id, title, description FROM film_indonesia WHERE film_id IN ({placeholders})"
+    with ew_registry_util.get_mysql_pool().connection() as mysql_conn:
+        cursor = mysql_conn.cursor(dictionary=True)
+        cursor.execute(qry, item_ids)
+        descriptions = {rs["film_id"]: rs["title"] + ". " + rs["description"] for rs in cursor.fetchall()}
+        cursor.close()
+
+    return descriptions
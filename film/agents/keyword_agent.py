@@ -1,8 +1,10 @@
+import asyncio
 import logging
 import json
 from datetime import date, datetime
 
 from film.agents.state import State
+from film.service import film_keyword_cache
 
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_ollama import ChatOllama
@@ -10,11 +12,53 @@ from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
 
 logger = logging.getLogger(__name__)
 
+# llama3.2:3b-instruct-q8_0
+# llama3.1:8b-instruct-q8_0
+KEYWORD_MODEL = "llama3.1:8b-instruct-q8_0"
+# Keeps the cached keywords of this prompt apart from those of other prompts
+PROMPT_TEMPLATE_NAME = "keyword_agent"
+# Bump whenever the prompt below changes, cached keywords of the old prompt are then ignored
+PROMPT_TEMPLATE_VERSION = 2
+# Temperature 0 and no current time in the prompt make the answer a function of the prompt, so it can be cached.
+# Off, the keywords are sampled at temperature 0.5 and never cached
+DETERMINISTIC = True
+
     
 def keyword_agent(state: State):
-    # llama3.2:3b-instruct-q8_0
-    # llama3.1:8b-instruct-q8_0
-    prompt_llm = ChatOllama(model="llama3.1:8b-instruct-q8_0", temperature = 0.5, format="json")
+    ori_prompt = state["ori_prompt"]
+    cached = _cached_state(ori_prompt)
+    if cached is not None:
+        return cached
+
+    result = _keyword_chain(ori_prompt).invoke(state)
+    return _result_state(ori_prompt, result)
+
+
+async def akeyword_agent(state: State):
+    """keyword_agent awaiting the LLM, the keyword cache is read and written off the event loop"""
+
+    ori_prompt = state["ori_prompt"]
+    cached = await asyncio.to_thread(_cached_state, ori_prompt)
+    if cached is not None:
+        return cached
+
+    result = await _keyword_chain(ori_prompt).ainvoke(state)
+    return await asyncio.to_thread(_result_state, ori_prompt, result)
+
+
+def _cached_state(ori_prompt):
+    if not DETERMINISTIC:
+        return None
+    cached = film_keyword_cache.get_keywords(PROMPT_TEMPLATE_NAME, KEYWORD_MODEL, PROMPT_TEMPLATE_VERSION, ori_prompt)
+    if cached is None:
+        return None
+    logger.info(f"\n### Cached keywords: [{cached['keywords']}] \n### Translation: [{cached['translation']}]")
+    return _keyword_state(ori_prompt, cached["translation"], cached["keywords"])
+
+
+def _keyword_chain(ori_prompt):
+    temperature = 0 if DETERMINISTIC else 0.5
+    prompt_llm = ChatOllama(model=KEYWORD_MODEL, temperature = temperature, format="json")
     agent_prompt = ChatPromptTemplate.from_messages(
         [
             (
@@ -31,9 +75,9 @@ def keyword_agent(state: State):
                 - The keywords should not contains 'movie' or 'film'.
                 - Make sure all keywords are in Indonesian language.            
                 - Return in plain text like for example: cantik, penyanyi, musik, pertunjukan
-                
+                """ + ("" if DETERMINISTIC else """
                 Current time: {time}.
-                """
+                """)
             ),
             (            
                 "human", 
@@ -46,16 +90,25 @@ def keyword_agent(state: State):
             )
         ]
     )    
-    ori_prompt = state["ori_prompt"]
     logger.debug(f"### User prompt: [{ori_prompt}]")
-    agent_prompt = agent_prompt.partial(time=datetime.now())    
+    if not DETERMINISTIC:
+        # The cached answer must only depend on the prompt, the time is left out of it
+        agent_prompt = agent_prompt.partial(time=datetime.now())
     agent_prompt = agent_prompt.partial(ori_prompt=ori_prompt)
-    prompt_llm = agent_prompt | prompt_llm
-    result = prompt_llm.invoke(state)
+    return agent_prompt | prompt_llm
+
+
+def _result_state(ori_prompt, result):
     logger.debug(f"##### Prompt agent result: [{result.content}]")
     keywords = json.loads(result.content)["keywords"]
     translation = json.loads(result.content)["translation"]
     logger.info(f"\n### Keywords: [{keywords}] \n### Translation: [{translation}]")
+    if DETERMINISTIC:
+        film_keyword_cache.put_keywords(PROMPT_TEMPLATE_NAME, KEYWORD_MODEL, PROMPT_TEMPLATE_VERSION, ori_prompt, keywords, translation)
+    return _keyword_state(ori_prompt, translation, keywords)
+
+
+def _keyword_state(ori_prompt, translation, keywords):
     return {
             "ori_prompt": ori_prompt, 
             "ind_prompt": translation, 
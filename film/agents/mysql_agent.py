@@ -1,29 +1,96 @@
+import asyncio
 import logging
 
 from film.agents.state import State
-from utils import ew_mysql_util
+from utils import ew_registry_util
+from film.service import film_lexical_service
+from film.service import film_attribute_service
+from film.io.film_filter import FilmFilter
+from film.io.film_statements import FULLTEXT_SEARCH
 
 logger = logging.getLogger(__name__)
-mysql_conn = ew_mysql_util.get_mysql_conn()
+MYSQL_LIMIT = 5
+# Prompts sent in one UNION ALL statement by mysql_search_many
+MYSQL_BATCH_QUERIES = 50
 
 def mysql_agent(state: State):
     ind_prompt = state["ind_prompt"]
     keywords =  state["keywords"] + " " + ind_prompt
+    limit = state.get("mysql_limit") or MYSQL_LIMIT
+    film_filter = FilmFilter.from_dict(state.get("filters"))
+
+    if film_lexical_service.LEXICAL_BACKEND == "bm25":
+        logger.info(f"### BM25 query using keywords : {keywords} {film_filter}")
+        allowed_ids = None if film_filter.is_empty() else film_attribute_service.get_film_ids(film_filter)
+        return {
+                "mysql_list": film_lexical_service.search(keywords, limit, allowed_ids),
+                }
     
-    cursor = mysql_conn.cursor(dictionary=True)
-    qry = f"""
-            SELECT
-                film_id
-                , MATCH(title, description) AGAINST(%s) AS score
-            FROM film_indonesia
-            WHERE MATCH(title, description) AGAINST(%s)
-            LIMIT 5
-            """
-    logger.info(f"### MySQL Natural language query using keywords : {keywords}")
-
-    cursor.execute(qry, (keywords, keywords))    
-    resultset = cursor.fetchall()
-    
+    logger.info(f"### MySQL Natural language query using keywords : {keywords} {film_filter}")
+    predicate, params = film_filter.sql_predicate("film_id")
+    if predicate is None:
+        resultset = ew_registry_util.get_mysql_pool().execute(FULLTEXT_SEARCH, (keywords, keywords, limit))
+    else:
+        qry = f"""
+                SELECT
+                    film_id
+                    , MATCH(title, description) AGAINST(%s) AS score
+                FROM film_indonesia
+                WHERE MATCH(title, description) AGAINST(%s)
+                AND {predicate}
+                LIMIT %s
+                """
+        with ew_registry_util.get_mysql_pool().connection() as mysql_conn:
+            cursor = mysql_conn.cursor(dictionary=True)
+            cursor.execute(qry, (keywords, keywords, *params, limit))
+            resultset = cursor.fetchall()
+            cursor.close()
+
+    return {
+            "mysql_list": _mysql_list(resultset),
+            }
+
+
+async def amysql_agent(state: State):
+    """mysql_agent on a worker thread, the pooled connection it borrows keeps the event loop free"""
+
+    return await asyncio.to_thread(mysql_agent, state)
+
+
+def mysql_search_many(query_texts, limit=MYSQL_LIMIT):
+    """mysql_list of many query texts, sent as UNION ALL statements of MYSQL_BATCH_QUERIES queries"""
+
+    if film_lexical_service.LEXICAL_BACKEND == "bm25":
+        return [film_lexical_service.search(query_text, limit) for query_text in query_texts]
+
+    resultsets = [[] for _ in query_texts]
+    with ew_registry_util.get_mysql_pool().connection() as mysql_conn:
+        cursor = mysql_conn.cursor(dictionary=True)
+        for start in range(0, len(query_texts), MYSQL_BATCH_QUERIES):
+            part = query_texts[start:start + MYSQL_BATCH_QUERIES]
+            qry = " UNION ALL ".join("""
+                (SELECT
+                    %s AS query_index
+                    , film_id
+                    , MATCH(title, description) AGAINST(%s) AS score
+                FROM film_indonesia
+                WHERE MATCH(title, description) AGAINST(%s)
+                LIMIT %s)
+                """ for _ in part)
+            params = list()
+            for i, query_text in enumerate(part):
+                params.extend((start + i, query_text, query_text, limit))
+            logger.info(f"### MySQL Natural language query for [{len(part)}] prompts")
+
+            cursor.execute(qry, params)
+            for rs in cursor.fetchall():
+                resultsets[rs["query_index"]].append(rs)
+        cursor.close()
+
+    return [_mysql_list(resultset) for resultset in resultsets]
+
+
+def _mysql_list(resultset):
     # Normalize score
     max_mysql_score = max(rs["score"] for rs in resultset) if resultset else 0
     logger.debug(f"### Max mysql score: [{max_mysql_score}]")
@@ -32,8 +99,5 @@ def mysql_agent(state: State):
     for rs in resultset:
         item_obj = {"item_id":rs["film_id"], "score":rs["score"] / max_mysql_score}
         film_list.append(item_obj)
-    cursor.close()
 
-    return {
-            "mysql_list": film_list,
-            }
+    return film_list
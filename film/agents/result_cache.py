@@ -0,0 +1,129 @@
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import ew_cache_util
+from utils import ew_embedding_util
+
+logger = logging.getLogger(__name__)
+
+# Fields of a result dropped on a semantic hit, the LLM wrote them for another prompt
+PROMPT_BOUND_KEYS = ("explanation",)
+
+
+class ResultCache:
+    """
+    In-process cache of agent_rag results in front of the graph.
+
+    1. Exact lookup on the normalised prompt
+    2. Semantic lookup, the nearest earlier prompt by cosine similarity of the
+       prompt embeddings, when it is above `threshold`. Its result is given back
+       without the explanations the LLM wrote for the other prompt
+
+    Entries expire after `ttl` seconds, the least recently used entries are evicted
+    above `max_size`, and the whole cache is dropped when the generation of the
+    film collection changes, which the insert, update and delete paths bump.
+    """
+
+    def __init__(self, generation_name, ttl=3600, max_size=1024, threshold=0.98):
+        self.generation_name = generation_name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.threshold = threshold
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = ew_cache_util.read_generation(generation_name)
+        self._keys = []
+        self._matrix = None
+
+    def lookup(self, prompt: str):
+        """Return a copy of the cached result for the prompt, None on a miss"""
+
+        self._check_generation()
+        key = _normalize(prompt)
+        now = time.time()
+
+        with self.lock:
+            self._expire(now)
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                logger.info(f"### Result cache exact hit [{prompt}]")
+                return copy.deepcopy(entry["result"])
+
+        try:
+            vector = _embed(prompt)
+        except Exception as e:
+            logger.error(f"Result cache embedding Error: {e}")
+            return None
+
+        with self.lock:
+            matrix, keys = self._get_matrix()
+            if matrix is None:
+                return None
+
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+
+            entry = self.entries[keys[best]]
+            self.entries.move_to_end(keys[best])
+            logger.info(f"### Result cache semantic hit [{prompt}] ~ [{entry['prompt']}] similarity [{similarities[best]:.3f}]")
+            return [{key: value for key, value in item.items() if key not in PROMPT_BOUND_KEYS} for item in entry["result"]]
+
+    def store(self, prompt: str, result):
+        try:
+            vector = _embed(prompt)
+        except Exception as e:
+            logger.error(f"Result cache embedding Error: {e}")
+            vector = None
+
+        with self.lock:
+            key = _normalize(prompt)
+            self.entries[key] = {"prompt": prompt, "vector": vector, "result": copy.deepcopy(result), "created": time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self._matrix = None
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self._matrix = None
+
+    def _check_generation(self):
+        generation = ew_cache_util.read_generation(self.generation_name)
+        if generation != self.generation:
+            logger.info("### Films changed, result cache invalidated")
+            self.invalidate()
+            self.generation = generation
+
+    def _expire(self, now):
+        expired = [key for key, entry in self.entries.items() if now - entry["created"] > self.ttl]
+        for key in expired:
+            del self.entries[key]
+        if expired:
+            self._matrix = None
+
+    def _get_matrix(self):
+        # Rebuilt only after the entries changed
+        if self._matrix is None:
+            self._keys = [key for key, entry in self.entries.items() if entry["vector"] is not None]
+            if self._keys:
+                self._matrix = np.stack([self.entries[key]["vector"] for key in self._keys])
+        return self._matrix, self._keys
+
+
+def _normalize(prompt: str):
+    return ew_cache_util.normalize_text(prompt).lower()
+
+
+def _embed(prompt: str):
+    vector = np.asarray(ew_embedding_util.get_query_embedding_cache().embed_query(_normalize(prompt)), dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
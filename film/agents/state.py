@@ -1,6 +1,6 @@
 from typing import Annotated
 
-from typing_extensions import TypedDict
+from typing_extensions import NotRequired, TypedDict
 
 from langgraph.graph.message import AnyMessage, add_messages
 from film.io.film_score import FilmScore
@@ -17,6 +17,9 @@ class State(TypedDict):
         chroma_list: List of item from Chroma vector search
         combined_list: Combined list ordered by their relevance
         result_list: Final list presented to the user
+        mysql_limit: Candidates taken from MySQL, 5 when not set
+        chroma_k: Chunks taken from Chroma, 10 when not set
+        filters: FilmFilter.to_dict() of the attributes both legs are restricted to
     """
     
     ori_prompt: str
@@ -25,4 +28,7 @@ class State(TypedDict):
     mysql_list: list[any]
     chroma_list: list[any]
     combined_list: list[any]        
-    result_list: list[any]        
\ No newline at end of file
+    result_list: list[any]        
+    mysql_limit: NotRequired[int]
+    chroma_k: NotRequired[int]
+    filters: NotRequired[dict]
\ No newline at end of file
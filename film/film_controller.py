@@ -1,19 +1,18 @@
 import argparse
+import json
 import logging
+import os
+import sys
+import time
 
-from film.service import film_list_service
-from film.service import film_get_service
-from film.service import film_insert_service
-from film.service import film_update_service
-from film.service import film_delete_service
-from film.service import film_search_service
-from film.service import film_rag_service
-from film.agents.app import agent_rag
 
 # Global variable start
 logger = logging.getLogger(__name__)
 # Global variable ends
 
+# Services, chroma, MySQL and the agent graph are imported by the operations that use them,
+# a trivial operation does not pay for loading the whole stack
+
 # Private functions start
 def _validate_list(values):
     """Validate each value in the list."""
@@ -33,6 +32,126 @@ def _validate_list(values):
             logger.error(f"Value '{value}' is not a valid integer.")
     
     return validated_values
+
+
+def _read_jsonl(path):
+    """Yield (line number, record) for every non empty line, '-' reads stdin."""
+
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error(f"Line [{line_number}] is not valid JSON: {e}")
+                yield line_number, None
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _validate_record(record, with_payload):
+    """Return (id, payload) of a bulk record, or None when it is invalid."""
+
+    if not isinstance(record, dict) or "id" not in record:
+        return None
+    validated = _validate_list([record["id"]])
+    if len(validated) < 1:
+        return None
+    if with_payload:
+        if not isinstance(record.get("payload"), str):
+            return None
+        return validated[0], record["payload"]
+    return validated[0], None
+
+
+def _run_bulk(operation, path, batch_size):
+    """Stream a JSONL file of records and apply the operation one batch at a time."""
+
+    def flush(batch):
+        if operation == "bulk-insert":
+            from film.service import film_insert_service
+            done, failed = film_insert_service.insert_items(batch)
+        elif operation == "bulk-update":
+            from film.service import film_update_service
+            done, failed = film_update_service.update_items(batch)
+        else:
+            from film.service import film_delete_service
+            done, failed = film_delete_service.delete_items([id for id, _ in batch])
+        summary["ok"] += len(done)
+        summary["failed_ids"].extend(failed)
+
+    start = time.perf_counter()
+    summary = {"records": 0, "ok": 0, "failed_ids": [], "invalid_lines": []}
+    batch = []
+    for line_number, record in _read_jsonl(path):
+        summary["records"] += 1
+        item = _validate_record(record, operation != "bulk-delete")
+        if item is None:
+            summary["invalid_lines"].append(line_number)
+            continue
+
+        batch.append(item)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"{operation}: [{summary['records']}] records in [{elapsed:.1f}]s ([{summary['records'] / elapsed:.1f}] records/s), "
+          f"ok [{summary['ok']}], failed ids {summary['failed_ids']}, invalid lines {summary['invalid_lines']}")
+    return summary
+
+
+def _parse_filters(parser, value):
+    """Parse the --filters JSON object, None when not given."""
+
+    if value is None:
+        return None
+    try:
+        filters = json.loads(value)
+    except json.JSONDecodeError as e:
+        parser.error(f"--filters is not valid JSON: {e}")
+    if not isinstance(filters, dict):
+        parser.error("--filters must be a JSON object")
+    return filters
+
+
+def _run_batch_search(path, batch_size, concurrency):
+    """Search every prompt of a JSONL file, one JSON line of results per prompt is printed."""
+
+    from film.agents.app import agent_rag_batch
+
+    def flush(batch):
+        response = agent_rag_batch(batch, concurrency)
+        for prompt, results in zip(batch, response["results"]):
+            print(json.dumps({"prompt": prompt, "results": results}, ensure_ascii=False, default=str))
+        summary["failed"] += response["stats"]["failed"]
+
+    start = time.perf_counter()
+    summary = {"prompts": 0, "failed": 0, "invalid_lines": []}
+    batch = []
+    for line_number, record in _read_jsonl(path):
+        if not isinstance(record, dict) or not isinstance(record.get("prompt"), str):
+            summary["invalid_lines"].append(line_number)
+            continue
+
+        summary["prompts"] += 1
+        batch.append(record["prompt"])
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    logger.info(f"batch-search: [{summary['prompts']}] prompts in [{elapsed:.1f}]s ([{summary['prompts'] / elapsed:.2f}] prompts/s), "
+                f"failed [{summary['failed']}], invalid lines {summary['invalid_lines']}")
+    return summary
 # Private functions end
 
 def main():
@@ -40,11 +159,18 @@ def main():
     parser = argparse.ArgumentParser(description="Manage a vector db with CRUD operations")
 
     # Define command-line arguments
-    parser.add_argument("--operation", choices=["list", "get", "update", "delete", "insert", "search"], required=True, help="Operation to perform")
+    parser.add_argument("--operation", choices=["list", "get", "update", "delete", "insert", "search", "search-page", "batch-search", "similar", "bulk-insert", "bulk-update", "bulk-delete"], required=True, help="Operation to perform")
     parser.add_argument("--ids", type=str, help="List of comma separated id's to list, only necessary for 'list' operation")
     parser.add_argument("--id", type=str, help="ID or index for the operation")
     parser.add_argument("--payload", type=str, help="Payload for the operation")
     parser.add_argument("--prompt", type=str, help="Prompt for search operation")
+    parser.add_argument("--file", type=str, help="JSONL file of {\"id\", \"payload\"} records for bulk operations, of {\"prompt\"} records for 'batch-search', '-' reads stdin")
+    parser.add_argument("--batch-size", type=int, default=100, help="Records sent to the vector db per call for bulk operations, prompts per call for 'batch-search'")
+    parser.add_argument("--filters", type=str, help="JSON film filter for search operations, e.g. '{\"year_from\": 2005, \"rating\": [\"G\", \"PG\"], \"category\": \"Horror\"}'")
+    parser.add_argument("--limit", type=int, default=10, help="Number of films returned by 'similar' operation")
+    parser.add_argument("--concurrency", type=int, default=4, help="Prompts whose LLM calls run at the same time for 'batch-search'")
+    parser.add_argument("--cursor", type=str, help="Cursor returned by a previous 'search-page' call, fetches the next page")
+    parser.add_argument("--page-size", type=int, default=5, help="Candidates evaluated per page for 'search-page' operation")
 
     # Parse arguments
     args = parser.parse_args()
@@ -56,6 +182,7 @@ def main():
             values = [value.strip() for value in args.ids.split(",")]
             # Validate the list
             validated_values = _validate_list(values)
+            from film.service import film_list_service
             film_list_service.list_items(validated_values)
         else:
             parser.error("The 'list' operation requires an --ids argument")
@@ -63,29 +190,65 @@ def main():
     elif args.operation == "get":
         if args.id is None:
             parser.error("The 'get' operation requires an --id argument")
+        from film.service import film_get_service
         film_get_service.get_item(args.id)
 
     elif args.operation == "update":
         if args.id is None or args.payload is None:
             parser.error("The 'update' operation requires both --id and --payload arguments")
+        from film.service import film_update_service
         film_update_service.update_item(args.id, args.payload)
 
     elif args.operation == "delete":
         if args.id is None:
             parser.error("The 'delete' operation requires an --id argument")
+        from film.service import film_delete_service
         film_delete_service.delete_item(args.id)
 
     elif args.operation == "insert":
         if args.id is None or args.payload is None:
             parser.error("The 'insert' operation requires both --id and --payload arguments")
+        from film.service import film_insert_service
         film_insert_service.insert_item(args.id, args.payload)
 
     elif args.operation == "search":
         if args.prompt is None:
             parser.error("The 'search' operation requires --prompt arguments")
 
-        result = agent_rag(args.prompt)
+        from film.agents.app import agent_rag
+        result = agent_rag(args.prompt, _parse_filters(parser, args.filters))
         logger.info(f"Found [{len(result)}] results {result}")
+
+    elif args.operation == "search-page":
+        if args.prompt is None and args.cursor is None:
+            parser.error("The 'search-page' operation requires a --prompt or a --cursor argument")
+
+        from film.agents.app import agent_rag_page
+        page = agent_rag_page(args.prompt, args.cursor, args.page_size, _parse_filters(parser, args.filters))
+        logger.info(f"Found [{len(page['results'])}] results {page['results']}")
+        print(f"Next cursor: {page['cursor']}")
+
+    elif args.operation == "similar":
+        if args.id is None:
+            parser.error("The 'similar' operation requires an --id argument")
+
+        from film.service import film_similar_service
+        result = film_similar_service.get_similar(args.id, args.limit)
+        logger.info(f"Found [{len(result)}] similar films {result}")
+
+    elif args.operation == "batch-search":
+        if args.file is None:
+            parser.error("The 'batch-search' operation requires a --file argument")
+        if args.file != "-" and not os.path.isfile(args.file):
+            parser.error(f"--file [{args.file}] does not exist")
+        _run_batch_search(args.file, args.batch_size, args.concurrency)
+
+    elif args.operation in ("bulk-insert", "bulk-update", "bulk-delete"):
+        if args.file is None:
+            parser.error(f"The '{args.operation}' operation requires a --file argument")
+        if args.file != "-" and not os.path.isfile(args.file):
+            parser.error(f"--file [{args.file}] does not exist")
+        _run_bulk(args.operation, args.file, args.batch_size)
             
 
 if __name__ == "__main__":
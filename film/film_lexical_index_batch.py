@@ -0,0 +1,44 @@
+import argparse
+import logging
+import time
+
+from film.service import film_lexical_service
+
+
+# Global variable start
+logger = logging.getLogger(__name__)
+# Global variable ends
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the in-process BM25 index of film_indonesia")
+    parser.add_argument("--build", action="store_true", help="Build a new index from a snapshot of film_indonesia")
+    parser.add_argument("--merge", action="store_true", help="Fold the inserts, updates and deletes made since the build into the index arrays")
+    args = parser.parse_args()
+
+    if not (args.build or args.merge):
+        parser.error("One of --build or --merge is required")
+    if args.build:
+        build_index()
+    if args.merge:
+        merge_index()
+
+
+def build_index():
+    """Build the index, queries then use it when FILM_LEXICAL_BACKEND=bm25"""
+
+    start = time.perf_counter()
+    index = film_lexical_service.build_index()
+    logger.info(f"Indexed [{len(index.doc_ids)}] films with [{len(index.terms)}] terms "
+                f"to [{film_lexical_service.LEXICAL_INDEX_PATH}] in [{time.perf_counter() - start:.1f}]s")
+
+
+def merge_index():
+    index = film_lexical_service.merge_index()
+    if index is None:
+        logger.error(f"No lexical index built at [{film_lexical_service.LEXICAL_INDEX_PATH}]")
+        return
+
+    logger.info(f"Merged index has [{len(index.doc_ids)}] films")
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,290 @@
+import argparse
+import json
 import logging
-
-from langchain.schema.document import Document
+import os
+import time
+from collections import deque
 
 from utils import ew_embedding_util
-from utils import ew_mysql_util
+from utils import ew_registry_util
+from utils import ew_cache_util
+from utils.ew_embedding_pool_util import EmbeddingWorkerPool, take_batch
+from film.io.film_document import build_payload, build_document
+from film.io.film_filter import FILM_ROWS_QUERY, row_attributes
+from film.io.film_statements import FILM_ROWS_AFTER, FILM_ROWS_PAGE
+from film.service import film_vector_service
+from film.service import film_lexical_service
+from film.service import film_similar_service
 
 
 # Global variable start
-db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
-mysql_conn = ew_mysql_util.get_mysql_conn()
 logger = logging.getLogger(__name__)
+
+FETCH_SIZE = 500
+BATCH_SIZE = 256
+CHECKPOINT_PATH = "checkpoint/film_load_data_batch.json"
+# Films of film_indonesia loaded into chroma
+MAX_FILM_ID = 10000
 # Global variable ends
 
-def main():    
-    # Load into chroma one by one
-    load_documents()
+
+def _db():
+    return ew_registry_util.get_chroma_db("chroma_film_indonesia", cache_embeddings=True)
+
+
+class LoadCheckpoint:
+    """
+    Durable progress of a batch load.
+
+    last_film_id only moves past a film once every chunk of that film and of all
+    the films before it has been written, batches may complete out of order.
+    Films with a chunk that failed to embed or write are kept in failed_ids, a film
+    retried from failed_ids only leaves it once all of its chunks were written.
+    """
+
+    def __init__(self, path, last_film_id=0, failed_ids=None):
+        self.path = path
+        self.last_film_id = last_film_id
+        self.failed_ids = set(failed_ids or [])
+
+        self._read_ids = deque()
+        self._pending_chunks = dict()
+        self._failed_in_run = set()
+
+    @classmethod
+    def load(cls, path):
+        """The saved progress, a missing checkpoint raises FileNotFoundError"""
+
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(path, data["last_film_id"], data["failed_ids"])
+
+    def start(self, film_id, chunk_count):
+        """Register a film whose chunks are about to be queued"""
+
+        self._read_ids.append(film_id)
+        self._pending_chunks[film_id] = chunk_count
+        self._advance()
+
+    def commit(self, chunks, success):
+        """Account for a batch of chunks that was written or failed, then save"""
+
+        for chunk in chunks:
+            film_id = chunk.metadata["mysql_id"]
+            self._pending_chunks[film_id] -= 1
+            if not success:
+                self.failed_ids.add(film_id)
+                self._failed_in_run.add(film_id)
+        self._advance()
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file and swap, a crash never leaves a half written checkpoint
+        data = {"last_film_id": self.last_film_id, "failed_ids": sorted(self.failed_ids)}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _advance(self):
+        while self._read_ids and self._pending_chunks[self._read_ids[0]] == 0:
+            film_id = self._read_ids.popleft()
+            del self._pending_chunks[film_id]
+            # Every chunk of the film is written now, a retried film is loaded unless one of them failed
+            if film_id in self._failed_in_run:
+                self._failed_in_run.discard(film_id)
+            else:
+                self.failed_ids.discard(film_id)
+            self.last_film_id = max(self.last_film_id, film_id)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load film_indonesia into the vector db")
+    parser.add_argument("--batch", action="store_true", help="Stream rows and embed chunks of many films per call")
+    parser.add_argument("--fetch-size", type=int, default=FETCH_SIZE, help="Rows fetched from MySQL per page, only used with --batch")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Chunks embedded and written per call, only used with --batch")
+    parser.add_argument("--workers", type=int, default=0, help="Embedding requests kept in flight, batch size becomes adaptive up to --batch-size")
+    parser.add_argument("--checkpoint", type=str, default=CHECKPOINT_PATH, help="File keeping the progress of a batch load")
+    parser.add_argument("--resume", action="store_true", help="Continue a batch load from its checkpoint and retry the failed ids")
+    args = parser.parse_args()
+
+    # Resuming without a checkpoint would drop every film after id 0
+    if args.resume and not os.path.exists(args.checkpoint):
+        parser.error(f"--resume needs a checkpoint, none found at [{args.checkpoint}]")
+
+    if args.batch or args.resume:
+        load_documents_batch(args.fetch_size, args.batch_size, args.workers, args.checkpoint, args.resume)
+    else:
+        # Load into chroma one by one
+        load_documents()
 
 
 def load_documents():
     """Read sql database and one by one insert into chroma"""
-    cursor = mysql_conn.cursor()
-    cursor.execute("SELECT film_id, title, description FROM film_indonesia WHERE film_id <= 10000")
-    
-    for film_id, title, description in cursor.fetchall():
-        str = f"Id: {film_id}\nTitle: {title}\nDescription: {description}\n"
-        insert_item(film_id, str)
 
-    cursor.close()
-    mysql_conn.close()
+    # Rows are all read first, a result left open across the embedding calls would hit net_write_timeout
+    rows = ew_registry_util.get_mysql_pool().execute(FILM_ROWS_AFTER, (0, MAX_FILM_ID), dictionary=False)
+    for film_id, title, description, *attributes in rows:
+        str = build_payload(film_id, title, description)
+        insert_item(film_id, str, row_attributes(*attributes))
+    ew_cache_util.bump_generation("chroma_film_indonesia")
+    ew_registry_util.close_mysql_pool()
+
+
+def load_documents_batch(fetch_size=FETCH_SIZE, batch_size=BATCH_SIZE, workers=0, checkpoint_path=CHECKPOINT_PATH, resume=False):
+    """Stream sql database page by page and insert chunks of many films per chroma call"""
 
+    if resume:
+        checkpoint = LoadCheckpoint.load(checkpoint_path)
+        logger.info(f"Resuming after film [{checkpoint.last_film_id}], retrying failed ids {sorted(checkpoint.failed_ids)}")
+        # Chunks written after the checkpoint by the interrupted run would be loaded twice
+        # Films above MAX_FILM_ID were added through the controller, the scan never reloads them
+        drop_films({"$and": [{"mysql_id": {"$gt": checkpoint.last_film_id}}, {"mysql_id": {"$lte": MAX_FILM_ID}}]})
+    else:
+        checkpoint = LoadCheckpoint(checkpoint_path)
 
-def insert_item(id, payload):
+    embedding_function = ew_registry_util.get_embedding_function(cache=True)
+    progress = {"rows": 0, "chunks": 0, "start": time.perf_counter()}
+    chunks = _iter_chunks(_iter_rows(fetch_size, checkpoint), progress, checkpoint)
+
+    if workers > 0:
+        # Several embedding requests in flight, batch size adapts to observed latency
+        with EmbeddingWorkerPool(embedding_function, max_workers=workers, max_batch_size=batch_size) as pool:
+            for batch, embeddings in pool.embed_stream(chunks):
+                written = write_chunks(batch, embeddings)
+                progress["chunks"] += written
+                checkpoint.commit(batch, written == len(batch))
+    else:
+        batch = take_batch(chunks, batch_size)
+        while batch:
+            written = insert_chunks(batch, embedding_function)
+            progress["chunks"] += written
+            checkpoint.commit(batch, written == len(batch))
+            batch = take_batch(chunks, batch_size)
+    _log_throughput(progress)
+    ew_cache_util.bump_generation("chroma_film_indonesia")
+
+    if checkpoint.failed_ids:
+        logger.error(f"Load finished with failed ids {sorted(checkpoint.failed_ids)}, run again with --resume to retry them")
+    ew_registry_util.close_mysql_pool()
+
+
+def insert_item(id, payload, attributes=None):
     """Insert a new item """
-    
+
     try:
         logger.debug(f"Payload [{payload}]")
-        doc = Document(page_content=payload, metadata={"mysql_id": id, "source":"film"})
+        doc = build_document(id, payload, attributes)
         chunks = ew_embedding_util.split_documents([doc])
-        ew_embedding_util.add_to_chroma(chunks, db)
+        embeddings = ew_embedding_util.add_to_chroma(chunks, _db())
+        film_vector_service.on_upsert(chunks, embeddings)
 
         logger.debug(f"Item inserted at id [{id}]")
 
     except Exception as e:
         logger.error(f"Insert Error: {e}")
 
-if __name__ == "__main__":
-    main()
 
+def insert_chunks(chunks, embedding_function):
+    """Embed a batch of chunks in one call and write them in one bulk add"""
 
+    if len(chunks) == 0:
+        return 0
+
+    try:
+        embeddings = ew_embedding_util.embed_chunks(chunks, embedding_function)
+    except Exception as e:
+        embeddings = None
+        logger.error(f"Embedding Error: {e}")
+
+    return write_chunks(chunks, embeddings)
+
+
+def write_chunks(chunks, embeddings):
+    """Write a batch of embedded chunks in one bulk add"""
+
+    film_ids = sorted({chunk.metadata["mysql_id"] for chunk in chunks})
+    if embeddings is None:
+        logger.error(f"Batch not embedded for ids {film_ids}")
+        return 0
+
+    try:
+        ew_embedding_util.add_embedded_to_chroma(chunks, embeddings, _db())
+        film_vector_service.on_upsert(chunks, embeddings, replace_films=False)
+        logger.debug(f"Batch of [{len(chunks)}] chunks inserted")
+        return len(chunks)
+
+    except Exception as e:
+        logger.error(f"Batch Insert Error for ids {film_ids}: {e}")
+        return 0
+
+
+def drop_films(where):
+    """Delete the chunks matching where from chroma and the films they belong to from the derived indexes"""
+
+    film_ids = set()
+    offset = 0
+    while True:
+        page = _db().get(where=where, include=["metadatas"], limit=BATCH_SIZE, offset=offset)
+        ids = page.get("ids")
+        if not ids:
+            break
+        film_ids.update(metadata["mysql_id"] for metadata in page.get("metadatas"))
+        offset += len(ids)
+
+    _db().delete(where=where)
+    if film_ids:
+        film_ids = sorted(film_ids)
+        film_vector_service.on_delete(film_ids)
+        film_lexical_service.on_delete(film_ids)
+        film_similar_service.on_delete(film_ids)
+        logger.info(f"Dropped the chunks of [{len(film_ids)}] films")
+
+
+def _iter_rows(fetch_size, checkpoint):
+    """Yield the failed films of a previous run first, then every film after the checkpoint"""
+
+    failed_ids = sorted(checkpoint.failed_ids)
+    if failed_ids:
+        # Drop whatever part of the failed films made it into chroma before loading them again
+        drop_films({"mysql_id": {"$in": failed_ids}})
+
+        placeholders = ", ".join(["%s"] * len(failed_ids))
+        with ew_registry_util.get_mysql_pool().connection() as mysql_conn:
+            cursor = mysql_conn.cursor()
+            cursor.execute(f"{FILM_ROWS_QUERY} WHERE fi.film_id IN ({placeholders}) ORDER BY fi.film_id", failed_ids)
+            rows = cursor.fetchall()
+            cursor.close()
+        yield rows
+
+    # Keyset pages, no result is left open on the server across the embedding calls
+    yield from ew_registry_util.get_mysql_pool().iter_key_pages(FILM_ROWS_PAGE, checkpoint.last_film_id, (MAX_FILM_ID,), fetch_size)
+
+
+def _iter_chunks(pages, progress, checkpoint):
+    """Yield the chunks of every film, one page of rows at a time"""
+
+    for rows in pages:
+        for film_id, title, description, *attributes in rows:
+            doc = build_document(film_id, build_payload(film_id, title, description), row_attributes(*attributes))
+            # Chunk metadata is stamped per film, a film may span two batches
+            chunks = list(ew_embedding_util.iter_chunks_with_metadata([doc]))
+            checkpoint.start(film_id, len(chunks))
+            yield from chunks
+
+        progress["rows"] += len(rows)
+        _log_throughput(progress)
+
+
+def _log_throughput(progress):
+    elapsed = max(time.perf_counter() - progress["start"], 1e-9)
+    logger.info(f"Loaded [{progress['rows']}] rows [{progress['chunks']}] chunks in [{elapsed:.1f}]s "
+                f"- [{progress['rows'] / elapsed:.1f}] rows/s [{progress['chunks'] / elapsed:.1f}] chunks/s")
+
+if __name__ == "__main__":
+    main()
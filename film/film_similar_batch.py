@@ -0,0 +1,30 @@
+import argparse
+import logging
+import time
+
+from utils import ew_embedding_util
+from film.service import film_similar_service
+
+
+# Global variable start
+logger = logging.getLogger(__name__)
+# Global variable ends
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the nearest films of every film in chroma_film_indonesia")
+    parser.add_argument("--neighbours", type=int, default=film_similar_service.SIMILAR_NEIGHBOURS, help="Nearest films kept per film")
+    parser.add_argument("--block-size", type=int, default=1024, help="Films whose similarities are computed in one matrix product")
+    args = parser.parse_args()
+
+    build_table(args.neighbours, args.block_size)
+
+
+def build_table(n_neighbours, block_size):
+    start = time.perf_counter()
+    db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
+    table = film_similar_service.build_table(db, n_neighbours, block_size)
+    logger.info(f"Built the [{n_neighbours}] nearest films of [{len(table.film_ids)}] films "
+                f"to [{film_similar_service.SIMILAR_TABLE_PATH}] in [{time.perf_counter() - start:.1f}]s")
+
+if __name__ == "__main__":
+    main()
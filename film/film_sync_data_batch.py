@@ -0,0 +1,266 @@
+import argparse
+import logging
+import time
+
+from utils import ew_embedding_util
+from utils import ew_registry_util
+from utils import ew_cache_util
+from utils.ew_embedding_pool_util import take_batch
+from film.io.film_document import build_payload, build_document, content_hash
+from film.io.film_filter import FILM_ROWS_QUERY, row_attributes
+from film.io.film_statements import FILM_ROWS_PAGE
+from film.service import film_vector_service
+from film.service import film_lexical_service
+from film.service import film_similar_service
+
+
+# Global variable start
+logger = logging.getLogger(__name__)
+
+FETCH_SIZE = 500
+BATCH_SIZE = 256
+PAGE_SIZE = 5000
+# Films of film_indonesia brought into chroma
+MAX_FILM_ID = 10000
+# Global variable ends
+
+
+def _db():
+    return ew_registry_util.get_chroma_db("chroma_film_indonesia", cache_embeddings=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync changed rows of film_indonesia into the vector db")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be inserted, replaced and deleted")
+    parser.add_argument("--fetch-size", type=int, default=FETCH_SIZE, help="Rows fetched from MySQL per page")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Chunks embedded and written per call")
+    args = parser.parse_args()
+
+    sync_documents(args.fetch_size, args.batch_size, args.dry_run)
+
+
+def sync_documents(fetch_size=FETCH_SIZE, batch_size=BATCH_SIZE, dry_run=False):
+    """
+    Bring chroma in line with film_indonesia, only touching the films that changed.
+
+    1. Read the content hash and vector ids of every film already in chroma
+    2. Stream film_indonesia, a film is
+        - inserted when it has no chunk yet
+        - replaced when the hash of its payload and attributes differs from the stored one,
+          or when it is missing some of its chunks
+    3. Films of a batch that failed are written again once, films still failing are left
+       without chunks so the next sync inserts them
+    4. Films of the scanned id range left in chroma but gone from MySQL are deleted
+    """
+
+    start = time.perf_counter()
+    indexed = get_indexed_films()
+    logger.info(f"Found [{len(indexed)}] films in chroma")
+
+    # Keyset pages, no result is left open on the server across the embedding calls
+    pages = ew_registry_util.get_mysql_pool().iter_key_pages(FILM_ROWS_PAGE, 0, (MAX_FILM_ID,), fetch_size)
+
+    stats = {"inserted": 0, "replaced": 0, "deleted": 0, "unchanged": 0, "chunks": 0}
+    seen = set()
+    changed = list()
+    failed_ids = set()
+    changed_docs = _iter_changed_documents(pages, indexed, seen, changed, stats)
+
+    embedding_function = ew_registry_util.get_embedding_function(cache=True)
+    chunks = ew_embedding_util.iter_chunks_with_metadata(changed_docs)
+    batch = take_batch(chunks, batch_size)
+    while batch:
+        if not dry_run:
+            stats["chunks"] += replace_chunks(batch, indexed, embedding_function, failed_ids)
+        batch = take_batch(chunks, batch_size)
+    if failed_ids and not dry_run:
+        stats["chunks"] += _retry_failed(failed_ids, indexed, batch_size, embedding_function)
+    stats["failed"] = len(failed_ids)
+    ew_registry_util.close_mysql_pool()
+
+    if failed_ids and not dry_run:
+        # Their chunks are gone from chroma, keep the lexical index in line
+        changed = [(film_id, payload) for film_id, payload in changed if film_id not in failed_ids]
+        film_lexical_service.on_delete(sorted(failed_ids))
+        film_similar_service.on_delete(sorted(failed_ids))
+    if changed and not dry_run:
+        film_lexical_service.on_upsert(changed)
+        upsert_similar([film_id for film_id, _ in changed])
+
+    # Whatever of the scanned range was not seen in MySQL has been deleted there,
+    # films above it were added through the controller and are left alone
+    deleted_ids = [film_id for film_id in indexed if film_id <= MAX_FILM_ID and film_id not in seen]
+    stats["deleted"] = len(deleted_ids)
+    if deleted_ids and not dry_run:
+        vector_ids = [vector_id for film_id in deleted_ids for vector_id in indexed[film_id]["vector_ids"]]
+        _db().delete(vector_ids)
+        film_vector_service.on_delete(deleted_ids)
+        film_lexical_service.on_delete(deleted_ids)
+        film_similar_service.on_delete(deleted_ids)
+        logger.debug(f"Deleted films {deleted_ids}")
+
+    if not dry_run:
+        ew_cache_util.bump_generation("chroma_film_indonesia")
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Sync {'(dry run) ' if dry_run else ''}done in [{elapsed:.1f}]s "
+                f"inserted [{stats['inserted']}] replaced [{stats['replaced']}] deleted [{stats['deleted']}] "
+                f"unchanged [{stats['unchanged']}] chunks written [{stats['chunks']}] failed [{stats['failed']}]")
+    if failed_ids:
+        logger.error(f"Sync could not write films {sorted(failed_ids)}, they have no chunks left and the next sync inserts them")
+    return stats
+
+
+def get_indexed_films():
+    """
+    Map every film id in chroma to its stored content hash and vector ids.
+    A film missing some of its chunks, or with chunks of two versions, gets no hash so it is replaced.
+    """
+
+    indexed = dict()
+    offset = 0
+    while True:
+        page = _db().get(include=["metadatas"], limit=PAGE_SIZE, offset=offset)
+        ids = page.get("ids")
+        if not ids:
+            break
+
+        for vector_id, metadata in zip(ids, page.get("metadatas")):
+            film = indexed.setdefault(metadata["mysql_id"], {"hashes": set(), "chunk_count": None, "vector_ids": []})
+            film["vector_ids"].append(vector_id)
+            film["hashes"].add(metadata.get("content_hash"))
+            film["chunk_count"] = metadata.get("chunk_count", film["chunk_count"])
+        offset += len(ids)
+
+    incomplete = 0
+    for film in indexed.values():
+        hashes, chunk_count = film.pop("hashes"), film.pop("chunk_count")
+        # Chunks loaded before hashes were stored have none, the film will be replaced once.
+        # Chunks loaded before counts were stored have none, their film is taken as complete.
+        complete = len(hashes) == 1 and (chunk_count is None or chunk_count == len(film["vector_ids"]))
+        film["content_hash"] = next(iter(hashes)) if complete else None
+        incomplete += not complete
+    if incomplete:
+        logger.info(f"Found [{incomplete}] films partly written or without hash, they will be replaced")
+
+    return indexed
+
+
+def replace_chunks(chunks, indexed, embedding_function, failed_ids=None):
+    """
+    Embed a batch of chunks, drop the old chunks of their films, then write the new ones.
+    The films of a batch that could not be written are added to failed_ids.
+    """
+
+    film_ids = sorted({chunk.metadata["mysql_id"] for chunk in chunks})
+    try:
+        embeddings = ew_embedding_util.embed_chunks(chunks, embedding_function)
+
+        # A film may span two batches, its old chunks are only deleted once
+        old_vector_ids = list()
+        replaced_ids = list()
+        for film_id in film_ids:
+            film = indexed.get(film_id)
+            if film is not None and film["vector_ids"]:
+                old_vector_ids.extend(film["vector_ids"])
+                replaced_ids.append(film_id)
+                film["vector_ids"] = []
+        if old_vector_ids:
+            _db().delete(old_vector_ids)
+            film_vector_service.on_delete(replaced_ids)
+
+        ew_embedding_util.add_embedded_to_chroma(chunks, embeddings, _db())
+        film_vector_service.on_upsert(chunks, embeddings, replace_films=False)
+        logger.debug(f"Batch of [{len(chunks)}] chunks written for ids {film_ids}")
+        return len(chunks)
+
+    except Exception as e:
+        logger.error(f"Sync Error for ids {film_ids}: {e}")
+        if failed_ids is not None:
+            failed_ids.update(film_ids)
+        return 0
+
+
+def upsert_similar(film_ids):
+    """
+    Recompute the similar films of written films from their chunk embeddings in chroma,
+    a film may span several batches so its vector is only known once all of them are written.
+    """
+
+    if film_similar_service.get_table() is None:
+        return
+
+    mysql_ids, embeddings = list(), list()
+    for start in range(0, len(film_ids), PAGE_SIZE):
+        page = _db().get(where={"mysql_id": {"$in": film_ids[start:start + PAGE_SIZE]}}, include=["embeddings", "metadatas"])
+        mysql_ids.extend(metadata["mysql_id"] for metadata in page.get("metadatas"))
+        embeddings.extend(page.get("embeddings"))
+    film_similar_service.on_upsert_embeddings(mysql_ids, embeddings)
+
+
+def _retry_failed(failed_ids, indexed, batch_size, embedding_function):
+    """
+    Write the films of failed batches again from scratch, they may have been cut short.
+    Films failing again are removed from failed_ids only once they are written.
+    """
+
+    film_ids = sorted(failed_ids)
+    logger.info(f"Retrying films of failed batches {film_ids}")
+    _drop_films(film_ids, indexed)
+
+    placeholders = ", ".join(["%s"] * len(film_ids))
+    with ew_registry_util.get_mysql_pool().connection() as mysql_conn:
+        cursor = mysql_conn.cursor()
+        cursor.execute(f"{FILM_ROWS_QUERY} WHERE fi.film_id IN ({placeholders}) ORDER BY fi.film_id", film_ids)
+        rows = cursor.fetchall()
+        cursor.close()
+
+    docs = (build_document(film_id, build_payload(film_id, title, description), row_attributes(*attributes))
+            for film_id, title, description, *attributes in rows)
+    still_failed = set()
+    written = 0
+    chunks = ew_embedding_util.iter_chunks_with_metadata(docs)
+    batch = take_batch(chunks, batch_size)
+    while batch:
+        written += replace_chunks(batch, indexed, embedding_function, still_failed)
+        batch = take_batch(chunks, batch_size)
+
+    # Leave no half written film behind, without chunks the next sync inserts it
+    if still_failed:
+        _drop_films(sorted(still_failed), indexed)
+    failed_ids.intersection_update(still_failed)
+    return written
+
+
+def _drop_films(film_ids, indexed):
+    try:
+        _db().delete(where={"mysql_id": {"$in": film_ids}})
+        film_vector_service.on_delete(film_ids)
+    except Exception as e:
+        logger.error(f"Sync could not drop the chunks of ids {film_ids}: {e}")
+    for film_id in film_ids:
+        if film_id in indexed:
+            indexed[film_id]["vector_ids"] = []
+
+
+def _iter_changed_documents(pages, indexed, seen, changed, stats):
+    """Yield the document of every film that is new or whose payload changed, (id, payload) is kept in `changed`"""
+
+    for rows in pages:
+        for film_id, title, description, *attributes in rows:
+            seen.add(film_id)
+            payload = build_payload(film_id, title, description)
+            attributes = row_attributes(*attributes)
+            film = indexed.get(film_id)
+            if film is None:
+                stats["inserted"] += 1
+            elif film["content_hash"] != content_hash(payload, attributes):
+                stats["replaced"] += 1
+            else:
+                stats["unchanged"] += 1
+                continue
+            changed.append((film_id, payload))
+            yield build_document(film_id, payload, attributes)
+
+if __name__ == "__main__":
+    main()
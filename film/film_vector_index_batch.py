@@ -0,0 +1,87 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from utils import ew_embedding_util
+from film.service import film_vector_service
+
+
+# Global variable start
+logger = logging.getLogger(__name__)
+# Global variable ends
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the in-process vector index of chroma_film_indonesia")
+    parser.add_argument("--export", action="store_true", help="Export every chunk embedding of the collection into a new index")
+    parser.add_argument("--compact", action="store_true", help="Fold the inserts, updates and deletes made since the export into the index")
+    parser.add_argument("--quantize", action="store_true", help="Write the int8 copy used by FILM_VECTOR_BACKEND=numpy-int8")
+    parser.add_argument("--recall", type=str, metavar="PROMPTS_FILE", help="Report recall@k of the int8 search against exact search, one held-out query prompt per line")
+    parser.add_argument("--queries", type=int, default=200, help="Prompts of the --recall file used at most")
+    parser.add_argument("--k", type=int, default=10, help="k used by --recall")
+    args = parser.parse_args()
+
+    if not (args.export or args.compact or args.quantize or args.recall):
+        parser.error("One of --export, --compact, --quantize or --recall is required")
+    if args.export:
+        export_index()
+    if args.compact:
+        compact_index()
+    if args.quantize:
+        quantize_index()
+    if args.recall:
+        report_recall(args.recall, args.queries, args.k)
+
+
+def export_index():
+    """Export the collection, queries then use it when FILM_VECTOR_BACKEND=numpy"""
+
+    start = time.perf_counter()
+    db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
+    index = film_vector_service.export_index(db)
+    logger.info(f"Exported [{len(index.mysql_ids)}] chunks to [{film_vector_service.VECTOR_INDEX_PATH}] in [{time.perf_counter() - start:.1f}]s")
+
+
+def compact_index():
+    index = film_vector_service.get_index()
+    if index is None:
+        logger.error(f"No index exported at [{film_vector_service.VECTOR_INDEX_PATH}]")
+        return
+
+    index.compact()
+    logger.info(f"Compacted index has [{len(index.mysql_ids)}] chunks")
+
+
+def quantize_index():
+    index = film_vector_service.get_index()
+    if index is None:
+        logger.error(f"No index exported at [{film_vector_service.VECTOR_INDEX_PATH}]")
+        return
+
+    index.quantize()
+    full_bytes = index.embeddings.nbytes
+    logger.info(f"Quantized [{len(index.mysql_ids)}] chunks, scanned matrix [{full_bytes / 2**20:.1f}]MB -> [{index.quantized.nbytes / 2**20:.1f}]MB")
+
+
+def report_recall(prompts_file, n_queries, k):
+    """
+    Embed held-out query prompts and compare int8 with exact top k.
+    Stored chunk embeddings are not used as queries, each would find itself first.
+    """
+
+    index = film_vector_service.get_index()
+    if index is None or index.quantized is None:
+        logger.error("The index has to be exported and quantized first")
+        return
+
+    with open(prompts_file, "r", encoding="utf-8") as f:
+        prompts = [line.strip() for line in f if line.strip()][:n_queries]
+    queries = [np.asarray(vector, dtype=np.float32) for vector in ew_embedding_util.get_query_embedding_cache().embed_queries(prompts)]
+
+    start = time.perf_counter()
+    recall = index.recall(queries, k)
+    logger.info(f"Recall@{k} of the int8 tier over [{len(queries)}] queries: [{recall:.4f}] in [{time.perf_counter() - start:.1f}]s")
+
+if __name__ == "__main__":
+    main()
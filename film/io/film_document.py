@@ -0,0 +1,39 @@
+import hashlib
+import json
+import re
+
+from langchain.schema.document import Document
+
+_PAYLOAD_PATTERN = re.compile(r"Id: [^\n]*\nTitle: (?P<title>[^\n]*)\nDescription: (?P<description>.*)", re.DOTALL)
+
+
+def build_payload(film_id, title, description):
+    """Text that is embedded for a film"""
+
+    return f"Id: {film_id}\nTitle: {title}\nDescription: {description}\n"
+
+
+def content_hash(payload: str, attributes=None):
+    """Hash of the embedded text and the film attributes, kept in every chunk metadata to detect changes"""
+
+    digest = hashlib.sha1(payload.encode("utf-8"))
+    if attributes:
+        digest.update(json.dumps(attributes, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_document(film_id, payload, attributes=None):
+    """Document of a film, ready to be split into chunks, the attributes go to the metadata for filtering"""
+
+    metadata = {"mysql_id": film_id, "source": "film", "content_hash": content_hash(payload, attributes)}
+    metadata.update(attributes or {})
+    return Document(page_content=payload, metadata=metadata)
+
+
+def payload_text(payload: str):
+    """Title and description of a payload built by build_payload, the whole payload when it was written by hand"""
+
+    match = _PAYLOAD_PATTERN.match(payload)
+    if match is None:
+        return payload
+    return f"{match.group('title')} {match.group('description')}"
@@ -0,0 +1,120 @@
+import json
+
+# Attributes of a film kept in every chunk metadata, read from the sakila tables
+ATTRIBUTE_KEYS = ("release_year", "language", "rating", "category")
+
+# Rows of film_indonesia with their attributes, append the WHERE / ORDER BY clauses
+FILM_ROWS_QUERY = """
+    SELECT
+        fi.film_id
+        , fi.title
+        , fi.description
+        , f.release_year
+        , l.name AS language
+        , f.rating
+        , (SELECT MIN(c.name) FROM film_category fc JOIN category c ON c.category_id = fc.category_id WHERE fc.film_id = fi.film_id) AS category
+    FROM film_indonesia fi
+    LEFT JOIN film f ON f.film_id = fi.film_id
+    LEFT JOIN language l ON l.language_id = f.language_id
+    """
+
+
+def row_attributes(release_year, language, rating, category):
+    """Attributes of a FILM_ROWS_QUERY row, missing ones are left out as chroma rejects None"""
+
+    values = (int(release_year) if release_year is not None else None
+              , language.strip() if language is not None else None
+              , rating
+              , category)
+    return {key: value for key, value in zip(ATTRIBUTE_KEYS, values) if value is not None}
+
+
+class FilmFilter:
+    """
+    Structured filter on film attributes, pushed down to both retrieval legs.
+
+    year_from / year_to bound release_year, languages, ratings and categories
+    are lists of accepted values. An attribute left as None is not filtered.
+    """
+
+    def __init__(self, year_from=None, year_to=None, languages=None, ratings=None, categories=None):
+        self.year_from = year_from
+        self.year_to = year_to
+        self.languages = languages
+        self.ratings = ratings
+        self.categories = categories
+
+    @classmethod
+    def from_dict(cls, values):
+        """Build from {"year_from", "year_to", "language", "rating", "category"}, a single value or a list each"""
+
+        values = values or {}
+        return cls(values.get("year_from")
+                   , values.get("year_to")
+                   , _as_list(values.get("language"))
+                   , _as_list(values.get("rating"))
+                   , _as_list(values.get("category")))
+
+    def to_dict(self):
+        values = {"year_from": self.year_from, "year_to": self.year_to
+                  , "language": self.languages, "rating": self.ratings, "category": self.categories}
+        return {key: value for key, value in values.items() if value is not None}
+
+    def is_empty(self):
+        return len(self.to_dict()) == 0
+
+    def chroma_where(self):
+        """Chroma `where` on the chunk metadata, None when nothing is filtered"""
+
+        conditions = list()
+        if self.year_from is not None:
+            conditions.append({"release_year": {"$gte": int(self.year_from)}})
+        if self.year_to is not None:
+            conditions.append({"release_year": {"$lte": int(self.year_to)}})
+        for key, accepted in (("language", self.languages), ("rating", self.ratings), ("category", self.categories)):
+            if accepted is not None:
+                conditions.append({key: {"$in": accepted}})
+
+        if len(conditions) == 0:
+            return None
+        if len(conditions) == 1:
+            return conditions[0]
+        return {"$and": conditions}
+
+    def sql_predicate(self, film_id_column="film_id"):
+        """SQL predicate on a film id column and its parameters, None when nothing is filtered"""
+
+        predicates, params = list(), list()
+        if self.year_from is not None:
+            predicates.append("f.release_year >= %s")
+            params.append(int(self.year_from))
+        if self.year_to is not None:
+            predicates.append("f.release_year <= %s")
+            params.append(int(self.year_to))
+        if self.languages is not None:
+            predicates.append(f"f.language_id IN (SELECT language_id FROM language WHERE name IN ({_placeholders(self.languages)}))")
+            params.extend(self.languages)
+        if self.ratings is not None:
+            predicates.append(f"f.rating IN ({_placeholders(self.ratings)})")
+            params.extend(self.ratings)
+        if self.categories is not None:
+            predicates.append("f.film_id IN (SELECT fc.film_id FROM film_category fc JOIN category c ON c.category_id = fc.category_id "
+                              f"WHERE c.name IN ({_placeholders(self.categories)}))")
+            params.extend(self.categories)
+
+        if len(predicates) == 0:
+            return None, []
+        return f"{film_id_column} IN (SELECT f.film_id FROM film f WHERE {' AND '.join(predicates)})", params
+
+    def __repr__(self):
+        return f"FilmFilter({json.dumps(self.to_dict(), ensure_ascii=False)})"
+
+
+def _as_list(value):
+    if value is None or isinstance(value, list):
+        return value
+    return [value]
+
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
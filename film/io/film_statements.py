@@ -0,0 +1,23 @@
+from film.io.film_filter import FILM_ROWS_QUERY
+
+# Hot read statements of film_indonesia, run as server-side prepared statements by ew_mysql_util.MySQLPool.
+# The pool keys its prepared cursors by these strings, always pass the constants themselves.
+
+# film_id and relevance of the natural language fulltext search : (text, text, limit)
+FULLTEXT_SEARCH = """
+    SELECT
+        film_id
+        , MATCH(title, description) AGAINST(%s) AS score
+    FROM film_indonesia
+    WHERE MATCH(title, description) AGAINST(%s)
+    LIMIT %s
+    """
+
+# Title and description of one film : (film_id,)
+FILM_DESCRIPTION = "SELECT film_id, title, description FROM film_indonesia WHERE film_id = %s"
+
+# FILM_ROWS_QUERY rows after a film id in film id order, the scan of the loader and the sync : (last_film_id, max_film_id)
+FILM_ROWS_AFTER = f"{FILM_ROWS_QUERY} WHERE fi.film_id > %s AND fi.film_id <= %s ORDER BY fi.film_id"
+
+# One keyset page of FILM_ROWS_AFTER, see MySQLPool.iter_key_pages : (last_film_id, max_film_id, limit)
+FILM_ROWS_PAGE = f"{FILM_ROWS_AFTER} LIMIT %s"
@@ -0,0 +1,41 @@
+import logging
+
+from utils import ew_registry_util
+from film.io.film_filter import FILM_ROWS_QUERY, row_attributes
+
+# Global variable start
+logger = logging.getLogger(__name__)
+# Global variable ends
+
+
+def get_attributes(film_ids):
+    """Filterable attributes of some films as a dict of film_id to attributes, empty when MySQL cannot be read"""
+
+    film_ids = list(dict.fromkeys(int(film_id) for film_id in film_ids))
+    if not film_ids:
+        return dict()
+
+    try:
+        placeholders = ", ".join(["%s"] * len(film_ids))
+        with ew_registry_util.get_mysql_pool().connection() as mysql_conn:
+            cursor = mysql_conn.cursor()
+            cursor.execute(f"{FILM_ROWS_QUERY} WHERE fi.film_id IN ({placeholders})", film_ids)
+            attributes = {film_id: row_attributes(*values) for film_id, _, _, *values in cursor.fetchall()}
+            cursor.close()
+        return attributes
+
+    except Exception as e:
+        logger.error(f"Attribute Error for ids {film_ids}: {e}")
+        return dict()
+
+
+def get_film_ids(film_filter):
+    """Ids of the films of film_indonesia matching a FilmFilter"""
+
+    predicate, params = film_filter.sql_predicate("fi.film_id")
+    with ew_registry_util.get_mysql_pool().connection() as mysql_conn:
+        cursor = mysql_conn.cursor()
+        cursor.execute(f"SELECT fi.film_id FROM film_indonesia fi WHERE {predicate}", params)
+        film_ids = [film_id for film_id, in cursor.fetchall()]
+        cursor.close()
+    return film_ids
@@ -1,14 +1,21 @@
 import logging
 
-from utils import ew_embedding_util 
+from utils import ew_registry_util
+from utils import ew_cache_util
 from film.service import film_get_service
+from film.service import film_vector_service
+from film.service import film_lexical_service
+from film.service import film_similar_service
 
 # Global variable start
-db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
 logger = logging.getLogger(__name__)
 # Global variable ends
 
 
+def _db():
+    return ew_registry_util.get_chroma_db("chroma_film_indonesia")
+
+
 def delete_item(id):
     """Delete an item by id."""
 
@@ -24,8 +31,41 @@ def delete_item(id):
         for chunk in existing:
             vector_ids.append(chunk["vector_id"])
 
-        db.delete(vector_ids)
+        _db().delete(vector_ids)
+        film_vector_service.on_delete([id])
+        film_lexical_service.on_delete([id])
+        film_similar_service.on_delete([id])
+        ew_cache_util.bump_generation("chroma_film_indonesia")
         logger.debug(f"Item at id [{id}] with chunk ids {vector_ids} deleted")
 
     except Exception as e:
         logger.error(f"Delete Error: {e}")
+
+
+def delete_items(ids):
+    """
+    Delete a batch of items by id with a single lookup and a single delete.
+    Returns the list of ids deleted and the list of ids not found or failed.
+    """
+
+    ids = list(dict.fromkeys(int(id) for id in ids))
+    try:
+        existing = _db().get(where={"mysql_id": {"$in": ids}}, include=["metadatas"])
+        vector_ids = existing.get("ids")
+        found_ids = {metadata["mysql_id"] for metadata in existing.get("metadatas")}
+        missing_ids = [id for id in ids if id not in found_ids]
+        if missing_ids:
+            logger.error(f"No existing item found for ids {missing_ids}")
+
+        if vector_ids:
+            _db().delete(vector_ids)
+            film_vector_service.on_delete(sorted(found_ids))
+            film_lexical_service.on_delete(sorted(found_ids))
+            film_similar_service.on_delete(sorted(found_ids))
+            ew_cache_util.bump_generation("chroma_film_indonesia")
+        logger.debug(f"Items at ids {sorted(found_ids)} with [{len(vector_ids)}] chunks deleted")
+        return sorted(found_ids), missing_ids
+
+    except Exception as e:
+        logger.error(f"Bulk Delete Error: {e}")
+        return [], ids
@@ -3,11 +3,9 @@ import logging
 from langchain.schema.document import Document
 from langchain_chroma import Chroma
 
-from utils import ew_embedding_util 
 from film.service import film_list_service
 
 # Global variable start
-db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
 logger = logging.getLogger(__name__)
 # Global variable ends
 
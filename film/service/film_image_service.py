@@ -1,12 +1,17 @@
 import logging
 
 import argparse
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
 from langchain.prompts import ChatPromptTemplate
 from langchain_community.llms.ollama import Ollama
 from PIL import Image
 import base64
 from io import BytesIO
 
+from utils import ew_cache_util
+
 PROMPT_TEMPLATE = """
 You are a programmer and coding assistant.
 
@@ -19,29 +24,37 @@ Translate the answer into Korean Language.
 
 logger = logging.getLogger(__name__)
 
+CAPTION_MODEL = "llava:7b"
+CAPTION_CACHE_PATH = "cache/caption_cache.sqlite"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp")
+
 
 def main():
     # Create CLI.
     parser = argparse.ArgumentParser()
     parser.add_argument("query_text", type=str, help="The query text.")
-    parser.add_argument("image_path", type=str, help="Path to the image file.")
+    parser.add_argument("image_path", type=str, help="Path to the image file, or a directory to caption every image in it.")
+    parser.add_argument("--workers", type=int, default=2, help="Images captioned at once in directory mode.")
     
     args = parser.parse_args()
     query_text = args.query_text
     image_path = args.image_path
     
-    query_rag(query_text, image_path)
+    if os.path.isdir(image_path):
+        caption_directory(query_text, image_path, args.workers)
+    else:
+        query_rag(query_text, image_path)
 
 
-def query_rag(query_text: str, image_path: str):
+def query_rag(query_text: str, image_path: str, model=None):
     logger.debug(f"Query Text: {query_text}")
     logger.debug(f"Image Path: {image_path}")
 
-    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-    prompt = prompt_template.format(question=query_text)
+    prompt = build_prompt(query_text)
     
     # 0.0 temperature means LLM will respond with exact answer to exact prompt
-    model = Ollama(model="llava:7b",temperature = 0.0)
+    if model is None:
+        model = Ollama(model=CAPTION_MODEL,temperature = 0.0)
     image_b64 = load_image(image_path)
     response_text = model.invoke(prompt, images=[image_b64])
 
@@ -49,6 +62,50 @@ def query_rag(query_text: str, image_path: str):
     logger.debug(formatted_response)
     return response_text
 
+
+def caption_directory(query_text: str, image_dir: str, workers: int = 2):
+    """
+    Caption every image of a directory with at most `workers` requests to the model at once.
+    Captions are cached by image content hash and prompt, already captioned images return instantly.
+    """
+
+    image_paths = sorted(os.path.join(image_dir, name) for name in os.listdir(image_dir)
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+    prompt = build_prompt(query_text)
+    cache = ew_cache_util.DiskCache(CAPTION_CACHE_PATH)
+    # Temperature 0 keeps a cached caption valid for the same image and prompt
+    model = Ollama(model=CAPTION_MODEL,temperature = 0.0)
+
+    def caption(image_path):
+        with open(image_path, "rb") as f:
+            image_hash = hashlib.sha256(f.read()).hexdigest()
+        key = ew_cache_util.hash_key(CAPTION_MODEL, prompt, image_hash)
+
+        cached = cache.get_json(key)
+        if cached is not None:
+            logger.debug(f"Caption cache hit [{image_path}]")
+            return cached["caption"]
+
+        try:
+            response_text = query_rag(query_text, image_path, model)
+        except Exception as e:
+            logger.error(f"Caption Error [{image_path}]: {e}")
+            return None
+        cache.put_json(key, {"caption": response_text})
+        return response_text
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        captions = dict(zip(image_paths, executor.map(caption, image_paths)))
+
+    for image_path, caption_text in captions.items():
+        logger.info(f"[{image_path}]\n{caption_text.strip() if caption_text else 'Caption failed'}")
+    return captions
+
+
+def build_prompt(query_text: str):
+    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+    return prompt_template.format(question=query_text)
+
 def convert_to_base64(pil_image: Image):
     buffered = BytesIO()
     pil_image.save(buffered, format="PNG")
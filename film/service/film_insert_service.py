@@ -1,16 +1,24 @@
 import logging
 
-from langchain.schema.document import Document
-
 from utils import ew_embedding_util 
+from utils import ew_registry_util
+from utils import ew_cache_util
 from film.service import film_list_service
+from film.service import film_vector_service
+from film.service import film_lexical_service
+from film.service import film_similar_service
+from film.service import film_attribute_service
+from film.io.film_document import build_document
 
 # Global variable start
-db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
 logger = logging.getLogger(__name__)
 # Global variable ends
 
 
+def _db():
+    return ew_registry_util.get_chroma_db("chroma_film_indonesia", cache_embeddings=True)
+
+
 def insert_item(id, payload):
     """Insert a new item """
     
@@ -24,11 +32,54 @@ def insert_item(id, payload):
             return
 
         logger.debug(f"Payload [{payload}]")
-        doc = Document(page_content=payload, metadata={"mysql_id": id, "source":"film"})
+        doc = build_document(id, payload, film_attribute_service.get_attributes([id]).get(id))
         chunks = ew_embedding_util.split_documents([doc])
-        ew_embedding_util.add_to_chroma(chunks, db)
+        embeddings = ew_embedding_util.add_to_chroma(chunks, _db())
+        film_vector_service.on_upsert(chunks, embeddings)
+        film_lexical_service.on_upsert([(id, payload)])
+        film_similar_service.on_upsert(chunks, embeddings)
+        ew_cache_util.bump_generation("chroma_film_indonesia")
 
         logger.debug(f"Item inserted at id [{id}]")
 
     except Exception as e:
-        logger.error(f"Insert Error: {e}")
\ No newline at end of file
+        logger.error(f"Insert Error: {e}")
+
+
+def insert_items(records):
+    """
+    Insert a batch of (id, payload) with a single chroma call.
+    Returns the list of ids inserted and the list of ids that failed or already exist.
+    """
+
+    # Last record wins when an id is repeated in the batch
+    payloads = dict()
+    for id, payload in records:
+        payloads[int(id)] = payload
+
+    try:
+        ids = list(payloads.keys())
+        existing = _db().get(where={"mysql_id": {"$in": ids}}, include=["metadatas"])
+        existing_ids = {metadata["mysql_id"] for metadata in existing.get("metadatas")}
+        if existing_ids:
+            logger.error(f"Existing items found {sorted(existing_ids)}, please use update operation to update them")
+
+        new_ids = [id for id in ids if id not in existing_ids]
+        chunks = list()
+        attributes = film_attribute_service.get_attributes(new_ids)
+        for id in new_ids:
+            doc = build_document(id, payloads[id], attributes.get(id))
+            chunks.extend(ew_embedding_util.split_documents([doc]))
+        if chunks:
+            embeddings = ew_embedding_util.add_to_chroma(chunks, _db())
+            film_vector_service.on_upsert(chunks, embeddings)
+            film_lexical_service.on_upsert([(id, payloads[id]) for id in new_ids])
+            film_similar_service.on_upsert(chunks, embeddings)
+            ew_cache_util.bump_generation("chroma_film_indonesia")
+
+        logger.debug(f"Items inserted at ids {new_ids}")
+        return new_ids, sorted(existing_ids)
+
+    except Exception as e:
+        logger.error(f"Bulk Insert Error: {e}")
+        return [], list(payloads.keys())
@@ -0,0 +1,40 @@
+import logging
+
+from utils import ew_cache_util
+
+# Global variable start
+logger = logging.getLogger(__name__)
+
+KEYWORD_CACHE_PATH = "cache/keyword_cache.sqlite"
+KEYWORD_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_cache = None
+# Global variable ends
+
+
+def get_keywords(template_name: str, model: str, template_version: int, prompt: str):
+    """
+    Cached {keywords, translation} of a prompt, None on a miss.
+    Every prompt template has its own entries, their answers do not have the same shape.
+    """
+
+    value = _get_cache().get_json(_key(template_name, model, template_version, prompt))
+    logger.debug(f"Keyword cache {'hit' if value is not None else 'miss'} [{prompt}]")
+    return value
+
+
+def put_keywords(template_name: str, model: str, template_version: int, prompt: str, keywords: str, translation: str = None):
+    """Store the keywords and translation the model gave for a prompt"""
+
+    _get_cache().put_json(_key(template_name, model, template_version, prompt), {"keywords": keywords, "translation": translation})
+
+
+def _key(template_name, model, template_version, prompt):
+    # Case is kept, the model may answer differently to a differently cased prompt
+    return ew_cache_util.hash_key(template_name, model, template_version, ew_cache_util.normalize_text(prompt))
+
+
+def _get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ew_cache_util.DiskCache(KEYWORD_CACHE_PATH, KEYWORD_CACHE_MAX_BYTES)
+    return _cache
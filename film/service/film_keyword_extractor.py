@@ -3,6 +3,7 @@ import logging
 from langchain.prompts import ChatPromptTemplate
 from langchain_community.llms.ollama import Ollama
 
+from film.service import film_keyword_cache
 
 # Global variable start
 logger = logging.getLogger(__name__)
@@ -17,6 +18,14 @@ Make sure all keywords are in Indonesian language.
 Here is an example output of movie with the female singer in it: cantik, penyanyi, musik, pertunjukan, bakat, vokalis, film, artis, musikal
 Do not write an introduction or summary in your response.
 """
+# Keeps the cached keywords of this prompt apart from those of other prompts
+PROMPT_TEMPLATE_NAME = "film_keyword_extractor"
+# Bump whenever the prompt above changes, cached keywords of the old prompt are then ignored
+PROMPT_TEMPLATE_VERSION = 1
+# llama3.1:70b-instruct-q2_k
+# llama3.1:8b-instruct-q8_0
+# llama3.2:3b-instruct-q8_0
+KEYWORD_MODEL = "llama3.2:3b-instruct-q8_0"
 # Global variable ends
 
 
@@ -31,15 +40,18 @@ def film_get_keywords(query_text: str):
 def call_ollama_with(query_text: str):
     """Send the prompt to LLM engine"""
 
+    # Temperature is 0, the same prompt always gets the same keywords
+    cached = film_keyword_cache.get_keywords(PROMPT_TEMPLATE_NAME, KEYWORD_MODEL, PROMPT_TEMPLATE_VERSION, query_text)
+    if cached is not None:
+        return cached["keywords"]
+
     prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
     prompt = prompt_template.format(question=query_text)
     logger.debug(f"Sending prompt to LLM.. {prompt}")
 
-    # llama3.1:70b-instruct-q2_k
-    # llama3.1:8b-instruct-q8_0
-    # llama3.2:3b-instruct-q8_0
-    model = Ollama(model="llama3.2:3b-instruct-q8_0",temperature = 0.0)
+    model = Ollama(model=KEYWORD_MODEL,temperature = 0.0)
     response_text = model.invoke(prompt)
     formatted_response = f"{response_text}"
+    film_keyword_cache.put_keywords(PROMPT_TEMPLATE_NAME, KEYWORD_MODEL, PROMPT_TEMPLATE_VERSION, query_text, formatted_response)
 
     return formatted_response
@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from utils import ew_registry_util
+from utils import ew_store_util
+from utils.ew_bm25_util import BM25Index
+from film.io.film_document import payload_text
+
+# Global variable start
+logger = logging.getLogger(__name__)
+
+# mysql : MATCH(title, description) AGAINST(...) on film_indonesia
+# bm25  : in-process BM25 over a snapshot of film_indonesia, see film.film_lexical_index_batch
+LEXICAL_BACKEND = os.getenv("FILM_LEXICAL_BACKEND", "mysql")
+LEXICAL_INDEX_PATH = "lexical_index/film_indonesia"
+_index = None
+_lock = threading.Lock()
+# Global variable ends
+
+
+def search(query: str, limit: int, allowed_ids=None):
+    """
+    Top films of the query as [{item_id, score}], the score normalized by the best one like mysql_agent does.
+    Only films in allowed_ids are returned when it is given.
+    """
+
+    index = get_index()
+    if index is None:
+        logger.warning(f"No lexical index built at [{LEXICAL_INDEX_PATH}]")
+        return []
+
+    results = index.search(query, limit, allowed_ids)
+    max_score = results[0][1] if results else 0
+    logger.debug(f"Max bm25 score: [{max_score}]")
+    return [{"item_id": film_id, "score": score / max_score} for film_id, score in results]
+
+
+def build_index():
+    """Build a new index from a snapshot of film_indonesia"""
+
+    global _index
+    with ew_registry_util.get_mysql_pool().connection() as mysql_conn:
+        cursor = mysql_conn.cursor()
+        cursor.execute("SELECT film_id, title, description FROM film_indonesia")
+        index = BM25Index.build((film_id, f"{title} {description}") for film_id, title, description in cursor)
+        cursor.close()
+
+    with ew_store_util.file_lock(LEXICAL_INDEX_PATH):
+        index.save(LEXICAL_INDEX_PATH)
+    with _lock:
+        _index = index
+    return index
+
+
+def on_upsert(records):
+    """Keep the index in line after some (id, payload) were written"""
+
+    with _writing() as index:
+        if index is None:
+            return
+        for film_id, payload in records:
+            index.upsert(film_id, payload_text(payload))
+        index.save(LEXICAL_INDEX_PATH)
+
+
+def on_delete(film_ids):
+    """Keep the index in line after some films were deleted"""
+
+    with _writing() as index:
+        if index is None:
+            return
+        for film_id in film_ids:
+            index.delete(film_id)
+        index.save(LEXICAL_INDEX_PATH)
+
+
+def merge_index():
+    """Fold the segment into the index arrays, None when the index was never built"""
+
+    with _writing() as index:
+        if index is not None:
+            index.merge()
+            index.save(LEXICAL_INDEX_PATH)
+        return index
+
+
+def get_index():
+    """The built index, reloaded when another process saved it, None when it was never built"""
+
+    global _index
+    with _lock:
+        stamp = ew_store_util.manifest_stamp(LEXICAL_INDEX_PATH)
+        if stamp is not None and (_index is None or stamp != _index.stamp):
+            _index = BM25Index.load(LEXICAL_INDEX_PATH, previous=_index)
+            logger.debug(f"Loaded lexical index of [{len(_index.doc_ids)}] films")
+        return _index
+
+
+@contextmanager
+def _writing():
+    # One writer at a time across processes, changing the version the others saved last
+    with ew_store_util.file_lock(LEXICAL_INDEX_PATH):
+        yield get_index()
@@ -2,20 +2,23 @@ import logging
 
 from langchain_chroma import Chroma
 
-from utils import ew_embedding_util 
+from utils import ew_registry_util
 
 # Global variable start
-db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
 logger = logging.getLogger(__name__)
 # Global variable ends
 
 
+def _db():
+    return ew_registry_util.get_chroma_db("chroma_film_indonesia")
+
+
 def list_items(ids):
     """List all items in the data_list."""
     
     metadata_criteria = {"mysql_id": { "$in" : ids}}
     logger.debug(f"Get all vectors with all the film_id from vector metadata.. : {metadata_criteria}")
-    retriever = db.get(where=metadata_criteria)
+    retriever = _db().get(where=metadata_criteria)
     ids = retriever.get("ids")
     docs = retriever.get("documents")
     metadatas = retriever.get("metadatas")
@@ -7,10 +7,10 @@ from langchain_community.llms.ollama import Ollama
 from film.io.film_score import FilmScore
 from film.service import film_search_service
 from film.service import film_keyword_extractor
-from utils import ew_mysql_util
+from utils import ew_registry_util
+from film.io.film_statements import FILM_DESCRIPTION
 
 # Global variable start
-mysql_conn = ew_mysql_util.get_mysql_conn()
 logger = logging.getLogger(__name__)
 
 PROMPT_TEMPLATE = """
@@ -61,14 +61,10 @@ def film_rag(query_text: str):
     film = semantic_search_results["results"][0]
     
     # Get additional data from MySQL, add it to the dict
-    cursor = mysql_conn.cursor(dictionary=True)
-    qry = f"SELECT film_id, title, description FROM film_indonesia WHERE film_id IN ({film.film_id})"
-    cursor.execute(qry)    
-    resultset = cursor.fetchall()
+    resultset = ew_registry_util.get_mysql_pool().execute(FILM_DESCRIPTION, (film.film_id,))
     for rs in resultset:
         film.title = rs["title"]
         film.description = rs["description"]
-    cursor.close()
 
     # Send to LLM
     user_query = query_text + ". " + keywords
@@ -1,20 +1,28 @@
 import logging
 
-from utils import ew_embedding_util
-from utils import ew_mysql_util
+from utils import ew_registry_util
+from utils import ew_fusion_util
 from film.io.film_score import FilmScore
+from film.io.film_statements import FULLTEXT_SEARCH
 from film.service import film_keyword_extractor
+from film.service import film_lexical_service
+from film.service import film_vector_service
 
 # Global variable start
-db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
-mysql_conn = ew_mysql_util.get_mysql_conn()
 logger = logging.getLogger(__name__)
 
 MYSQL_WEIGHT = 0.7
 CHROMA_WEIGHT = 0.3
+# See ew_fusion_util.fuse, weighted without normalization is the original ranking
+FUSION_STRATEGY = "weighted"
+FUSION_NORMALIZE = None
 # Global variable ends
 
 
+def _db():
+    return ew_registry_util.get_chroma_db("chroma_film_indonesia")
+
+
 def film_search(query_text: str):
     """
     Semantically search data with the provided keywords.
@@ -53,27 +61,13 @@ def film_search(query_text: str):
     chroma_results = search_chroma(keywords)
     logger.info(f"Chroma results:\n{chroma_results}")
 
-    # Combine and sort by score
-    # Create a dictionary for quick access to semantic scores
-    chroma_results_dict = {item.film_id : item.score for item in chroma_results}
-    
-    # Combine scores using a set of all unique IDs
-    combined_scores = []
-    for mysql_item in mysql_results:
-        chroma_score = chroma_results_dict.get(mysql_item.film_id, 0)  
-        combined_score = ((MYSQL_WEIGHT * mysql_item.score) + (CHROMA_WEIGHT * chroma_score))
-        combined_score = FilmScore(mysql_item.film_id, combined_score)
-        combined_scores.append(combined_score)
-
-    # Add missing semantic search results
-    for chroma_item in chroma_results:
-        if chroma_item.film_id not in [item.film_id for item in mysql_results]:
-            missing_chroma_item = FilmScore(chroma_item.film_id, chroma_item.score)
-            logger.debug(f"Missing chroma item :\n{missing_chroma_item}")
-            combined_scores.append(missing_chroma_item)        
-    
-    # Sort by combined score in descending order
-    combined_scores.sort(key=lambda film: film.score, reverse=True)
+    # MySQL is the primary leg, chroma only items keep their chroma score
+    ids, scores = ew_fusion_util.fuse([_to_arrays(mysql_results), _to_arrays(chroma_results)]
+                                      , [MYSQL_WEIGHT, CHROMA_WEIGHT]
+                                      , strategy=FUSION_STRATEGY
+                                      , normalize=FUSION_NORMALIZE
+                                      , primary=0)
+    combined_scores = [FilmScore(film_id, score) for film_id, score in zip(ids.tolist(), scores.tolist())]
     logger.info(f"Final ordered results:\n{combined_scores}")
 
     result = {"keywords": keywords, "results": combined_scores}
@@ -89,19 +83,11 @@ def extract_keywords(query_text: str):
 
 def search_mysql(keywords: str):
     """Search mysql db with natural language search using keywords"""
+
+    if film_lexical_service.LEXICAL_BACKEND == "bm25":
+        return [FilmScore(item["item_id"], item["score"]) for item in film_lexical_service.search(keywords, 10)]
     
-    cursor = mysql_conn.cursor(dictionary=True)
-    qry = f"""
-            SELECT
-                film_id
-                , MATCH(title, description) AGAINST('{keywords}') AS score
-            FROM film_indonesia
-            WHERE MATCH(title, description) AGAINST('{keywords}')
-            LIMIT 10
-            """
-
-    cursor.execute(qry)    
-    resultset = cursor.fetchall()
+    resultset = ew_registry_util.get_mysql_pool().execute(FULLTEXT_SEARCH, (keywords, keywords, 10))
     
     # Normalize score
     max_mysql_score = max(rs["score"] for rs in resultset)
@@ -111,25 +97,31 @@ def search_mysql(keywords: str):
     for rs in resultset:
         film_score = FilmScore(rs["film_id"], rs["score"] / max_mysql_score)
         film_list.append(film_score)
-    cursor.close()
-
 
     return film_list
 
 
+def _to_arrays(film_scores):
+    return [film.film_id for film in film_scores], [film.score for film in film_scores]
+
+
 def search_chroma(keywords):
     """Search Chroma DB with cosine similarity search"""
 
     # Search the DB.
     k = 10
+    if film_vector_service.CHUNK_POOLING != "none":
+        logger.debug(f"Querying vector stores for [{k}] films pooled by [{film_vector_service.CHUNK_POOLING}] : {keywords}")
+        return [FilmScore(mysql_id, score) for mysql_id, score in film_vector_service.search_films(_db(), keywords, k)]
+
     logger.debug(f"Querying vector stores with top [{k}] : {keywords}")
-    results = db.similarity_search_with_score(keywords, k)
+    results = film_vector_service.similarity_search(_db(), keywords, k)
 
-    # Create a list of result
+    # Create a list of result, the score is the cosine similarity like the pooled search gives
     doc_list = list()
     film_id_set = set()
-    for doc, _score in results:
-        film_score = FilmScore(doc.metadata.get("mysql_id", None), _score)
+    for mysql_id, distance in results:
+        film_score = FilmScore(mysql_id, 1 - distance)
         doc_list.append(film_score)
         film_id_set.add(film_score.film_id)
 
@@ -0,0 +1,78 @@
+import logging
+
+import numpy as np
+
+from utils import ew_store_util
+from utils.ew_neighbour_util import NeighbourTable, film_vectors
+
+# Global variable start
+logger = logging.getLogger(__name__)
+
+SIMILAR_TABLE_PATH = "vector_index/similar_films"
+SIMILAR_NEIGHBOURS = 20
+PAGE_SIZE = 5000
+_table = None
+# Global variable ends
+
+
+def get_similar(film_id, limit=10):
+    """Nearest films of a film as [{item_id, score}], the score is the cosine similarity of the film vectors"""
+
+    table = get_table()
+    if table is None:
+        logger.warning(f"No similar film table built at [{SIMILAR_TABLE_PATH}]")
+        return []
+    return [{"item_id": item_id, "score": score} for item_id, score in table.lookup(int(film_id), limit)]
+
+
+def build_table(db, n_neighbours=SIMILAR_NEIGHBOURS, block_size=1024):
+    """Average the chunk embeddings stored in chroma per film and compute the neighbours of every film"""
+
+    global _table
+    embeddings, mysql_ids = [], []
+    offset = 0
+    while True:
+        page = db.get(include=["embeddings", "metadatas"], limit=PAGE_SIZE, offset=offset)
+        ids = page.get("ids")
+        if not ids:
+            break
+        embeddings.append(np.asarray(page.get("embeddings"), dtype=np.float32))
+        mysql_ids.extend(metadata["mysql_id"] for metadata in page.get("metadatas"))
+        offset += len(ids)
+        logger.info(f"Read [{offset}] chunk embeddings")
+
+    film_ids, vectors = film_vectors(mysql_ids, np.concatenate(embeddings))
+    _table = NeighbourTable.build(SIMILAR_TABLE_PATH, film_ids, vectors, n_neighbours, block_size)
+    return _table
+
+
+def on_upsert(chunks, embeddings):
+    """Recompute the neighbours touched by films whose chunks were all just written"""
+
+    on_upsert_embeddings([chunk.metadata["mysql_id"] for chunk in chunks], embeddings)
+
+
+def on_upsert_embeddings(mysql_ids, embeddings):
+    """on_upsert of every chunk embedding of some films, given as parallel mysql ids and vectors"""
+
+    table = get_table()
+    if table is None or not len(mysql_ids):
+        return
+    film_ids, vectors = film_vectors(mysql_ids, np.asarray(embeddings))
+    table.upsert(film_ids, vectors)
+
+
+def on_delete(film_ids):
+    table = get_table()
+    if table is None:
+        return
+    table.delete(film_ids)
+
+
+def get_table():
+    """The built table, None when it was never built"""
+
+    global _table
+    if _table is None and ew_store_util.manifest_stamp(SIMILAR_TABLE_PATH) is not None:
+        _table = NeighbourTable(SIMILAR_TABLE_PATH)
+    return _table
@@ -2,28 +2,70 @@ import logging
 from langchain_chroma import Chroma
 
 from utils import ew_embedding_util 
-from film.service import film_insert_service
-from film.service import film_delete_service
+from utils import ew_registry_util
+from utils import ew_cache_util
+from film.io.film_document import build_document
+from film.service import film_vector_service
+from film.service import film_lexical_service
+from film.service import film_similar_service
+from film.service import film_attribute_service
 
 # Global variable start
-db = ew_embedding_util.get_chroma_db("chroma_film_indonesia")
 logger = logging.getLogger(__name__)
 # Global variable ends
 
+
+def _db():
+    return ew_registry_util.get_chroma_db("chroma_film_indonesia", cache_embeddings=True)
+
+
 def update_item(id, payload):
     """Update an item at a specific id."""
 
     try:
         id = int(id)
-        # Delete existing
-        film_delete_service.delete_item(id)
-
-        # Insert afterwards
+        # Overwrite the chunks in place, only trailing chunks are deleted
         logger.debug(f"Payload [{payload}]")
-        film_insert_service.insert_item(id, payload)
+        doc = build_document(id, payload, film_attribute_service.get_attributes([id]).get(id))
+        chunks = ew_embedding_util.split_documents([doc])
+        embeddings = ew_embedding_util.upsert_to_chroma(chunks, _db())
+        film_vector_service.on_upsert(chunks, embeddings)
+        film_lexical_service.on_upsert([(id, payload)])
+        film_similar_service.on_upsert(chunks, embeddings)
+        ew_cache_util.bump_generation("chroma_film_indonesia")
 
         logger.debug(f"Item at id [{id}] updated")
 
     except Exception as e:
         logger.error(f"Update Error: {e}")
 
+
+def update_items(records):
+    """
+    Update a batch of (id, payload) with a single chroma upsert.
+    Returns the list of ids updated and the list of ids that failed.
+    """
+
+    # Last record wins when an id is repeated in the batch
+    payloads = dict()
+    for id, payload in records:
+        payloads[int(id)] = payload
+
+    try:
+        chunks = list()
+        attributes = film_attribute_service.get_attributes(payloads.keys())
+        for id, payload in payloads.items():
+            doc = build_document(id, payload, attributes.get(id))
+            chunks.extend(ew_embedding_util.split_documents([doc]))
+        embeddings = ew_embedding_util.upsert_to_chroma(chunks, _db())
+        film_vector_service.on_upsert(chunks, embeddings)
+        film_lexical_service.on_upsert(payloads.items())
+        film_similar_service.on_upsert(chunks, embeddings)
+        ew_cache_util.bump_generation("chroma_film_indonesia")
+
+        logger.debug(f"Items at ids {list(payloads.keys())} updated")
+        return list(payloads.keys()), []
+
+    except Exception as e:
+        logger.error(f"Bulk Update Error: {e}")
+        return [], list(payloads.keys())
@@ -0,0 +1,120 @@
+import logging
+import os
+
+from utils import ew_embedding_util
+from utils import ew_store_util
+from utils.ew_vector_index_util import NumpyVectorIndex, pool_by_film
+
+# Global variable start
+logger = logging.getLogger(__name__)
+
+# chroma     : query the chroma collection
+# numpy      : exact brute force over the memory-mapped export of the collection
+# numpy-int8 : int8 first pass over the quantized export, best candidates rescored in full precision
+VECTOR_BACKEND = os.getenv("FILM_VECTOR_BACKEND", "chroma")
+VECTOR_INDEX_PATH = "vector_index/chroma_film_indonesia"
+
+# none : the agents collapse the k chunks to films themselves
+# max / mean / sum : search_films oversamples chunks and pools them per film, see pool_by_film
+CHUNK_POOLING = os.getenv("FILM_CHUNK_POOLING", "none")
+# Chunks fetched per requested film
+POOL_OVERSAMPLE = int(os.getenv("FILM_POOL_OVERSAMPLE", "5"))
+# Chunks averaged per film by the mean pooling
+POOL_TOP_M = 3
+_index = None
+# Global variable ends
+
+
+def similarity_search(db, query: str, k: int, filter=None):
+    """
+    Top k chunks of the query as (mysql_id, score), the score is the cosine distance like chroma returns.
+    A chroma `where` filter on the chunk metadata is always answered by chroma.
+    """
+
+    backend = VECTOR_BACKEND if filter is None else "chroma"
+    if backend in ("numpy", "numpy-int8") and get_index() is None:
+        logger.warning(f"No index exported at [{VECTOR_INDEX_PATH}], searching chroma")
+    elif backend == "numpy":
+        vector = ew_embedding_util.get_query_embedding_cache().embed_query(query)
+        return [(mysql_id, score) for mysql_id, _, score in get_index().search(vector, k)]
+    elif backend == "numpy-int8":
+        vector = ew_embedding_util.get_query_embedding_cache().embed_query(query)
+        return [(mysql_id, score) for mysql_id, _, score in get_index().search_quantized(vector, k)]
+
+    results = ew_embedding_util.similarity_search_with_score(db, query, k, filter=filter)
+    return [(doc.metadata.get("mysql_id", None), score) for doc, score in results]
+
+
+def similarity_search_many(db, queries: list[str], k: int):
+    """similarity_search of many queries, the query vectors are embedded in one batched call"""
+
+    if VECTOR_BACKEND in ("numpy", "numpy-int8") and get_index() is None:
+        logger.warning(f"No index exported at [{VECTOR_INDEX_PATH}], searching chroma")
+    elif VECTOR_BACKEND in ("numpy", "numpy-int8"):
+        vectors = ew_embedding_util.get_query_embedding_cache().embed_queries(queries)
+        search = get_index().search if VECTOR_BACKEND == "numpy" else get_index().search_quantized
+        return [[(mysql_id, score) for mysql_id, _, score in search(vector, k)] for vector in vectors]
+
+    results = ew_embedding_util.similarity_search_many(db, queries, k)
+    return [[(doc.metadata.get("mysql_id", None), score) for doc, score in query_results] for query_results in results]
+
+
+def search_films(db, query: str, n: int, filter=None):
+    """
+    Top n distinct films of the query as (mysql_id, score), best first.
+    n * POOL_OVERSAMPLE chunks are fetched and pooled per film with CHUNK_POOLING,
+    the score is the pooled cosine similarity.
+    """
+
+    return pool_films(similarity_search(db, query, n * POOL_OVERSAMPLE, filter), n)
+
+
+def pool_films(results, n: int):
+    """Pool the (mysql_id, distance) chunk hits of one query into its top n films"""
+
+    mysql_ids = [mysql_id for mysql_id, _ in results]
+    similarities = [1 - distance for _, distance in results]
+    films = pool_by_film(mysql_ids, similarities, n, method=CHUNK_POOLING, top_m=POOL_TOP_M)
+    logger.debug(f"Pooled [{len(results)}] chunks into [{len(films)}] films with [{CHUNK_POOLING}]")
+    return films
+
+
+def on_upsert(chunks, embeddings, replace_films=True):
+    """
+    Keep the exported index in line after chunks were written to chroma.
+    Pass replace_films=False when the chunks of a film are written over several batches.
+    """
+
+    index = get_index()
+    if index is None:
+        return
+    index.upsert([chunk.metadata["mysql_id"] for chunk in chunks]
+                 , [chunk.metadata["chunk_index"] for chunk in chunks]
+                 , embeddings
+                 , replace_films)
+
+
+def on_delete(mysql_ids):
+    """Keep the exported index in line after some films were deleted from chroma"""
+
+    index = get_index()
+    if index is None:
+        return
+    index.delete(mysql_ids)
+
+
+def export_index(db):
+    """Export the chroma collection into a new index"""
+
+    global _index
+    _index = NumpyVectorIndex.export(db, VECTOR_INDEX_PATH)
+    return _index
+
+
+def get_index():
+    """The exported index, None when the collection was never exported"""
+
+    global _index
+    if _index is None and ew_store_util.manifest_stamp(VECTOR_INDEX_PATH) is not None:
+        _index = NumpyVectorIndex(VECTOR_INDEX_PATH)
+    return _index
@@ -0,0 +1,198 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from langchain.schema.document import Document
+from pypdf import PdfReader
+
+from utils import ew_embedding_util
+from utils.ew_embedding_pool_util import EmbeddingWorkerPool
+
+
+# Global variable start
+logger = logging.getLogger(__name__)
+
+CHROMA_PATH = "chroma_pdf"
+# Hash of every file whose chunks were all written, kept with chroma so --reset clears it too
+LOADED_PATH = os.path.join(CHROMA_PATH, "loaded_files.json")
+DATA_PATH = "data"
+PAGES_PER_TASK = 16
+BATCH_SIZE = 256
+# Global variable ends
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the PDF files of a directory into the vector db")
+    parser.add_argument("--data", type=str, default=DATA_PATH, help="Directory holding the PDF files")
+    parser.add_argument("--reset", action="store_true", help="Clear the vector db before loading")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes parsing PDF pages")
+    parser.add_argument("--pages-per-task", type=int, default=PAGES_PER_TASK, help="Pages parsed by a process per task")
+    parser.add_argument("--embedding-workers", type=int, default=4, help="Embedding requests kept in flight")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Maximum chunks embedded per call")
+    args = parser.parse_args()
+
+    if args.reset:
+        logger.info("Clearing database")
+        ew_embedding_util.clear_chroma_db(CHROMA_PATH)
+
+    load_documents(args.data, args.workers, args.pages_per_task, args.embedding_workers, args.batch_size)
+
+
+def load_documents(data_path=DATA_PATH, workers=None, pages_per_task=PAGES_PER_TASK, embedding_workers=4, batch_size=BATCH_SIZE):
+    """
+    Parse, chunk and load every new or changed PDF of the directory.
+
+    1. Hash every file, files whose hash is recorded as completely loaded are skipped
+    2. Parse page ranges of the changed files in a process pool
+    3. Stream the pages into batched embedding as the ranges complete
+    4. Write chunks with stable {source}:{page}:{chunk} ids, then drop the chunks
+       the previous version of a file had beyond the new ones
+    5. Record the hash of a file only once all of it is written, a file cut short by
+       an error, a crash or Ctrl-C is loaded again by the next run
+    """
+
+    db = ew_embedding_util.get_chroma_db(CHROMA_PATH, cache_embeddings=True)
+    start = time.perf_counter()
+
+    loaded = read_loaded_hashes()
+    changed = dict()
+    for path in sorted(glob.glob(os.path.join(data_path, "*.pdf"))):
+        try:
+            file_hash = hash_file(path)
+        except OSError as e:
+            logger.error(f"Read Error in [{path}], skipping it: {e}")
+            continue
+        if loaded.get(path) == file_hash:
+            logger.info(f"Unchanged, skipping [{path}]")
+            continue
+        changed[path] = file_hash
+
+    if not changed:
+        logger.info("No new or changed PDF to load")
+        return
+
+    # Forget the files about to be rewritten before touching their chunks
+    for path in changed:
+        loaded.pop(path, None)
+    write_loaded_hashes(loaded)
+
+    written_ids = {path: set() for path in changed}
+    failed_paths = set()
+    progress = {"pages": 0, "chunks": 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict()
+        for path in changed:
+            try:
+                page_count = len(PdfReader(path).pages)
+            except Exception as e:
+                logger.error(f"Parse Error in [{path}]: {e}")
+                failed_paths.add(path)
+                continue
+            logger.info(f"Loading [{path}] with [{page_count}] pages")
+            for first_page in range(0, page_count, pages_per_task):
+                last_page = min(first_page + pages_per_task, page_count)
+                futures[executor.submit(extract_pages, path, first_page, last_page)] = path
+
+        documents = _iter_documents(futures, changed, failed_paths, progress)
+        chunks = ew_embedding_util.iter_chunks_with_metadata(documents, page_key="page")
+        embedding_function = ew_embedding_util.get_embedding_function(cache=True)
+        with EmbeddingWorkerPool(embedding_function, max_workers=embedding_workers, max_batch_size=batch_size) as pool:
+            for batch, embeddings in pool.embed_stream(chunks):
+                if embeddings is None:
+                    failed_paths.update(chunk.metadata["source"] for chunk in batch)
+                    continue
+                try:
+                    ew_embedding_util.add_embedded_to_chroma(batch, embeddings, db)
+                except Exception as e:
+                    sources = {chunk.metadata["source"] for chunk in batch}
+                    logger.error(f"Batch Insert Error for {sorted(sources)}: {e}")
+                    failed_paths.update(sources)
+                    continue
+                for chunk in batch:
+                    written_ids[chunk.metadata["source"]].add(chunk.metadata["chunk_id"])
+                progress["chunks"] += len(batch)
+
+    for path in changed:
+        try:
+            if path in failed_paths:
+                # Left unrecorded, the next run loads it again
+                logger.error(f"Failed to load [{path}], its chunks are removed so the next run loads it again")
+                db.delete(where={"source": path})
+                continue
+
+            existing = db.get(where={"source": path}, include=[])
+            stale_ids = [vector_id for vector_id in existing.get("ids") if vector_id not in written_ids[path]]
+            if stale_ids:
+                db.delete(stale_ids)
+                logger.debug(f"Deleted [{len(stale_ids)}] stale chunks of [{path}]")
+        except Exception as e:
+            logger.error(f"Cleanup Error for [{path}], it is loaded again by the next run: {e}")
+            continue
+        loaded[path] = changed[path]
+        write_loaded_hashes(loaded)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    logger.info(f"Loaded [{len(changed)}] files [{progress['pages']}] pages [{progress['chunks']}] chunks in [{elapsed:.1f}]s "
+                f"- [{progress['pages'] / elapsed:.1f}] pages/s [{progress['chunks'] / elapsed:.1f}] chunks/s")
+
+
+def extract_pages(path, first_page, last_page):
+    """Extract the text of a page range, runs in a worker process"""
+
+    reader = PdfReader(path)
+    return [(page_number, reader.pages[page_number].extract_text() or "") for page_number in range(first_page, last_page)]
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_loaded_hashes():
+    """Map of path to the hash of the file version completely loaded in chroma"""
+
+    if not os.path.exists(LOADED_PATH):
+        return dict()
+    with open(LOADED_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_loaded_hashes(loaded):
+    os.makedirs(os.path.dirname(LOADED_PATH), exist_ok=True)
+
+    # Write to a temporary file and swap, a crash never leaves a half written record
+    tmp_path = LOADED_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(loaded, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, LOADED_PATH)
+
+
+def _iter_documents(futures, changed, failed_paths, progress):
+    """Yield one document per page as the page ranges complete"""
+
+    for future in as_completed(futures):
+        path = futures[future]
+        try:
+            pages = future.result()
+        except Exception as e:
+            logger.error(f"Parse Error in [{path}]: {e}")
+            failed_paths.add(path)
+            continue
+
+        for page_number, text in pages:
+            if text.strip():
+                metadata = {"source": path, "page": page_number, "file_hash": changed[path]}
+                yield Document(page_content=text, metadata=metadata)
+        progress["pages"] += len(pages)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+from utils import ew_store_util
+
+logger = logging.getLogger(__name__)
+
+K1 = 1.2
+B = 0.75
+# Rebuild the arrays once the in-memory segment grows past this share of the indexed documents
+MERGE_RATIO = 0.1
+
+STOPWORDS = frozenset("""
+    ada adalah agar akan aku anda antara apa apakah atau bagaimana bagi bahwa banyak bersama
+    beberapa belum bisa dalam dan dari dengan di dia ia ini itu jika juga kami kamu karena
+    ke kepada kita lagi lain lalu maka mereka meski namun oleh pada para saat sama sangat
+    saya sebagai sebuah sedang sehingga sejak seorang seperti setelah sudah tak tanpa telah
+    tentang tetapi tidak untuk walau yaitu yang
+    a an and are as at be by for from in is it of on or that the this to was with
+""".split())
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+_PARTICLE_SUFFIXES = ("lah", "kah", "tah", "pun")
+_POSSESSIVE_SUFFIXES = ("nya", "ku", "mu")
+
+
+def tokenize(text: str):
+    """
+    Lowercase, accent free tokens without stopwords.
+    Indonesian particles (-lah, -kah, -tah, -pun) and possessives (-nya, -ku, -mu)
+    are stripped from longer words so "filmnya" and "film" share a term.
+    """
+
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    tokens = list()
+    for token in _TOKEN_PATTERN.findall(text):
+        if token in STOPWORDS:
+            continue
+        tokens.append(_stem(token))
+    return tokens
+
+
+def _stem(token):
+    # Strip until nothing is left to strip, a stem stems to itself so stored terms can be tokenized again
+    stripped = True
+    while stripped:
+        stripped = False
+        for suffix in _PARTICLE_SUFFIXES + _POSSESSIVE_SUFFIXES:
+            if len(token) > len(suffix) + 3 and token.endswith(suffix):
+                token = token[:-len(suffix)]
+                stripped = True
+                break
+    return token
+
+
+class BM25Index:
+    """
+    BM25 over a compact array based inverted index.
+
+    Terms map to a slice of `doc_rows` / `tfs` through `indptr` (CSR layout),
+    a query accumulates the term scores of every posting with one `bincount` per term.
+
+    Documents added or updated after the build live in a small in-memory segment
+    and the old rows are masked in `alive`. `merge` folds the segment into the arrays,
+    it runs on its own once the segment passes MERGE_RATIO of the index.
+    Document frequencies of the segment are added to the arrays', masked rows still count
+    until the next merge.
+
+    `save` writes to an ew_store_util store: the arrays go to a `base-*.npz` written only
+    after a build or a merge, the mask and the segment to a small `delta-*.json`.
+    """
+
+    def __init__(self, doc_ids, doc_lengths, terms, indptr, doc_rows, tfs):
+        self.lock = threading.Lock()
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.terms = terms
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.indptr = indptr
+        self.doc_rows = doc_rows
+        self.tfs = tfs
+
+        self.row_of = {int(doc_id): row for row, doc_id in enumerate(doc_ids)}
+        self.alive = np.ones(len(doc_ids), dtype=bool)
+        self.segment = dict()
+        # Name of the saved base the arrays come from, None until they are saved
+        self.base_name = None
+        self.stamp = None
+
+    @classmethod
+    def build(cls, documents):
+        """Build from an iterable of (doc_id, text)"""
+
+        return cls.from_counts((doc_id, Counter(tokenize(text))) for doc_id, text in documents)
+
+    @classmethod
+    def from_counts(cls, documents):
+        """Build from an iterable of (doc_id, Counter of terms), the terms are taken as they are"""
+
+        doc_ids, doc_lengths = list(), list()
+        postings = dict()
+        for row, (doc_id, counts) in enumerate(documents):
+            doc_ids.append(doc_id)
+            doc_lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((row, tf))
+
+        terms = sorted(postings)
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        doc_rows, tfs = list(), list()
+        for i, term in enumerate(terms):
+            for row, tf in postings[term]:
+                doc_rows.append(row)
+                tfs.append(tf)
+            indptr[i + 1] = len(doc_rows)
+
+        return cls(np.asarray(doc_ids, dtype=np.int64)
+                   , np.asarray(doc_lengths, dtype=np.float32)
+                   , terms
+                   , indptr
+                   , np.asarray(doc_rows, dtype=np.int32)
+                   , np.asarray(tfs, dtype=np.float32))
+
+    @classmethod
+    def load(cls, path, previous=None):
+        """
+        Load the current version of the store at path, None when it was never saved.
+        The arrays of `previous` are reused when it holds the same base.
+        """
+
+        def loader(manifest, stamp):
+            if previous is not None and previous.base_name == manifest["base"]:
+                index = cls(previous.doc_ids, previous.doc_lengths, previous.terms
+                            , previous.indptr, previous.doc_rows, previous.tfs)
+            else:
+                with np.load(os.path.join(path, manifest["base"]), allow_pickle=False) as data:
+                    index = cls(data["doc_ids"], data["doc_lengths"], data["terms"].tolist()
+                                , data["indptr"], data["doc_rows"], data["tfs"])
+            with open(os.path.join(path, manifest["delta"]), "r", encoding="utf-8") as f:
+                delta = json.load(f)
+            index.alive = ~np.isin(index.doc_ids, np.asarray(delta["masked"], dtype=np.int64))
+            index.segment = {int(doc_id): (Counter(counts), sum(counts.values())) for doc_id, counts in delta["segment"].items()}
+            index.base_name, index.stamp = manifest["base"], stamp
+            return index
+
+        return ew_store_util.load_current(path, loader)
+
+    def save(self, path):
+        """
+        Write the index to the store at path, the arrays only when they are not saved yet.
+        Callers hold ew_store_util.file_lock(path) and loaded the current version first.
+        """
+
+        with self.lock:
+            os.makedirs(path, exist_ok=True)
+            base_name = self.base_name
+            if base_name is None:
+                base_name = ew_store_util.new_version("base", ".npz")
+                tmp_path = os.path.join(path, f"base.{os.getpid()}.tmp.npz")
+                np.savez(tmp_path
+                         , doc_ids=self.doc_ids
+                         , doc_lengths=self.doc_lengths
+                         , terms=np.asarray(self.terms, dtype=str)
+                         , indptr=self.indptr
+                         , doc_rows=self.doc_rows
+                         , tfs=self.tfs)
+                os.replace(tmp_path, os.path.join(path, base_name))
+
+            delta_name = ew_store_util.new_version("delta", ".json")
+            tmp_path = os.path.join(path, f"delta.{os.getpid()}.tmp.json")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"masked": self.doc_ids[~self.alive].tolist()
+                           , "segment": {doc_id: counts for doc_id, (counts, _) in self.segment.items()}}, f)
+            os.replace(tmp_path, os.path.join(path, delta_name))
+
+            ew_store_util.write_manifest(path, {"base": base_name, "delta": delta_name})
+            self.base_name = base_name
+            self.stamp = ew_store_util.manifest_stamp(path)
+
+    def search(self, query: str, k: int, allowed_ids=None):
+        """Top k documents as (doc_id, score), best first, only documents matching a query term and in allowed_ids when given"""
+
+        query_terms = set(tokenize(query))
+        with self.lock:
+            n_docs = int(self.alive.sum()) + len(self.segment)
+            if n_docs == 0 or not query_terms:
+                return []
+            total_length = float(self.doc_lengths[self.alive].sum()) + sum(length for _, length in self.segment.values())
+            avg_length = total_length / n_docs or 1.0
+            norms = K1 * (1 - B + B * self.doc_lengths / avg_length)
+
+            scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+            segment_scores = Counter()
+            for term in query_terms:
+                term_id = self.term_ids.get(term)
+                rows = tfs = None
+                df = 0
+                if term_id is not None:
+                    start, end = self.indptr[term_id], self.indptr[term_id + 1]
+                    rows, tfs = self.doc_rows[start:end], self.tfs[start:end]
+                    df = end - start
+                df += sum(1 for counts, _ in self.segment.values() if term in counts)
+                if df == 0:
+                    continue
+
+                idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                if rows is not None:
+                    weights = idf * tfs * (K1 + 1) / (tfs + norms[rows])
+                    scores += np.bincount(rows, weights=weights, minlength=len(scores)).astype(np.float32)
+                for doc_id, (counts, length) in self.segment.items():
+                    tf = counts.get(term)
+                    if tf:
+                        segment_scores[doc_id] += idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avg_length))
+
+            scores[~self.alive] = 0
+            if allowed_ids is not None:
+                allowed_ids = set(allowed_ids)
+                scores[~np.isin(self.doc_ids, np.fromiter(allowed_ids, dtype=np.int64, count=len(allowed_ids)))] = 0
+                segment_scores = {doc_id: score for doc_id, score in segment_scores.items() if doc_id in allowed_ids}
+            matched = np.flatnonzero(scores > 0)
+            results = [(int(self.doc_ids[row]), float(scores[row])) for row in matched]
+            results.extend((doc_id, float(score)) for doc_id, score in segment_scores.items())
+
+        results.sort(key=lambda item: item[1], reverse=True)
+        return results[:k]
+
+    def upsert(self, doc_id, text):
+        with self.lock:
+            self._mask(doc_id)
+            counts = Counter(tokenize(text))
+            self.segment[int(doc_id)] = (counts, sum(counts.values()))
+            if len(self.segment) > MERGE_RATIO * max(len(self.doc_ids), 1):
+                self._merge()
+
+    def delete(self, doc_id):
+        with self.lock:
+            self._mask(doc_id)
+            self.segment.pop(int(doc_id), None)
+
+    def merge(self):
+        with self.lock:
+            self._merge()
+
+    def _mask(self, doc_id):
+        row = self.row_of.get(int(doc_id))
+        if row is not None:
+            self.alive[row] = False
+
+    def _merge(self):
+        if not self.segment and self.alive.all():
+            return
+
+        # Regroup the live postings by term, then append the segment
+        documents = dict()
+        for term_id, term in enumerate(self.terms):
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            for row, tf in zip(self.doc_rows[start:end], self.tfs[start:end]):
+                if self.alive[row]:
+                    documents.setdefault(int(self.doc_ids[row]), Counter())[term] = int(tf)
+        for row in np.flatnonzero(self.alive):
+            documents.setdefault(int(self.doc_ids[row]), Counter())
+        for doc_id, (counts, _) in self.segment.items():
+            documents[doc_id] = counts
+
+        merged = BM25Index.from_counts(documents.items())
+        self.doc_ids, self.doc_lengths = merged.doc_ids, merged.doc_lengths
+        self.terms, self.term_ids = merged.terms, merged.term_ids
+        self.indptr, self.doc_rows, self.tfs = merged.indptr, merged.doc_rows, merged.tfs
+        self.row_of = merged.row_of
+        self.alive = merged.alive
+        self.segment = dict()
+        self.base_name = None
+        logger.debug(f"Merged BM25 index, [{len(self.doc_ids)}] documents [{len(self.terms)}] terms")
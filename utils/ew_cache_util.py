@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+GENERATION_PATH = "cache/generation"
+# Access times of hits are kept in memory and written in one statement once this many are pending
+ACCESS_FLUSH_SIZE = 256
+# or once the oldest pending one is this many seconds old
+ACCESS_FLUSH_SECONDS = 30
+
+
+class DiskCache:
+    """
+    Persistent key value store backed by a single SQLite file.
+
+    Values are raw bytes, the least recently used entries are evicted
+    once the total size of the stored values goes over `max_bytes`.
+    The total is kept in its own row, updated with every write, so it is shared by
+    all processes using the file. Access times of hits are written in batches.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY
+                , value BLOB NOT NULL
+                , size INTEGER NOT NULL
+                , accessed REAL NOT NULL
+            )
+            """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_size (
+                id INTEGER PRIMARY KEY CHECK (id = 0)
+                , total INTEGER NOT NULL
+            )
+            """)
+        # Files written before the total was kept get it computed once
+        self.conn.execute("INSERT OR IGNORE INTO cache_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM cache")
+        self.conn.commit()
+        self.accessed = dict()
+        self.accessed_since = None
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Return a dict of the keys found in the cache"""
+
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        with self.lock:
+            found = self._select(keys, "key, value")
+            if found:
+                for key in found:
+                    self.accessed[key] = now
+                if self.accessed_since is None:
+                    self.accessed_since = now
+                if len(self.accessed) >= ACCESS_FLUSH_SIZE or now - self.accessed_since >= ACCESS_FLUSH_SECONDS:
+                    self._flush_accessed()
+                    self.conn.commit()
+        return found
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, items):
+        """Store a dict of key to bytes, then evict if the cache got too big"""
+
+        if len(items) == 0:
+            return
+
+        now = time.time()
+        with self.lock:
+            # Replaced entries give their size back
+            replaced = self._select(list(items.keys()), "key, size")
+            added = sum(len(value) for value in items.values()) - sum(replaced.values())
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, size, accessed) VALUES (?, ?, ?, ?)"
+                , [(key, value, len(value), now) for key, value in items.items()])
+            self.conn.execute("UPDATE cache_size SET total = total + ? WHERE id = 0", (added,))
+            self._evict()
+            self.conn.commit()
+
+    def get_json(self, key):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def put_json(self, key, value):
+        self.put(key, json.dumps(value).encode("utf-8"))
+
+    def delete(self, key):
+        with self.lock:
+            self._delete([key])
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.accessed.clear()
+            self.accessed_since = None
+            self.conn.execute("DELETE FROM cache")
+            self.conn.execute("UPDATE cache_size SET total = 0 WHERE id = 0")
+            self.conn.commit()
+
+    def flush(self):
+        """Write the pending access times"""
+
+        with self.lock:
+            if self.accessed:
+                self._flush_accessed()
+                self.conn.commit()
+
+    def _select(self, keys, columns):
+        found = {}
+        # Stay below the SQLite host parameter limit
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            placeholders = ",".join("?" * len(part))
+            rows = self.conn.execute(f"SELECT {columns} FROM cache WHERE key IN ({placeholders})", part)
+            found.update(rows.fetchall())
+        return found
+
+    def _delete(self, keys):
+        sizes = self._select(keys, "key, size")
+        self.conn.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in sizes])
+        self.conn.execute("UPDATE cache_size SET total = total - ? WHERE id = 0", (sum(sizes.values()),))
+
+    def _flush_accessed(self):
+        self.conn.executemany("UPDATE cache SET accessed = ? WHERE key = ?"
+                              , [(accessed, key) for key, accessed in self.accessed.items()])
+        self.accessed.clear()
+        self.accessed_since = None
+
+    def _evict(self):
+        total = self.conn.execute("SELECT total FROM cache_size WHERE id = 0").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Recent hits must count before picking the oldest entries
+        self._flush_accessed()
+
+        # Drop the oldest entries until we are back to 90% of the limit
+        excess = total - int(self.max_bytes * 0.9)
+        rows = self.conn.execute("SELECT key, size FROM cache ORDER BY accessed")
+        evicted = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            evicted.append(key)
+            excess -= size
+        self._delete(evicted)
+        logger.debug(f"Evicted [{len(evicted)}] entries from [{self.path}]")
+
+
+def bump_generation(name):
+    """Mark the data behind `name` as changed, caches built on it in any process become stale"""
+
+    os.makedirs(GENERATION_PATH, exist_ok=True)
+    path = os.path.join(GENERATION_PATH, name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp_path, path)
+
+
+def read_generation(name):
+    """Current generation of the data behind `name`, 0 when it never changed"""
+
+    try:
+        with open(os.path.join(GENERATION_PATH, name), "r", encoding="utf-8") as f:
+            return int(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def normalize_text(text: str):
+    """Normalise text so trivially different strings share a cache entry"""
+
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+
+def hash_key(*parts):
+    """Build a cache key from its parts"""
+
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
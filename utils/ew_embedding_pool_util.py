@@ -0,0 +1,123 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import ew_embedding_util
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingWorkerPool:
+    """
+    Bounded pool that keeps several embedding requests in flight against Ollama.
+
+    Batch size and concurrency are adjusted AIMD-style:
+        - A batch finishing under the target latency grows the batch size by `batch_step`
+          and the concurrency by one, up to their maximum.
+        - A slow batch or an error halves both.
+
+    Backpressure comes from the caller's iterator, the next chunks are only pulled
+    when a slot is free, so at most `concurrency` batches are held in memory.
+    """
+
+    def __init__(self
+                 , embedding_function=None
+                 , max_workers=8
+                 , min_batch_size=16
+                 , max_batch_size=512
+                 , batch_step=16
+                 , target_latency=5.0
+                 , max_retries=3):
+        self.embedding_function = embedding_function or ew_embedding_util.get_embedding_function()
+        self.max_workers = max_workers
+        self.min_batch_size = min(min_batch_size, max_batch_size)
+        self.max_batch_size = max_batch_size
+        self.batch_step = batch_step
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+
+        self.concurrency = 1
+        self.batch_size = self.min_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embedding")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def embed_stream(self, chunks):
+        """
+        Embed an iterable of chunks, yield (chunks, embeddings) per batch in completion order.
+        A batch that still fails after `max_retries` is yielded with embeddings set to None.
+        """
+
+        chunks = iter(chunks)
+        in_flight = {}
+        exhausted = False
+
+        while True:
+            # Fill the free slots
+            while not exhausted and len(in_flight) < self.concurrency:
+                batch = take_batch(chunks, self.batch_size)
+                if len(batch) == 0:
+                    exhausted = True
+                    break
+                in_flight[self._submit(batch)] = (batch, 0)
+
+            if len(in_flight) == 0:
+                return
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch, attempt = in_flight.pop(future)
+                try:
+                    embeddings, latency = future.result()
+                    self._on_success(latency)
+                    yield batch, embeddings
+                except Exception as e:
+                    self._on_error()
+                    if attempt + 1 < self.max_retries:
+                        logger.warning(f"Embedding batch of [{len(batch)}] failed, retrying: {e}")
+                        in_flight[self._submit(batch)] = (batch, attempt + 1)
+                    else:
+                        logger.error(f"Embedding batch of [{len(batch)}] failed after [{self.max_retries}] attempts: {e}")
+                        yield batch, None
+
+    def _submit(self, batch):
+        return self.executor.submit(self._embed, batch)
+
+    def _embed(self, batch):
+        start = time.perf_counter()
+        embeddings = ew_embedding_util.embed_chunks(batch, self.embedding_function)
+        return embeddings, time.perf_counter() - start
+
+    def _on_success(self, latency):
+        if latency > self.target_latency:
+            self._decrease()
+        else:
+            self.batch_size = min(self.batch_size + self.batch_step, self.max_batch_size)
+            self.concurrency = min(self.concurrency + 1, self.max_workers)
+        logger.debug(f"Latency [{latency:.2f}]s batch size [{self.batch_size}] concurrency [{self.concurrency}]")
+
+    def _on_error(self):
+        self._decrease()
+
+    def _decrease(self):
+        self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+        self.concurrency = max(self.concurrency // 2, 1)
+        logger.debug(f"Backing off, batch size [{self.batch_size}] concurrency [{self.concurrency}]")
+
+
+def take_batch(iterator, n):
+    """Pull up to n items from an iterator"""
+
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) >= n:
+            break
+    return batch
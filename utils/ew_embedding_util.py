@@ -1,18 +1,154 @@
 import logging
 import os
 import shutil
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Iterable, Iterator
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.embeddings.ollama import OllamaEmbeddings
 from langchain_community.embeddings.bedrock import BedrockEmbeddings
 from langchain.schema.document import Document
 from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
 from chromadb.config import Settings
 
+from utils import ew_cache_util
+
 logger = logging.getLogger(__name__)
 
+EMBEDDING_MODEL = "mxbai-embed-large"
+EMBEDDING_CACHE_PATH = "cache/embedding_cache.sqlite"
+EMBEDDING_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+CHUNK_SIZE = 200
+CHUNK_OVERLAP = 40
+QUERY_CACHE_SIZE = 2048
+_embedding_cache = None
+_query_cache = None
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embedding function wrapper that keeps every vector on disk.
+    Vectors are keyed by the model name, the kind of vector with the instruction the model
+    puts before the text for it, and a hash of the normalised text, so only texts never seen
+    before reach the embedding server and a query never gets the vector of a document.
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, cache: ew_cache_util.DiskCache):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._key(text, "document") for text in texts]
+        found = self.cache.get_many(keys)
+
+        # Embed the misses in one call, duplicates are only sent once
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = {key: array("f", vector).tobytes() for key, vector in zip(missing.keys(), vectors)}
+            self.cache.put_many(new_items)
+            found.update(new_items)
+        logger.debug(f"Embedding cache hit [{len(texts) - len(missing)}] miss [{len(missing)}]")
+
+        return [_unpack_vector(found[key]) for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self._key(text, "query")
+        value = self.cache.get(key)
+        if value is None:
+            vector = self.embeddings.embed_query(text)
+            value = array("f", vector).tobytes()
+            self.cache.put(key, value)
+        return _unpack_vector(value)
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """embed_query of many texts, one cache lookup and one call to the model for the misses"""
+
+        keys = [self._key(text, "query") for text in texts]
+        found = self.cache.get_many(keys)
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = embed_query_batch(self.embeddings, list(missing.values()))
+            new_items = {key: array("f", vector).tobytes() for key, vector in zip(missing.keys(), vectors)}
+            self.cache.put_many(new_items)
+            found.update(new_items)
+
+        return [_unpack_vector(found[key]) for key in keys]
+
+    def _key(self, text, kind):
+        instruction = getattr(self.embeddings, "query_instruction" if kind == "query" else "embed_instruction", None)
+        return ew_cache_util.hash_key(self.model, kind, instruction or "", ew_cache_util.normalize_text(text))
+
+
+class QueryEmbeddingCache:
+    """Bounded in-process LRU from normalised query text to query vector, with hit/miss counters"""
+
+    def __init__(self, embedding_function: Embeddings, max_size=QUERY_CACHE_SIZE):
+        self.embedding_function = embedding_function
+        self.max_size = max_size
+        self.vectors = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed_query(self, text: str) -> list[float]:
+        key = ew_cache_util.normalize_text(text)
+        with self.lock:
+            vector = self.vectors.get(key)
+            if vector is not None:
+                self.vectors.move_to_end(key)
+                self.hits += 1
+                return vector
+
+        vector = self.embedding_function.embed_query(text)
+        with self.lock:
+            self.misses += 1
+            self.vectors[key] = vector
+            self.vectors.move_to_end(key)
+            while len(self.vectors) > self.max_size:
+                self.vectors.popitem(last=False)
+        return vector
 
-def get_chroma_db(path):
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """embed_query of many texts, the misses are embedded in one batched call"""
+
+        keys = [ew_cache_util.normalize_text(text) for text in texts]
+        vectors = dict()
+        with self.lock:
+            for key in keys:
+                vector = self.vectors.get(key)
+                if vector is not None:
+                    self.vectors.move_to_end(key)
+                    vectors[key] = vector
+            self.hits += sum(1 for key in keys if key in vectors)
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing:
+            if hasattr(self.embedding_function, "embed_queries"):
+                new_vectors = self.embedding_function.embed_queries(list(missing.values()))
+            else:
+                new_vectors = embed_query_batch(self.embedding_function, list(missing.values()))
+            with self.lock:
+                self.misses += len(missing)
+                for key, vector in zip(missing.keys(), new_vectors):
+                    vectors[key] = vector
+                    self.vectors[key] = vector
+                    self.vectors.move_to_end(key)
+                while len(self.vectors) > self.max_size:
+                    self.vectors.popitem(last=False)
+
+        return [vectors[key] for key in keys]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.vectors)}
+
+
+def get_chroma_db(path, cache_embeddings=False):
     """Get DB"""
     client_settings = Settings(
         is_persistent=True,
@@ -20,7 +156,7 @@ def get_chroma_db(path):
         anonymized_telemetry=False,
     )
 
-    db = Chroma(embedding_function=get_embedding_function()
+    db = Chroma(embedding_function=get_embedding_function(cache_embeddings)
             , collection_metadata=get_embedding_similarity()
             , client_settings = client_settings)
     
@@ -31,16 +167,46 @@ def clear_chroma_db(path):
         shutil.rmtree(path)
 
 
+# Built once and shared, the splitter holds no state between calls
+_text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    length_function=len,
+    is_separator_regex=False,
+)
+
+
 def split_documents(documents: list[Document]):
     """Split document into multiple smaller chunks"""
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=200,
-        chunk_overlap=40,
-        length_function=len,
-        is_separator_regex=False,
-    )
-    return text_splitter.split_documents(documents)
+    return list(iter_split_documents(documents))
+
+
+def iter_split_documents(documents: Iterable[Document]) -> Iterator[Document]:
+    """Lazily split documents, chunks are yielded as soon as their document is split"""
+
+    for doc in documents:
+        for text in _text_splitter.split_text(doc.page_content):
+            # Metadata values are flat, a shallow copy per chunk is enough
+            yield Document(page_content=text, metadata=dict(doc.metadata))
+
+
+def iter_chunks_with_metadata(documents: Iterable[Document], page_key="mysql_id") -> Iterator[Document]:
+    """
+    Lazily split documents and stamp chunk_id, chunk_index and chunk_count on every chunk.
+    Same ids as generate_chunk_metadata, counted per document instead of comparing page ids.
+    """
+
+    for doc in documents:
+        page_id = f"{doc.metadata.get('source')}:{doc.metadata.get(page_key)}"
+        texts = _text_splitter.split_text(doc.page_content)
+        for chunk_index, text in enumerate(texts):
+            metadata = dict(doc.metadata)
+            metadata["chunk_id"] = f"{page_id}:{chunk_index}"
+            metadata["chunk_index"] = chunk_index
+            # Lets a reader tell a fully written document from one cut short
+            metadata["chunk_count"] = len(texts)
+            yield Document(page_content=text, metadata=metadata)
 
 
 def generate_chunk_metadata(chunks):
@@ -68,21 +234,141 @@ def generate_chunk_metadata(chunks):
         chunk.metadata["chunk_id"] = chunk_id
         chunk.metadata["chunk_index"] = current_chunk_index
 
+    # The last chunk index of a page gives the chunk count of all its chunks
+    chunk_counts = dict()
+    for chunk in chunks:
+        page_id = chunk.metadata["chunk_id"].rsplit(":", 1)[0]
+        chunk_counts[page_id] = max(chunk_counts.get(page_id, 0), chunk.metadata["chunk_index"] + 1)
+    for chunk in chunks:
+        chunk.metadata["chunk_count"] = chunk_counts[chunk.metadata["chunk_id"].rsplit(":", 1)[0]]
+
     return chunks
 
 def add_to_chroma(chunks: list[Document], db: Chroma): 
-    """Add to chroma """
+    """Add to chroma, returns the embeddings of the chunks"""
 
     # Generate chunk metadata.
     chunks_with_metadata = generate_chunk_metadata(chunks)
-    db.add_documents(chunks_with_metadata)
+    embeddings = embed_chunks(chunks_with_metadata, db.embeddings)
+    add_embedded_to_chroma(chunks_with_metadata, embeddings, db)
+    return embeddings
+
+
+def upsert_to_chroma(chunks: list[Document], db: Chroma):
+    """
+    Overwrite the chunks of the films in place, keyed on their deterministic chunk id.
+    Chunks left over from a longer previous version of a film are deleted afterwards.
+    Returns the embeddings of the chunks.
+    """
+
+    chunks_with_metadata = generate_chunk_metadata(chunks)
+    ids = [chunk.metadata["chunk_id"] for chunk in chunks_with_metadata]
+    film_ids = sorted({chunk.metadata["mysql_id"] for chunk in chunks_with_metadata})
+
+    existing = db.get(where={"mysql_id": {"$in": film_ids}}, include=[])
+    new_ids = set(ids)
+    stale_ids = [vector_id for vector_id in existing.get("ids") if vector_id not in new_ids]
+
+    embeddings = embed_chunks(chunks_with_metadata, db.embeddings)
+    add_embedded_to_chroma(chunks_with_metadata, embeddings, db)
+    if stale_ids:
+        db.delete(stale_ids)
+    logger.debug(f"Upserted [{len(ids)}] chunks, deleted stale chunks {stale_ids}")
+    return embeddings
+
 
+def embed_chunks(chunks: list[Document], embedding_function=None):
+    """Embed the content of many chunks with a single embedding call"""
 
-def get_embedding_function():
-    """Use offline embedding provided by Ollama"""
+    if embedding_function is None:
+        embedding_function = get_embedding_function()
+
+    texts = [chunk.page_content for chunk in chunks]
+    return embedding_function.embed_documents(texts)
+
+
+def add_embedded_to_chroma(chunks: list[Document], embeddings, db: Chroma):
+    """Write already embedded chunks to chroma with a single bulk call, keyed on their chunk id"""
+
+    if len(chunks) == 0:
+        return
+
+    ids = [chunk.metadata["chunk_id"] for chunk in chunks]
+    db._collection.upsert(
+        ids=ids,
+        embeddings=embeddings,
+        metadatas=[chunk.metadata for chunk in chunks],
+        documents=[chunk.page_content for chunk in chunks],
+    )
+
+
+def get_embedding_function(cache=False):
+    """Use offline embedding provided by Ollama, optionally behind a persistent cache"""
     
-    embeddings = OllamaEmbeddings(model="mxbai-embed-large")
+    embeddings = OllamaEmbeddings(model=EMBEDDING_MODEL)
+    if cache:
+        return CachedEmbeddings(embeddings, EMBEDDING_MODEL, _get_embedding_cache())
     return embeddings
 
+
+def embed_query_batch(embeddings: Embeddings, texts: list[str]) -> list[list[float]]:
+    """Query vectors of many texts in one request to the model"""
+
+    # OllamaEmbeddings only batches documents, its query prefix is applied by hand to batch queries
+    instruction = getattr(embeddings, "query_instruction", None)
+    if instruction is not None and hasattr(embeddings, "_embed"):
+        return embeddings._embed([f"{instruction}{text}" for text in texts])
+    return [embeddings.embed_query(text) for text in texts]
+
+
+def _get_embedding_cache():
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = ew_cache_util.DiskCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_BYTES)
+    return _embedding_cache
+
+
+def _unpack_vector(value):
+    vector = array("f")
+    vector.frombytes(value)
+    return vector.tolist()
+
+
+def get_query_embedding_cache():
+    """Process wide query embedding LRU, misses go through the persistent embedding cache"""
+
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = QueryEmbeddingCache(get_embedding_function(cache=True))
+    return _query_cache
+
+
+def similarity_search_with_score(db: Chroma, query: str, k: int, filter=None):
+    """Same result as db.similarity_search_with_score, the query vector comes from the LRU"""
+
+    query_cache = get_query_embedding_cache()
+    vector = query_cache.embed_query(query)
+    logger.debug(f"Query embedding cache {query_cache.stats()}")
+    return db.similarity_search_by_vector_with_relevance_scores(vector, k, filter=filter)
+
+
+def similarity_search_many(db: Chroma, queries: list[str], k: int, filter=None):
+    """similarity_search_with_score of many queries, embedded in one call and sent as one chroma query"""
+
+    query_cache = get_query_embedding_cache()
+    vectors = query_cache.embed_queries(queries)
+    logger.debug(f"Query embedding cache {query_cache.stats()}")
+    if not vectors:
+        return []
+
+    results = db._collection.query(query_embeddings=vectors
+                                   , n_results=k
+                                   , where=filter
+                                   , include=["documents", "metadatas", "distances"])
+    return [[(Document(page_content=document, metadata=metadata), distance)
+             for document, metadata, distance in zip(documents, metadatas, distances)]
+            for documents, metadatas, distances in zip(results["documents"], results["metadatas"], results["distances"])]
+
+
 def get_embedding_similarity():
     return {"hnsw:space": "cosine"}
@@ -0,0 +1,114 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Constant of reciprocal rank fusion, dampens the lead of the very first ranks
+RRF_K = 60
+
+
+def fuse(legs, weights, strategy="weighted", normalize=None, primary=None, rrf_k=RRF_K):
+    """
+    Combine ranked lists of (ids, scores) into one list, best first.
+
+    strategy
+        weighted : sum of weight * score, an item missing from a leg scores 0 there
+        rrf      : sum of weight / (rrf_k + rank), scores only decide the rank inside a leg
+        max      : best weight * score over the legs
+    normalize
+        None     : scores are used as they are
+        max      : every leg divided by its best score
+        minmax   : every leg rescaled to 0 ~ 1
+    primary
+        Index of a leg, items missing from it keep their best raw score instead of being fused.
+        reranking_agent uses the MySQL leg so chroma only items keep their chroma score.
+
+    Ties keep the order in which items first appear in the legs.
+    Returns (ids, scores) as arrays.
+    """
+
+    legs = [(np.asarray(ids), np.asarray(scores, dtype=np.float64)) for ids, scores in legs]
+    weights = np.asarray(weights, dtype=np.float64)
+    if len(legs) != len(weights):
+        raise ValueError(f"Got [{len(legs)}] legs for [{len(weights)}] weights")
+
+    all_ids = np.concatenate([ids for ids, _ in legs]) if legs else np.empty(0)
+    if len(all_ids) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    # Number the union of ids in order of first appearance
+    unique_ids, first, inverse = np.unique(all_ids, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    slot_of = np.empty(len(order), dtype=np.int64)
+    slot_of[order] = np.arange(len(order))
+    union_ids = unique_ids[order]
+
+    raw = np.zeros((len(union_ids), len(legs)))
+    present = np.zeros((len(union_ids), len(legs)), dtype=bool)
+    values = np.zeros((len(union_ids), len(legs)))
+    offset = 0
+    for i, (ids, scores) in enumerate(legs):
+        slots = slot_of[inverse[offset:offset + len(ids)]]
+        offset += len(ids)
+        if len(ids) == 0:
+            continue
+
+        # A leg holding an id twice keeps its best score
+        best = np.full(len(union_ids), -np.inf)
+        np.maximum.at(best, slots, scores)
+        raw[:, i] = np.where(np.isfinite(best), best, 0)
+        present[slots, i] = True
+
+        if strategy == "rrf":
+            ranks = np.empty(len(ids))
+            ranks[np.argsort(-scores, kind="stable")] = np.arange(1, len(ids) + 1)
+            rank = np.full(len(union_ids), np.inf)
+            np.minimum.at(rank, slots, ranks)
+            values[:, i] = np.where(present[:, i], 1 / (rrf_k + rank), 0)
+        else:
+            values[:, i] = _normalize(raw[:, i], present[:, i], normalize)
+
+    if strategy == "weighted" or strategy == "rrf":
+        fused = values @ weights
+    elif strategy == "max":
+        fused = np.where(present, values * weights, -np.inf).max(axis=1)
+    else:
+        raise ValueError(f"Unknown fusion strategy [{strategy}]")
+
+    if primary is not None:
+        outside = ~present[:, primary]
+        fused[outside] = np.where(present[outside], raw[outside], -np.inf).max(axis=1)
+
+    ranking = np.argsort(-fused, kind="stable")
+    return union_ids[ranking], fused[ranking]
+
+
+def from_items(items, id_key="item_id", score_key="score"):
+    """Arrays of ids and scores out of a list of {item_id, score}"""
+
+    ids = np.fromiter((item[id_key] for item in items), dtype=np.int64, count=len(items))
+    scores = np.fromiter((item[score_key] for item in items), dtype=np.float64, count=len(items))
+    return ids, scores
+
+
+def to_items(ids, scores, id_key="item_id", score_key="score"):
+    """List of {item_id, score} out of arrays of ids and scores"""
+
+    return [{id_key: item_id, score_key: score} for item_id, score in zip(ids.tolist(), scores.tolist())]
+
+
+def _normalize(scores, present, normalize):
+    if normalize is None or not present.any():
+        return scores
+
+    found = scores[present]
+    if normalize == "max":
+        top = found.max()
+        return scores / top if top else scores
+    if normalize == "minmax":
+        low, high = found.min(), found.max()
+        if high == low:
+            return np.where(present, 1.0, 0.0)
+        return np.where(present, (scores - low) / (high - low), 0.0)
+    raise ValueError(f"Unknown normalization [{normalize}]")
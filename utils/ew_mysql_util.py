@@ -1,8 +1,30 @@
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import mysql.connector
+from mysql.connector import errors
 
 logger = logging.getLogger(__name__)
 
+# Global variable start
+# Connections opened by a pool at most, borrowers wait when all of them are in use
+POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", "8"))
+# Seconds a borrower waits for a free connection
+POOL_TIMEOUT = 30
+# Idle connections older than this many seconds are closed
+IDLE_TIMEOUT = 300
+# Connections idle longer than this many seconds are pinged before being handed out
+HEALTH_CHECK_AFTER = 30
+# Prepared statements kept open per connection, the least recently used one is closed first
+MAX_PREPARED = 16
+# Errors after which a connection is dropped and a read is retried on a new one
+CONNECTION_ERRORS = (errors.OperationalError, errors.InterfaceError)
+# Global variable ends
+
 def get_mysql_conn():
     """Get MySQL DB Connection"""
 
@@ -12,5 +34,203 @@ def get_mysql_conn():
         password="sakila",
         database="sakila"
     )
-    
+
     return mysql_conn
+
+
+class MySQLPool:
+    """
+    Thread safe pool of MySQL connections, opened on demand up to `size`.
+
+    A connection idle for more than `check_after` seconds is pinged before it is handed out
+    and replaced by a new one when it is gone, one idle for more than `idle_timeout` is closed.
+    `execute` and `iter_key_pages` run read statements as server-side prepared statements,
+    every connection keeps its prepared cursors so a statement is only prepared once per connection.
+    Statements are keyed by their SQL string, pass module constants like the ones of film.io.film_statements.
+    """
+
+    def __init__(self, size=POOL_SIZE, timeout=POOL_TIMEOUT, idle_timeout=IDLE_TIMEOUT
+                 , check_after=HEALTH_CHECK_AFTER, connect=get_mysql_conn):
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.connect = connect
+        self._idle = list()
+        self._in_use = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for ad hoc statements, it goes back to the pool when the block exits"""
+
+        pooled = self._acquire()
+        try:
+            yield pooled.conn
+        except CONNECTION_ERRORS:
+            self._discard(pooled)
+            raise
+        except BaseException:
+            self._release(pooled)
+            raise
+        self._release(pooled)
+
+    def execute(self, statement, params=(), dictionary=True):
+        """All rows of a prepared read statement, retried once on a new connection when the connection was lost"""
+
+        for attempt in (1, 2):
+            pooled = self._acquire()
+            try:
+                cursor = pooled.prepared(statement, dictionary)
+                cursor.execute(statement, params)
+                rows = cursor.fetchall()
+            except CONNECTION_ERRORS as e:
+                self._discard(pooled)
+                if attempt == 2:
+                    raise
+                logger.warning(f"MySQL connection lost, retrying on a new one. Error: {e}")
+                continue
+            except BaseException:
+                self._release(pooled)
+                raise
+            self._release(pooled)
+            return rows
+
+    def iter_key_pages(self, statement, last_key, params=(), fetch_size=1000):
+        """
+        Rows of a keyset paged read statement as lists of at most fetch_size tuples.
+
+        The statement takes (last_key, *params, fetch_size), orders by a key in its first column
+        and returns the rows after last_key. Every page is a short statement read to the end,
+        no result stays open on the server while the caller works on a page, so a slow caller
+        never runs into net_write_timeout.
+        """
+
+        while True:
+            rows = self.execute(statement, (last_key, *params, fetch_size), dictionary=False)
+            if not rows:
+                return
+            yield rows
+            if len(rows) < fetch_size:
+                return
+            last_key = rows[-1][0]
+
+    def close(self):
+        """Close the idle connections, borrowed ones are closed when they come back"""
+
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, list()
+            self._condition.notify_all()
+        for pooled in idle:
+            pooled.close()
+
+    def stats(self):
+        with self._condition:
+            return {"idle": len(self._idle), "in_use": self._in_use, "size": self.size}
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise errors.PoolError("MySQL pool is closed")
+                self._evict_idle()
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._in_use < self.size:
+                    pooled = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise errors.PoolError(f"No free MySQL connection after [{self.timeout}]s, [{self.size}] in use")
+                self._condition.wait(remaining)
+            self._in_use += 1
+
+        # Connecting and pinging happen outside the lock, other borrowers are not held up
+        try:
+            if pooled is not None and time.monotonic() - pooled.released_at > self.check_after and not pooled.is_alive():
+                logger.info("Replacing a dead MySQL connection")
+                pooled.close()
+                pooled = None
+            if pooled is None:
+                pooled = _PooledConnection(self.connect())
+        except BaseException:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+        return pooled
+
+    def _release(self, pooled):
+        try:
+            # A pending result breaks the next statement, an open transaction keeps an old read snapshot
+            if pooled.conn.unread_result:
+                pooled.conn.consume_results()
+            if pooled.conn.in_transaction:
+                pooled.conn.rollback()
+        except Exception as e:
+            logger.warning(f"Dropping a MySQL connection that could not be reset. Error: {e}")
+            self._discard(pooled)
+            return
+
+        pooled.released_at = time.monotonic()
+        with self._condition:
+            self._in_use -= 1
+            if self._closed:
+                pooled.close()
+            else:
+                self._idle.append(pooled)
+            self._condition.notify()
+
+    def _discard(self, pooled):
+        pooled.close()
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify()
+
+    def _evict_idle(self):
+        # Idle connections are appended on release, the oldest ones come first
+        now = time.monotonic()
+        while self._idle and now - self._idle[0].released_at > self.idle_timeout:
+            self._idle.pop(0).close()
+            logger.debug("Closed an idle MySQL connection")
+
+
+class _PooledConnection:
+    """A pooled connection with its prepared cursors"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.released_at = time.monotonic()
+        self.cursors = OrderedDict()
+
+    def prepared(self, statement, dictionary):
+        key = (statement, dictionary)
+        cursor = self.cursors.get(key)
+        if cursor is None:
+            cursor = self.conn.cursor(prepared=True, dictionary=dictionary)
+            self.cursors[key] = cursor
+            if len(self.cursors) > MAX_PREPARED:
+                _, oldest = self.cursors.popitem(last=False)
+                oldest.close()
+        else:
+            self.cursors.move_to_end(key)
+        return cursor
+
+    def is_alive(self):
+        try:
+            self.conn.ping(reconnect=False)
+            return True
+        except errors.Error:
+            return False
+
+    def close(self):
+        try:
+            for cursor in self.cursors.values():
+                cursor.close()
+            self.conn.close()
+        except Exception as e:
+            logger.debug(f"Error closing a MySQL connection: {e}")
@@ -0,0 +1,191 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils import ew_store_util
+from utils.ew_vector_index_util import normalize
+
+logger = logging.getLogger(__name__)
+
+NEIGHBOURS = 20
+BLOCK_SIZE = 1024
+
+
+class NeighbourTable:
+    """
+    Precomputed top-N nearest films of every film, by cosine similarity of film vectors.
+
+    `film_ids.npy` is sorted so a lookup is one `searchsorted` into the memory-mapped
+    `neighbours.npy` / `scores.npy` rows, -1 pads films with fewer neighbours.
+    `vectors.npy` keeps the film vectors for incremental updates, a film that changes
+    gets its row recomputed along with every row it enters or leaves.
+
+    The path is an ew_store_util store, its manifest names the current `table-*`
+    directory holding the four arrays. Every change writes a new directory and switches
+    the manifest under the store file lock, after reloading what other processes wrote.
+    Readers reload once the manifest changed, never seeing arrays of two versions.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._stamp = None
+        if ew_store_util.load_current(path, self._load) is None:
+            raise FileNotFoundError(f"No neighbour table built at [{path}]")
+
+    @classmethod
+    def build(cls, path, film_ids, vectors, n_neighbours=NEIGHBOURS, block_size=BLOCK_SIZE):
+        """Compute the table of normalised film vectors, `block_size` rows of the similarity matrix at a time"""
+
+        order = np.argsort(film_ids)
+        film_ids = np.asarray(film_ids, dtype=np.int64)[order]
+        vectors = normalize(np.asarray(vectors, dtype=np.float32)[order])
+
+        neighbours, scores = _top_rows(vectors, np.arange(len(film_ids)), film_ids, n_neighbours, block_size)
+        with ew_store_util.file_lock(path):
+            _save(path, film_ids, vectors, neighbours, scores)
+        return cls(path)
+
+    def lookup(self, film_id, n=None):
+        """Nearest films of a film as (film_id, similarity), best first, empty when the film is unknown"""
+
+        self._reload_if_changed()
+        row = self._row(film_id)
+        if row is None:
+            return []
+        neighbours, scores = self.neighbours[row], self.scores[row]
+        count = int((neighbours >= 0).sum()) if n is None else min(n, int((neighbours >= 0).sum()))
+        return list(zip(neighbours[:count].tolist(), scores[:count].tolist()))
+
+    def upsert(self, film_ids, vectors):
+        """Add or replace the vectors of some films and fix every row they affect"""
+
+        with self._writing():
+            film_ids = np.asarray(film_ids, dtype=np.int64)
+            vectors = normalize(np.asarray(vectors, dtype=np.float32))
+            all_ids, all_vectors = np.array(self.film_ids), np.array(self.vectors)
+            n_neighbours = self.neighbours.shape[1] if self.neighbours.ndim == 2 else NEIGHBOURS
+
+            # Rows holding a changed film may lose it, new vectors may enter any row, both are recomputed
+            keep = ~np.isin(all_ids, film_ids)
+            affected_ids = set(all_ids[np.isin(self.neighbours, film_ids).any(axis=1)].tolist())
+            if len(all_ids) and len(vectors):
+                worst = np.where(self.neighbours >= 0, self.scores, -np.inf).min(axis=1)
+                worst = np.where((self.neighbours >= 0).sum(axis=1) < n_neighbours, -np.inf, worst)
+                entering = (all_vectors @ vectors.T > worst[:, None]).any(axis=1)
+                affected_ids.update(all_ids[entering].tolist())
+
+            new_ids = np.concatenate([all_ids[keep], film_ids])
+            new_vectors = np.concatenate([all_vectors[keep], vectors]) if len(all_vectors) else vectors
+            order = np.argsort(new_ids)
+            new_ids, new_vectors = new_ids[order], new_vectors[order]
+            self._rewrite(new_ids, new_vectors, affected_ids | set(film_ids.tolist()), n_neighbours)
+
+    def delete(self, film_ids):
+        """Drop some films and recompute the rows they were a neighbour in"""
+
+        with self._writing():
+            film_ids = np.asarray(film_ids, dtype=np.int64)
+            keep = ~np.isin(self.film_ids, film_ids)
+            if keep.all():
+                return
+            affected_ids = set(np.asarray(self.film_ids)[np.isin(self.neighbours, film_ids).any(axis=1)].tolist())
+            n_neighbours = self.neighbours.shape[1]
+            self._rewrite(np.array(self.film_ids)[keep], np.array(self.vectors)[keep], affected_ids, n_neighbours)
+
+    def _rewrite(self, film_ids, vectors, recompute_ids, n_neighbours):
+        """Carry over the unaffected rows, recompute the others, then save"""
+
+        neighbours = np.full((len(film_ids), n_neighbours), -1, dtype=np.int64)
+        scores = np.zeros((len(film_ids), n_neighbours), dtype=np.float32)
+        recompute = np.isin(film_ids, list(recompute_ids))
+        if len(self.film_ids):
+            old_rows = np.minimum(np.searchsorted(self.film_ids, film_ids), len(self.film_ids) - 1)
+            carried = (self.film_ids[old_rows] == film_ids) & ~recompute
+            neighbours[carried], scores[carried] = self.neighbours[old_rows[carried]], self.scores[old_rows[carried]]
+
+        rows = np.flatnonzero(recompute)
+        neighbours[rows], scores[rows] = _top_rows(vectors, rows, film_ids, n_neighbours)
+        _save(self.path, film_ids, vectors, neighbours, scores)
+        self._reload_if_changed(locked=True)
+        logger.debug(f"Recomputed [{len(rows)}] rows of [{len(film_ids)}] films")
+
+    def _row(self, film_id):
+        row = int(np.searchsorted(self.film_ids, film_id))
+        if row < len(self.film_ids) and self.film_ids[row] == film_id:
+            return row
+        return None
+
+    @contextmanager
+    def _writing(self):
+        # One writer at a time across processes, working on what the others wrote last
+        with self.lock, ew_store_util.file_lock(self.path):
+            self._reload_if_changed(locked=True)
+            yield
+
+    def _load(self, manifest, stamp):
+        """Load the arrays of the directory a manifest names"""
+
+        table_path = os.path.join(self.path, manifest["table"])
+        film_ids = np.load(os.path.join(table_path, "film_ids.npy"))
+        vectors = np.load(os.path.join(table_path, "vectors.npy"), mmap_mode="r")
+        neighbours = np.load(os.path.join(table_path, "neighbours.npy"), mmap_mode="r")
+        scores = np.load(os.path.join(table_path, "scores.npy"), mmap_mode="r")
+
+        # Everything is read before anything is swapped, a failed load leaves the table as it was
+        self.film_ids, self.vectors, self.neighbours, self.scores = film_ids, vectors, neighbours, scores
+        self._stamp = stamp
+        return True
+
+    def _reload_if_changed(self, locked=False):
+        if ew_store_util.manifest_stamp(self.path) == self._stamp:
+            return
+        if locked:
+            ew_store_util.load_current(self.path, self._load)
+        else:
+            with self.lock:
+                logger.debug(f"Reloading [{self.path}]")
+                ew_store_util.load_current(self.path, self._load)
+
+
+def film_vectors(mysql_ids, embeddings):
+    """Mean of the normalised chunk vectors of every film, as (film_ids, normalised film vectors)"""
+
+    film_ids, groups = np.unique(np.asarray(mysql_ids, dtype=np.int64), return_inverse=True)
+    sums = np.zeros((len(film_ids), embeddings.shape[1]), dtype=np.float32)
+    np.add.at(sums, groups, normalize(np.asarray(embeddings, dtype=np.float32)))
+    return film_ids, normalize(sums)
+
+
+def _top_rows(vectors, rows, film_ids, n_neighbours, block_size=BLOCK_SIZE):
+    """Top neighbours of the given rows, the film itself excluded"""
+
+    neighbours = np.full((len(rows), n_neighbours), -1, dtype=np.int64)
+    scores = np.zeros((len(rows), n_neighbours), dtype=np.float32)
+    n = min(n_neighbours, len(film_ids) - 1)
+    if n <= 0:
+        return neighbours, scores
+
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        similarities = vectors[block] @ vectors.T
+        similarities[np.arange(len(block)), block] = -np.inf
+        top = np.argpartition(-similarities, n - 1, axis=1)[:, :n]
+        top_scores = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        neighbours[start:start + len(block), :n] = film_ids[np.take_along_axis(top, order, axis=1)]
+        scores[start:start + len(block), :n] = np.take_along_axis(top_scores, order, axis=1)
+    return neighbours, scores
+
+
+def _save(path, film_ids, vectors, neighbours, scores):
+    """Write the arrays into a new table directory and switch the manifest to it, the store lock is held"""
+
+    table_name = ew_store_util.new_version("table")
+    table_path = os.path.join(path, table_name)
+    for name, array in (("film_ids", film_ids), ("vectors", vectors), ("neighbours", neighbours), ("scores", scores)):
+        ew_store_util.save_array(table_path, name, array)
+    ew_store_util.write_manifest(path, {"table": table_name})
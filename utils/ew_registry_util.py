@@ -0,0 +1,54 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Global variable start
+_resources = dict()
+_lock = threading.Lock()
+# Global variable ends
+
+
+def get_or_create(key, factory):
+    """Process wide instance stored under key, created by factory on first use"""
+
+    resource = _resources.get(key)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(key)
+            if resource is None:
+                resource = factory()
+                _resources[key] = resource
+                logger.debug(f"Created shared resource {key}")
+    return resource
+
+
+def get_chroma_db(path, cache_embeddings=False):
+    """Shared chroma client of a collection path"""
+
+    from utils import ew_embedding_util
+    return get_or_create(("chroma", path, cache_embeddings)
+                         , lambda: ew_embedding_util.get_chroma_db(path, cache_embeddings=cache_embeddings))
+
+
+def get_embedding_function(cache=False):
+    """Shared embedding client, optionally behind the persistent embedding cache"""
+
+    from utils import ew_embedding_util
+    return get_or_create(("embedding", cache), lambda: ew_embedding_util.get_embedding_function(cache=cache))
+
+
+def get_mysql_pool():
+    """Shared MySQL connection pool"""
+
+    from utils import ew_mysql_util
+    return get_or_create(("mysql",), ew_mysql_util.MySQLPool)
+
+
+def close_mysql_pool():
+    """Close the shared MySQL pool, the next get_mysql_pool opens a new one"""
+
+    with _lock:
+        mysql_pool = _resources.pop(("mysql",), None)
+    if mysql_pool is not None:
+        mysql_pool.close()
@@ -0,0 +1,138 @@
+"""
+On-disk stores shared by several processes.
+
+A store is a directory whose `manifest` names the versioned files and directories
+that make up its current state. Files are never rewritten in place: a writer writes
+a new version next to the current one, switches the manifest with `os.replace`,
+then removes the versions no longer named. Readers keep memory maps of the old
+version valid since an unlinked file lives on while it is mapped, and reload
+once `manifest_stamp` changes. Writers serialise on `file_lock` and reload before
+changing anything, so no process overwrites the change of another.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest"
+LOCK = "lock"
+# Attempts of a reader racing a writer that removed the version it was about to open
+LOAD_ATTEMPTS = 5
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock of the store at path, across threads and processes"""
+
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, LOCK), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def manifest_stamp(path):
+    """Identity of the current manifest, None when the store was never written"""
+
+    try:
+        stat = os.stat(os.path.join(path, MANIFEST))
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def read_manifest(path):
+    """The manifest dict and its stamp, (None, None) when the store was never written"""
+
+    try:
+        with open(os.path.join(path, MANIFEST), "r", encoding="utf-8") as f:
+            stamp = os.fstat(f.fileno())
+            return json.load(f), (stamp.st_ino, stamp.st_mtime_ns)
+    except FileNotFoundError:
+        return None, None
+
+
+def write_manifest(path, manifest):
+    """Switch the store to manifest atomically, then drop the versions it does not name"""
+
+    tmp_path = os.path.join(path, f"{MANIFEST}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(path, MANIFEST))
+    remove_unnamed(path, manifest)
+
+
+def load_current(path, loader):
+    """
+    loader(manifest, stamp) of the current manifest, retried when a writer removed
+    the version in between. None when the store was never written.
+    """
+
+    for attempt in range(LOAD_ATTEMPTS):
+        manifest, stamp = read_manifest(path)
+        if manifest is None:
+            return None
+        try:
+            return loader(manifest, stamp)
+        except FileNotFoundError:
+            if attempt == LOAD_ATTEMPTS - 1:
+                raise
+            logger.debug(f"Version of [{path}] replaced while loading, retrying")
+            time.sleep(0.01 * (attempt + 1))
+
+
+def new_version(prefix, suffix=""):
+    """Unique name of a new version"""
+
+    return f"{prefix}-{time.time_ns()}-{os.getpid()}{suffix}"
+
+
+def save_array(directory, name, array):
+    """np.save into a new file of a version directory, written aside then renamed"""
+
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f"{name}.{os.getpid()}.tmp.npy")
+    np.save(tmp_path, array)
+    os.replace(tmp_path, os.path.join(directory, f"{name}.npy"))
+
+
+def link_or_copy(source, target):
+    """Share an unchanged file of the previous version with a new version"""
+
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def remove_unnamed(path, manifest):
+    """Remove the versions of the store the manifest does not name"""
+
+    named = set()
+    for value in manifest.values():
+        if isinstance(value, str):
+            named.add(value)
+        elif isinstance(value, list):
+            named.update(value)
+    for entry in os.listdir(path):
+        if entry in named or entry in (MANIFEST, LOCK) or ".tmp" in entry or "-" not in entry:
+            continue
+        entry_path = os.path.join(path, entry)
+        try:
+            if os.path.isdir(entry_path):
+                shutil.rmtree(entry_path)
+            else:
+                os.remove(entry_path)
+        except FileNotFoundError:
+            pass
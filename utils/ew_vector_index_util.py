@@ -0,0 +1,418 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from utils import ew_store_util
+
+logger = logging.getLogger(__name__)
+
+RESCORE_FACTOR = 10
+# Rows read at a time when the int8 copy is built
+SCAN_BLOCK_SIZE = 65536
+# Rows of the int8 copy upcast at a time by a query, 256 x 1024 dimensions is a 1MB float32 buffer that stays in cache
+QUANTIZED_BLOCK_SIZE = 256
+# The delta is folded into the export once it holds this share of the exported rows, at least COMPACT_MIN_ROWS,
+# a load through the delta then rewrites the export a logarithmic number of times
+COMPACT_RATIO = 0.25
+COMPACT_MIN_ROWS = 20000
+# Delta segments kept before they are merged into one, bounds the files a reader replays
+MAX_DELTA_SEGMENTS = 64
+
+
+class NumpyVectorIndex:
+    """
+    Exact cosine search over the chunk embeddings of a chroma collection.
+
+    The export is a normalised float32 matrix in `embeddings.npy`, memory-mapped
+    read only, with the parallel arrays `mysql_ids.npy` and `chunk_indexes.npy`.
+    A top-k query is one matrix-vector product plus `argpartition`.
+
+    Inserts, updates and deletes go to a small delta: films in `tombstones` are masked
+    out of the exported matrix and their current chunks live in the delta arrays.
+    Every change appends one `delta-*.npz` segment holding only that change, the delta
+    is the replay of the segments in order. `compact` folds the delta back into the export,
+    it runs by itself once the delta grows past COMPACT_RATIO of the export.
+
+    The path is an ew_store_util store, its manifest names the current `base-*`
+    directory and delta segments. Every change writes new versions and switches the
+    manifest under the store file lock, after reloading what other processes wrote.
+    Readers reload the base once it changed and replay the segments they have not seen.
+
+    `quantize` adds an int8 copy of the matrix with one scale per dimension.
+    `search_quantized` scans that copy for the first pass and only reads the
+    full precision rows of the best candidates to rescore them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._stamp = None
+        self._base_name = None
+        self._segments = []
+        if ew_store_util.load_current(path, self._load) is None:
+            raise FileNotFoundError(f"No index exported at [{path}]")
+
+    @classmethod
+    def export(cls, db, path, page_size=5000):
+        """Dump every chunk embedding of a chroma collection, normalised, into a new index"""
+
+        os.makedirs(path, exist_ok=True)
+        vectors, mysql_ids, chunk_indexes = [], [], []
+        offset = 0
+        while True:
+            page = db.get(include=["embeddings", "metadatas"], limit=page_size, offset=offset)
+            ids = page.get("ids")
+            if not ids:
+                break
+            vectors.append(np.asarray(page.get("embeddings"), dtype=np.float32))
+            for metadata in page.get("metadatas"):
+                mysql_ids.append(metadata["mysql_id"])
+                chunk_indexes.append(metadata.get("chunk_index", 0))
+            offset += len(ids)
+            logger.info(f"Exported [{offset}] chunk embeddings")
+
+        embeddings = normalize(np.concatenate(vectors)) if vectors else np.zeros((0, 0), dtype=np.float32)
+        with ew_store_util.file_lock(path):
+            base_name = ew_store_util.new_version("base")
+            _save_base(os.path.join(path, base_name), embeddings
+                       , np.asarray(mysql_ids, dtype=np.int64), np.asarray(chunk_indexes, dtype=np.int32))
+            ew_store_util.write_manifest(path, {"base": base_name, "segments": []})
+        return cls(path)
+
+    def search(self, vector, k):
+        """Return the top k chunks as (mysql_id, chunk_index, cosine distance), closest first"""
+
+        self._reload_if_changed()
+        query = normalize(np.asarray(vector, dtype=np.float32))
+
+        with self.lock:
+            scores = self.embeddings @ query if len(self.embeddings) else np.zeros(0, dtype=np.float32)
+            if self.alive is not None:
+                scores = np.where(self.alive, scores, -np.inf)
+            mysql_ids, chunk_indexes = self.mysql_ids, self.chunk_indexes
+            if len(self.delta_mysql_ids):
+                scores = np.concatenate([scores, self.delta_embeddings @ query])
+                mysql_ids = np.concatenate([mysql_ids, self.delta_mysql_ids])
+                chunk_indexes = np.concatenate([chunk_indexes, self.delta_chunk_indexes])
+
+        return top_k(scores, mysql_ids, chunk_indexes, k)
+
+    def search_quantized(self, vector, k, rescore_factor=RESCORE_FACTOR):
+        """
+        Same result shape as `search`. The top k * rescore_factor chunks of the int8 scan
+        are rescored against their full precision rows before the final top k.
+        """
+
+        if self.quantized is None:
+            return self.search(vector, k)
+
+        self._reload_if_changed()
+        query = normalize(np.asarray(vector, dtype=np.float32))
+
+        with self.lock:
+            # Fold the scales into the query, the int8 matrix is upcast a few hundred rows at a time
+            # into one reused buffer, so a query never holds more than one small float32 block
+            scaled_query = query * self.scales
+            scores = np.empty(len(self.quantized), dtype=np.float32)
+            buffer = np.empty((min(QUANTIZED_BLOCK_SIZE, len(self.quantized)), self.quantized.shape[1]), dtype=np.float32)
+            for start in range(0, len(self.quantized), QUANTIZED_BLOCK_SIZE):
+                block = self.quantized[start:start + QUANTIZED_BLOCK_SIZE]
+                upcast = buffer[:len(block)]
+                upcast[...] = block
+                np.matmul(upcast, scaled_query, out=scores[start:start + len(block)])
+            if self.alive is not None:
+                scores = np.where(self.alive, scores, -np.inf)
+
+            n_candidates = min(k * rescore_factor, int(np.isfinite(scores).sum()))
+            if n_candidates > 0:
+                candidates = np.sort(np.argpartition(-scores, n_candidates - 1)[:n_candidates])
+                exact_scores = np.asarray(self.embeddings[candidates]) @ query
+            else:
+                candidates = np.zeros(0, dtype=np.int64)
+                exact_scores = np.zeros(0, dtype=np.float32)
+
+            mysql_ids, chunk_indexes = self.mysql_ids[candidates], self.chunk_indexes[candidates]
+            if len(self.delta_mysql_ids):
+                exact_scores = np.concatenate([exact_scores, self.delta_embeddings @ query])
+                mysql_ids = np.concatenate([mysql_ids, self.delta_mysql_ids])
+                chunk_indexes = np.concatenate([chunk_indexes, self.delta_chunk_indexes])
+
+        return top_k(exact_scores, mysql_ids, chunk_indexes, k)
+
+    def quantize(self):
+        """Write the int8 copy of the exported matrix, with a symmetric scale per dimension"""
+
+        with self._writing():
+            base_name = ew_store_util.new_version("base")
+            base_path = os.path.join(self.path, base_name)
+            os.makedirs(base_path)
+            # The float32 files do not change, the new version shares them
+            for name in ("embeddings.npy", "mysql_ids.npy", "chunk_indexes.npy"):
+                ew_store_util.link_or_copy(os.path.join(self.path, self._base_name, name), os.path.join(base_path, name))
+            _save_quantized(base_path, self.embeddings)
+            ew_store_util.write_manifest(self.path, {"base": base_name, "segments": self._segments})
+            self._reload_if_changed(locked=True)
+
+    def recall(self, queries, k, rescore_factor=RESCORE_FACTOR):
+        """
+        Mean recall@k of the quantized search against the exact search.
+        Use held-out query vectors, an indexed vector finds itself and inflates the recall.
+        """
+
+        recalls = list()
+        for query in queries:
+            exact = {(mysql_id, chunk_index) for mysql_id, chunk_index, _ in self.search(query, k)}
+            approximate = {(mysql_id, chunk_index) for mysql_id, chunk_index, _ in self.search_quantized(query, k, rescore_factor)}
+            recalls.append(len(exact & approximate) / len(exact) if exact else 1.0)
+        return float(np.mean(recalls)) if recalls else 1.0
+
+    def upsert(self, mysql_ids, chunk_indexes, vectors, replace_films=True):
+        """
+        Write chunks to the delta, their films are hidden from the exported matrix.
+        With replace_films every earlier chunk of the films is dropped, otherwise only the chunks
+        with the same (mysql_id, chunk_index), so the chunks of a film can arrive over several calls.
+        """
+
+        mysql_ids = np.asarray(mysql_ids, dtype=np.int64)
+        chunk_indexes = np.asarray(chunk_indexes, dtype=np.int32)
+        vectors = normalize(np.asarray(vectors, dtype=np.float32)).reshape(len(mysql_ids), -1)
+        film_ids = np.unique(mysql_ids)
+        if replace_films:
+            segment = _segment(tombstones=film_ids, drop_films=film_ids)
+        else:
+            segment = _segment(tombstones=film_ids, drop_chunks=_chunk_keys(mysql_ids, chunk_indexes))
+        segment.update(mysql_ids=mysql_ids, chunk_indexes=chunk_indexes, embeddings=vectors)
+        with self._writing():
+            self._append_segment(segment)
+
+    def delete(self, mysql_ids):
+        film_ids = np.unique(np.asarray(mysql_ids, dtype=np.int64))
+        with self._writing():
+            self._append_segment(_segment(tombstones=film_ids, drop_films=film_ids))
+
+    def compact(self):
+        """Fold the delta into the exported matrix"""
+
+        with self._writing():
+            self._compact()
+
+    @contextmanager
+    def _writing(self):
+        # One writer at a time across processes, working on what the others wrote last
+        with self.lock, ew_store_util.file_lock(self.path):
+            self._reload_if_changed(locked=True)
+            yield
+
+    def _compact(self):
+        alive = self.alive if self.alive is not None else np.ones(len(self.mysql_ids), dtype=bool)
+        embeddings = np.concatenate([np.asarray(self.embeddings[alive]), self.delta_embeddings]) if len(self.delta_mysql_ids) else np.asarray(self.embeddings[alive])
+        mysql_ids = np.concatenate([self.mysql_ids[alive], self.delta_mysql_ids])
+        chunk_indexes = np.concatenate([self.chunk_indexes[alive], self.delta_chunk_indexes])
+
+        base_name = ew_store_util.new_version("base")
+        base_path = os.path.join(self.path, base_name)
+        _save_base(base_path, embeddings, mysql_ids, chunk_indexes)
+        # The int8 copy has to follow the new rows
+        if self.quantized is not None:
+            _save_quantized(base_path, embeddings)
+        ew_store_util.write_manifest(self.path, {"base": base_name, "segments": []})
+        self._reload_if_changed(locked=True)
+        logger.info(f"Compacted [{self.path}] to [{len(mysql_ids)}] chunks")
+
+    def _append_segment(self, segment):
+        """Apply a change, write it as a new segment, then compact or merge the segments when they grew too much"""
+
+        self._apply(segment)
+        if len(self.delta_mysql_ids) > max(COMPACT_MIN_ROWS, COMPACT_RATIO * len(self.mysql_ids)):
+            self._compact()
+            return
+
+        if len(self._segments) >= MAX_DELTA_SEGMENTS:
+            # One segment holding the whole delta replaces all of them
+            segment = _segment(tombstones=self.tombstones, mysql_ids=self.delta_mysql_ids
+                               , chunk_indexes=self.delta_chunk_indexes, embeddings=self.delta_embeddings)
+            segments = []
+        else:
+            segments = list(self._segments)
+        segment_name = ew_store_util.new_version("delta", ".npz")
+        tmp_path = os.path.join(self.path, f"delta.{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, **segment)
+        os.replace(tmp_path, os.path.join(self.path, segment_name))
+        segments.append(segment_name)
+        ew_store_util.write_manifest(self.path, {"base": self._base_name, "segments": segments})
+        self._segments = segments
+        self._stamp = ew_store_util.manifest_stamp(self.path)
+
+    def _apply(self, segment):
+        """Replay one segment on the delta"""
+
+        self.tombstones = np.union1d(self.tombstones, segment["tombstones"])
+        keep = ~np.isin(self.delta_mysql_ids, segment["drop_films"])
+        if len(segment["drop_chunks"]):
+            keep &= ~np.isin(_chunk_keys(self.delta_mysql_ids, self.delta_chunk_indexes), segment["drop_chunks"])
+        self.delta_mysql_ids = np.concatenate([self.delta_mysql_ids[keep], segment["mysql_ids"]])
+        self.delta_chunk_indexes = np.concatenate([self.delta_chunk_indexes[keep], segment["chunk_indexes"]])
+        embeddings = segment["embeddings"]
+        self.delta_embeddings = np.concatenate([self.delta_embeddings[keep], embeddings]) if len(embeddings) else self.delta_embeddings[keep]
+        self._update_alive()
+
+    def _update_alive(self):
+        self.alive = ~np.isin(self.mysql_ids, self.tombstones) if len(self.tombstones) else None
+
+    def _load(self, manifest, stamp):
+        """
+        Load the base and the delta segments a manifest names. The base is only read when it changed,
+        the segments only from the first one not replayed yet.
+        """
+
+        if manifest["base"] != self._base_name:
+            base_path = os.path.join(self.path, manifest["base"])
+            embeddings = np.load(os.path.join(base_path, "embeddings.npy"), mmap_mode="r")
+            mysql_ids = np.load(os.path.join(base_path, "mysql_ids.npy"))
+            chunk_indexes = np.load(os.path.join(base_path, "chunk_indexes.npy"))
+            quantized, scales = None, None
+            if os.path.exists(os.path.join(base_path, "scales.npy")):
+                quantized = np.load(os.path.join(base_path, "embeddings_int8.npy"), mmap_mode="r")
+                scales = np.load(os.path.join(base_path, "scales.npy"))
+            logger.debug(f"Loaded base [{manifest['base']}] of [{self.path}]")
+        else:
+            embeddings, mysql_ids, chunk_indexes = self.embeddings, self.mysql_ids, self.chunk_indexes
+            quantized, scales = self.quantized, self.scales
+
+        segments = manifest["segments"]
+        replayed = len(self._segments)
+        if manifest["base"] == self._base_name and segments[:replayed] == self._segments:
+            delta = (self.tombstones, self.delta_mysql_ids, self.delta_chunk_indexes, self.delta_embeddings)
+        else:
+            dimension = embeddings.shape[1] if embeddings.ndim == 2 else 0
+            delta = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+                     , np.zeros(0, dtype=np.int32), np.zeros((0, dimension), dtype=np.float32))
+            replayed = 0
+        new_segments = list()
+        for segment_name in segments[replayed:]:
+            with np.load(os.path.join(self.path, segment_name)) as segment:
+                new_segments.append({name: segment[name] for name in segment.files})
+
+        # Everything is read before anything is swapped, a failed load leaves the index as it was
+        self.embeddings, self.mysql_ids, self.chunk_indexes = embeddings, mysql_ids, chunk_indexes
+        self.quantized, self.scales = quantized, scales
+        self.tombstones, self.delta_mysql_ids, self.delta_chunk_indexes, self.delta_embeddings = delta
+        for segment in new_segments:
+            self._apply(segment)
+        self._update_alive()
+        self._base_name, self._segments, self._stamp = manifest["base"], list(segments), stamp
+        return True
+
+    def _reload_if_changed(self, locked=False):
+        if ew_store_util.manifest_stamp(self.path) == self._stamp:
+            return
+        if locked:
+            ew_store_util.load_current(self.path, self._load)
+        else:
+            with self.lock:
+                logger.debug(f"Reloading [{self.path}]")
+                ew_store_util.load_current(self.path, self._load)
+
+
+def normalize(vectors):
+    """L2 normalise a vector or every row of a matrix"""
+
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return (vectors / np.where(norms == 0, 1, norms)).astype(np.float32, copy=False)
+
+
+def top_k(scores, mysql_ids, chunk_indexes, k):
+    """Best k of the cosine similarities as (mysql_id, chunk_index, cosine distance)"""
+
+    k = min(k, int(np.isfinite(scores).sum()))
+    if k <= 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(mysql_ids[i]), int(chunk_indexes[i]), float(1 - scores[i])) for i in top]
+
+
+def pool_by_film(mysql_ids, similarities, n, method="max", top_m=3):
+    """
+    Collapse chunk hits into the best n distinct films as (mysql_id, pooled similarity), best first.
+
+    max  : best chunk of the film
+    mean : mean of the film's best top_m chunks
+    sum  : sum over the film's chunks, films matching in many places win
+    """
+
+    mysql_ids = np.asarray(mysql_ids, dtype=np.int64)
+    similarities = np.asarray(similarities, dtype=np.float64)
+    if len(mysql_ids) == 0 or n <= 0:
+        return []
+
+    films, groups = np.unique(mysql_ids, return_inverse=True)
+    if method == "max":
+        pooled = np.full(len(films), -np.inf)
+        np.maximum.at(pooled, groups, similarities)
+    elif method == "sum":
+        pooled = np.bincount(groups, weights=similarities, minlength=len(films))
+    elif method == "mean":
+        # Rank the chunks inside their film, best first, and keep the top_m of each
+        order = np.lexsort((-similarities, groups))
+        sorted_groups = groups[order]
+        starts = np.searchsorted(sorted_groups, np.arange(len(films)))
+        ranks = np.arange(len(order)) - starts[sorted_groups]
+        kept = order[ranks < top_m]
+        totals = np.bincount(groups[kept], weights=similarities[kept], minlength=len(films))
+        pooled = totals / np.bincount(groups[kept], minlength=len(films))
+    else:
+        raise ValueError(f"Unknown pooling method [{method}]")
+
+    n = min(n, len(films))
+    top = np.argpartition(-pooled, n - 1)[:n]
+    top = top[np.argsort(-pooled[top], kind="stable")]
+    return [(int(films[i]), float(pooled[i])) for i in top]
+
+
+def _segment(tombstones, drop_films=None, drop_chunks=None, mysql_ids=None, chunk_indexes=None, embeddings=None):
+    """Arrays of one delta segment, the missing ones are empty"""
+
+    dimension = embeddings.shape[1] if embeddings is not None and embeddings.ndim == 2 else 0
+    return {
+        "tombstones": np.asarray(tombstones, dtype=np.int64)
+        , "drop_films": np.asarray(drop_films if drop_films is not None else [], dtype=np.int64)
+        , "drop_chunks": np.asarray(drop_chunks if drop_chunks is not None else [], dtype=np.int64)
+        , "mysql_ids": np.asarray(mysql_ids if mysql_ids is not None else [], dtype=np.int64)
+        , "chunk_indexes": np.asarray(chunk_indexes if chunk_indexes is not None else [], dtype=np.int32)
+        , "embeddings": embeddings if embeddings is not None else np.zeros((0, dimension), dtype=np.float32)
+    }
+
+
+def _chunk_keys(mysql_ids, chunk_indexes):
+    return mysql_ids.astype(np.int64) * (1 << 20) + chunk_indexes
+
+
+def _save_base(path, embeddings, mysql_ids, chunk_indexes):
+    ew_store_util.save_array(path, "embeddings", embeddings)
+    ew_store_util.save_array(path, "mysql_ids", mysql_ids)
+    ew_store_util.save_array(path, "chunk_indexes", chunk_indexes)
+
+
+def _save_quantized(path, embeddings):
+    """Write the int8 copy of embeddings and its per dimension scales into a new base directory"""
+
+    max_abs = np.zeros(embeddings.shape[1], dtype=np.float32)
+    for start in range(0, len(embeddings), SCAN_BLOCK_SIZE):
+        block = np.abs(embeddings[start:start + SCAN_BLOCK_SIZE])
+        max_abs = np.maximum(max_abs, block.max(axis=0))
+    scales = np.where(max_abs == 0, 1, max_abs / 127).astype(np.float32)
+
+    tmp_path = os.path.join(path, f"embeddings_int8.{os.getpid()}.tmp.npy")
+    quantized = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.int8, shape=embeddings.shape)
+    for start in range(0, len(embeddings), SCAN_BLOCK_SIZE):
+        block = embeddings[start:start + SCAN_BLOCK_SIZE] / scales
+        quantized[start:start + len(block)] = np.clip(np.rint(block), -127, 127)
+    quantized.flush()
+    del quantized
+    os.replace(tmp_path, os.path.join(path, "embeddings_int8.npy"))
+    # scales.npy marks the int8 copy as complete
+    ew_store_util.save_array(path, "scales", scales)